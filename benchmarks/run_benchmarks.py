@@ -0,0 +1,540 @@
+"""Benchmarks of the Newns-Anderson models in catchemi.
+
+Every benchmark builds a model and evaluates the quantities that are
+used in practice, covering Delta0 = 0 and Delta0 > 0, poles of the
+Green's function inside and outside the d-band, the float and the arb
+paths, single evaluations and 2D sweeps, and a full fit on the data in
+examples/inputs. The import benchmarks time the start of a fresh Python
+process that imports parts of catchemi, as the short-lived workers do.
+Nothing is downloaded, so the suite runs offline.
+
+For every benchmark the wall time over a number of repeats, the number
+of integrals done with quad and acb.integral and the number of energies
+the integrands were evaluated at, both taken from the counters of the
+models in NewnsAndersonInstrumentation, and the peak memory allocated
+through tracemalloc are reported. The three are measured in separate
+runs, so that counting and tracing do not distort the timings. The results are stored as JSON and two of
+them can be compared with --compare.
+
+Usage:
+
+    python benchmarks/run_benchmarks.py                    # run and store
+    python benchmarks/run_benchmarks.py --quick -k sweep   # subset, fewer repeats
+    python benchmarks/run_benchmarks.py --compare old.json new.json
+    python benchmarks/run_benchmarks.py --compare old.json # against a new run
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from collections import defaultdict
+from datetime import datetime
+
+import numpy as np
+import scipy
+import yaml
+from scipy import odr
+import flint
+
+from catchemi import (NewnsAndersonNumerical, NewnsAndersonLinearRepulsion,
+                      NewnsAndersonGrimleyRepulsion, NewnsAndersonDerivativeEpsd,
+                      NewnsAndersonAnalytical, NewnsAndersonBatch,
+                      FitParametersNewnsAnderson, FitAdsorbatesNewnsAnderson,
+                      NewnsAndersonTabulatedLinearRepulsion, NewnsAndersonShapeNumerical,
+                      model_cache, instrumentation)
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPOSITORY_DIR = os.path.dirname(BENCHMARK_DIR)
+INPUTS_DIR = os.path.join(BENCHMARK_DIR, '..', 'examples', 'inputs')
+RESULTS_DIR = os.path.join(BENCHMARK_DIR, 'results')
+
+# Energy grid, sp-band and Delta0 used throughout, as in examples/run_model.py
+EPS_VALUES = np.linspace(-30, 10, 1000)
+EPS_SP_MIN = -15
+EPS_SP_MAX = 15
+CONSTANT_DELTA0 = 0.1
+
+# Registry of the benchmarks, filled by the benchmark decorator
+BENCHMARKS = {}
+
+
+def benchmark(name, description):
+    """Register a benchmark. The function takes the quick flag and
+    returns a function that performs one run of the benchmark."""
+    def register(function):
+        BENCHMARKS[name] = (description, function)
+        return function
+    return register
+
+
+def count_evaluations(run) -> dict:
+    """Run a benchmark once with the instrumentation enabled and get the
+    counts summed over the recorders of the models it created. Every
+    benchmark creates its models within the run, so they all get a
+    recorder; models evaluated in worker processes are not counted."""
+    enabled = instrumentation.enabled
+    instrumentation.configure(enabled=True)
+    instrumentation.clear()
+    try:
+        _run_quietly(run)
+        counts = instrumentation.get_statistics()['counts']
+    finally:
+        instrumentation.configure(enabled=enabled)
+        instrumentation.clear()
+    return counts
+
+
+def load_fitting_data(adsorbate='C', site='hollow'):
+    """Load the d-band centres, widths, coupling elements, number of bonds
+    and DFT energies of examples/inputs, prepared as in examples/run_model.py.
+    The bond lengths only enter as a ratio to that of Cu, so they are
+    used in units of Bohr."""
+    with open(os.path.join(INPUTS_DIR, 'pdos_moments.json')) as handle:
+        data_from_dos_calculation = json.load(handle)
+    with open(os.path.join(INPUTS_DIR, 'adsorption_energies.json')) as handle:
+        data_from_energy_calculation = json.load(handle)
+    with open(os.path.join(INPUTS_DIR, 'data_from_LMTO.json')) as handle:
+        data_from_LMTO = json.load(handle)
+    with open(os.path.join(INPUTS_DIR, 'number_bonds.yaml')) as handle:
+        no_of_bonds = yaml.safe_load(handle)
+
+    s_data = data_from_LMTO['s']
+    anderson_band_width = data_from_LMTO['anderson_band_width']
+    parameters = defaultdict(list)
+    for metal, adsorption_energy in data_from_energy_calculation[adsorbate].items():
+        parameters['metals'].append(metal)
+        parameters['width'].append(data_from_dos_calculation[metal]['width'])
+        parameters['d_band_centre'].append(data_from_dos_calculation[metal]['d_band_centre'])
+        parameters['dft_energy'].append(np.min(adsorption_energy))
+        # Vsd^2 normalised by that of Cu and by the bond length
+        Vsdsq = s_data[metal]**5 * anderson_band_width[metal]
+        Vsdsq /= s_data['Cu']**5 * anderson_band_width['Cu']
+        Vsdsq *= s_data['Cu']**8 / s_data[metal]**8
+        parameters['Vsd'].append(np.sqrt(Vsdsq))
+        parameters['no_of_bonds'].append(no_of_bonds[site][metal])
+    return parameters
+
+
+def _evaluate_numerical(model):
+    """Evaluate the quantities of a single Newns-Anderson calculation."""
+    model.get_hybridisation_energy()
+    model.get_occupancy()
+    model.get_dband_filling()
+
+
+def _numerical_benchmark(Delta0_mag, Vak, eps_a, eps_d, width, **kwargs):
+    def run():
+        _evaluate_numerical(NewnsAndersonNumerical(Vak=Vak, eps_a=eps_a, eps_d=eps_d,
+                                                   width=width, eps=EPS_VALUES,
+                                                   Delta0_mag=Delta0_mag,
+                                                   eps_sp_min=EPS_SP_MIN,
+                                                   eps_sp_max=EPS_SP_MAX, **kwargs))
+    return run
+
+
+# Parameters with the zero of eps - eps_a - Lambda below the d-band,
+# where it is a localised state for Delta0 = 0, and within the d-band
+POLE_OUTSIDE = dict(Vak=2.0, eps_a=-5.0, eps_d=-2.0, width=1.5)
+POLE_INSIDE = dict(Vak=1.0, eps_a=-1.0, eps_d=-2.0, width=3.0)
+
+def _register_numerical(Delta0_label, Delta0_mag, pole_label, parameters, engine):
+    @benchmark(f'numerical/{Delta0_label}/{pole_label}/{engine}',
+               f'NewnsAndersonNumerical, {engine} occupancy')
+    def setup(quick):
+        return _numerical_benchmark(Delta0_mag, occupancy_engine=engine, **parameters)
+
+for Delta0_label, Delta0_mag in [ ('delta0_zero', 0.0), ('delta0_finite', CONSTANT_DELTA0) ]:
+    for pole_label, parameters in [ ('pole_outside', POLE_OUTSIDE), ('pole_inside', POLE_INSIDE) ]:
+        for engine in ['float', 'arb']:
+            _register_numerical(Delta0_label, Delta0_mag, pole_label, parameters, engine)
+
+
+def _register_shape(shape, skewness):
+    @benchmark(f'numerical/delta0_finite/{shape}',
+               f'NewnsAndersonShapeNumerical, {shape} Delta')
+    def setup(quick):
+        def run():
+            _evaluate_numerical(NewnsAndersonShapeNumerical(eps=EPS_VALUES, Delta0_mag=CONSTANT_DELTA0,
+                                                            eps_sp_min=EPS_SP_MIN, eps_sp_max=EPS_SP_MAX,
+                                                            shape=shape, skewness=skewness, **POLE_INSIDE))
+        return run
+
+for shape, skewness in [ ('gaussian', 0.0), ('lorentzian', 0.0), ('skewed', 0.5) ]:
+    _register_shape(shape, skewness)
+
+@benchmark('numerical/delta0_finite/escalate',
+           'NewnsAndersonNumerical, float integrals escalated to arb')
+def _numerical_escalate(quick):
+    # Parameters for which the float hybridisation energy misses the tolerance
+    return _numerical_benchmark(CONSTANT_DELTA0, Vak=3.0, eps_a=1.0, eps_d=-2.0, width=2.0,
+                                precision_policy='escalate')
+
+
+@benchmark('numerical/delta0_finite/gauss_legendre',
+           'NewnsAndersonNumerical, Gauss-Legendre panels and float occupancy')
+def _numerical_gauss_legendre(quick):
+    return _numerical_benchmark(CONSTANT_DELTA0, quadrature='gauss_legendre',
+                                occupancy_engine='float', **POLE_INSIDE)
+
+
+@benchmark('linear_repulsion/single', 'NewnsAndersonLinearRepulsion, chemisorption energy')
+def _linear_repulsion(quick):
+    def run():
+        NewnsAndersonLinearRepulsion(Vsd=2.0, eps_a=-1.0, eps_d=-2.0, width=2.0,
+                                     eps=EPS_VALUES, Delta0_mag=CONSTANT_DELTA0,
+                                     eps_sp_min=EPS_SP_MIN, eps_sp_max=EPS_SP_MAX,
+                                     alpha=0.1, beta=2.0, constant_offset=0.1,
+                                     add_largeS_contribution=True).get_chemisorption_energy()
+    return run
+
+
+@benchmark('linear_repulsion/derivatives', 'NewnsAndersonLinearRepulsion, parameter derivatives')
+def _linear_repulsion_derivatives(quick):
+    def run():
+        NewnsAndersonLinearRepulsion(Vsd=2.0, eps_a=-1.0, eps_d=-2.0, width=2.0,
+                                     eps=EPS_VALUES, Delta0_mag=CONSTANT_DELTA0,
+                                     eps_sp_min=EPS_SP_MIN, eps_sp_max=EPS_SP_MAX,
+                                     alpha=0.1, beta=2.0, constant_offset=0.1,
+                                     occupancy_engine='float').get_chemisorption_energy_derivatives()
+    return run
+
+
+def _register_grimley_repulsion(single_pass):
+    @benchmark(f'grimley_repulsion/{"single_pass" if single_pass else "two_pass"}',
+               'NewnsAndersonGrimleyRepulsion, chemisorption energy')
+    def setup(quick):
+        def run():
+            NewnsAndersonGrimleyRepulsion(Vsd=2.0, eps_a=-5.0, eps_d=-2.0, width=2.0,
+                                          eps=EPS_VALUES, Delta0_mag=CONSTANT_DELTA0,
+                                          eps_sp_min=EPS_SP_MIN, eps_sp_max=EPS_SP_MAX,
+                                          alpha=0.05, beta=2.0,
+                                          quadrature='gauss_legendre' if single_pass else 'adaptive',
+                                          single_pass=single_pass).get_chemisorption_energy()
+        return run
+
+for single_pass in [False, True]:
+    _register_grimley_repulsion(single_pass)
+
+
+@benchmark('tabulated/linear_repulsion',
+           'NewnsAndersonTabulatedLinearRepulsion, semi-elliptic Delta on the grid')
+def _tabulated_linear_repulsion(quick):
+    eps_ref = ( EPS_VALUES + 2.0 ) / 2.0
+    Delta = np.sqrt(np.clip(1 - eps_ref**2, 0.0, None))
+    def run():
+        NewnsAndersonTabulatedLinearRepulsion(EPS_VALUES, Delta, eps_a=-1.0, Vsd=2.0,
+                                              Delta0_mag=CONSTANT_DELTA0,
+                                              eps_sp_min=EPS_SP_MIN, eps_sp_max=EPS_SP_MAX,
+                                              alpha=0.1, beta=2.0,
+                                              constant_offset=0.1).get_chemisorption_energy()
+    return run
+
+
+def _f_Vsd(eps_d):
+    return 2.0 - 0.2 * eps_d
+
+def _f_Vsd_p(eps_d):
+    return -0.2
+
+def _f_wd(eps_d):
+    return 2.5 + 0.3 * eps_d
+
+def _f_wd_p(eps_d):
+    return 0.3
+
+
+def _register_derivative_epsd(use_multiprec):
+    @benchmark(f'derivative_epsd/{"arb" if use_multiprec else "float"}',
+               'NewnsAndersonDerivativeEpsd, derivative on the diff grid')
+    def setup(quick):
+        # The arb path integrates one d-band centre at a time
+        diff_grid = np.linspace(-4, -1, 5 if quick or use_multiprec else 50)
+        def run():
+            NewnsAndersonDerivativeEpsd(f_Vsd=_f_Vsd, f_Vsd_p=_f_Vsd_p, eps_a=-1.0,
+                                        f_wd=_f_wd, f_wd_p=_f_wd_p, eps=EPS_VALUES,
+                                        Delta0_mag=CONSTANT_DELTA0, eps_sp_min=EPS_SP_MIN,
+                                        eps_sp_max=EPS_SP_MAX, beta=2.0, diff_grid=diff_grid,
+                                        use_multiprec=use_multiprec).get_hybridisation_energy_prime_epsd()
+        return run
+
+for use_multiprec in [False, True]:
+    _register_derivative_epsd(use_multiprec)
+
+
+@benchmark('analytical/self_consistent', 'NewnsAndersonAnalytical, spin polarised self-consistency')
+def _analytical(quick):
+    def run():
+        NewnsAndersonAnalytical(beta_p=2.0, eps_a=-1.0, eps=np.linspace(-20, 20, 10000),
+                                eps_d=-2.0, beta=2.0, fermi_energy=0.0,
+                                U=2.0).self_consistent_calculation()
+    return run
+
+
+@benchmark('sweep/numerical_loop', 'NewnsAndersonNumerical over a width x eps_d grid, one by one')
+def _sweep_numerical(quick):
+    size = 4 if quick else 10
+    widths = np.linspace(1, 6, size)
+    eps_ds = np.linspace(-6, 2, size)
+    def run():
+        for width in widths:
+            for eps_d in eps_ds:
+                _evaluate_numerical(NewnsAndersonNumerical(Vak=1.0, eps_a=0.0, eps_d=eps_d,
+                                                           width=width, eps=EPS_VALUES,
+                                                           Delta0_mag=CONSTANT_DELTA0,
+                                                           occupancy_engine='float'))
+    return run
+
+
+@benchmark('sweep/batch', 'NewnsAndersonBatch over a width x eps_d grid')
+def _sweep_batch(quick):
+    size = 20 if quick else 75
+    widths = np.linspace(1, 12, size)
+    eps_ds = np.linspace(-6, 5.5, size)
+    def run():
+        newns = NewnsAndersonBatch(width=widths[:, None], Vak=1.0, eps_a=0.0,
+                                   eps_d=eps_ds[None, :], eps=EPS_VALUES,
+                                   Delta0_mag=0.0)
+        newns.get_hybridisation_energy()
+        newns.get_occupancy()
+        newns.get_dband_filling()
+    return run
+
+
+@benchmark('fit/odr_C', 'FitParametersNewnsAnderson, ODR fit of C* on examples/inputs')
+def _fit(quick):
+    parameters = load_fitting_data('C')
+    def run():
+        fitting_function = FitParametersNewnsAnderson(
+            eps_sp_min=EPS_SP_MIN, eps_sp_max=EPS_SP_MAX, eps=EPS_VALUES,
+            Delta0_mag=CONSTANT_DELTA0, Vsd=parameters['Vsd'],
+            width=parameters['width'], eps_a=-1.0,
+            no_of_bonds=parameters['no_of_bonds'], occupancy_engine='float')
+        data = odr.RealData(parameters['d_band_centre'], parameters['dft_energy'])
+        fitting_model = odr.Model(fitting_function.fit_parameters,
+                                  fjacb=fitting_function.jacobian,
+                                  fjacd=lambda beta, x: np.zeros_like(x))
+        fitting_odr = odr.ODR(data, fitting_model, [0.01, np.pi*0.6, 0.1],
+                              maxit=2 if quick else 50)
+        fitting_odr.set_job(fit_type=2, deriv=3)
+        fitting_odr.run()
+    return run
+
+
+@benchmark('fit/sequential_O_C', 'FitAdsorbatesNewnsAnderson, warm started fits of O* and C* on examples/inputs')
+def _fit_adsorbates(quick):
+    adsorbates = {'O': -5.0, 'C': -1.0}
+    surfaces = {}
+    energies = {}
+    no_of_bonds = {}
+    for adsorbate in adsorbates:
+        parameters = load_fitting_data(adsorbate)
+        metals = parameters['metals']
+        for i, metal in enumerate(metals):
+            surfaces[metal] = ( parameters['d_band_centre'][i], parameters['width'][i], parameters['Vsd'][i] )
+        energies[adsorbate] = dict(zip(metals, parameters['dft_energy']))
+        no_of_bonds[adsorbate] = dict(zip(metals, parameters['no_of_bonds']))
+    metals = sorted(surfaces)
+    eps_d, width, Vsd = [ [ surfaces[metal][i] for metal in metals ] for i in range(3) ]
+    def run():
+        engine = FitAdsorbatesNewnsAnderson(metals, eps_d, width, Vsd, eps=EPS_VALUES,
+                                            Delta0_mag=CONSTANT_DELTA0, eps_sp_min=EPS_SP_MIN,
+                                            eps_sp_max=EPS_SP_MAX, occupancy_engine='float')
+        for adsorbate, eps_a in adsorbates.items():
+            engine.add_adsorbate(adsorbate, eps_a, energies[adsorbate], no_of_bonds[adsorbate])
+        engine.fit(max_nfev=2 if quick else 50)
+    return run
+
+
+# Statements run in a fresh interpreter by the import benchmarks; the
+# interpreter and numpy alone are the floor of the others
+IMPORT_STATEMENTS = {
+    'interpreter': 'pass',
+    'numpy': 'import numpy',
+    'package': 'import catchemi',
+    'analytical': 'from catchemi import NewnsAndersonAnalytical',
+    'numerical': 'from catchemi import NewnsAndersonNumerical',
+    'linear_repulsion': 'from catchemi import NewnsAndersonLinearRepulsion',
+    'all': 'from catchemi import *',
+}
+
+def _register_import(name, statement):
+    @benchmark(f'import/{name}', f'Start Python and run: {statement}')
+    def setup(quick):
+        # The catchemi of this repository, not an installed one
+        environment = dict(os.environ, PYTHONPATH=os.pathsep.join(
+            filter(None, [ REPOSITORY_DIR, os.environ.get('PYTHONPATH') ])))
+        def run():
+            subprocess.run([ sys.executable, '-c', statement ], env=environment, check=True)
+        return run
+
+for name, statement in IMPORT_STATEMENTS.items():
+    _register_import(name, statement)
+
+
+def _run_quietly(function):
+    """Run a function with the output of the models suppressed."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        return function()
+
+
+def run_benchmark(name, repeat, quick):
+    """Time, count and trace a single benchmark."""
+    description, setup = BENCHMARKS[name]
+    run = setup(quick)
+    # A first run to import and compile everything that is lazily set up
+    _run_quietly(run)
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        _run_quietly(run)
+        times.append(time.perf_counter() - start)
+
+    counts = count_evaluations(run)
+
+    tracemalloc.start()
+    try:
+        _run_quietly(run)
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'description': description,
+        'repeat': repeat,
+        'time_min': float(np.min(times)),
+        'time_median': float(np.median(times)),
+        'time_mean': float(np.mean(times)),
+        'integrals': int(counts.get('quad_integrals', 0) + counts.get('arb_integrals', 0)),
+        'integrand_evaluations': int(sum(value for key, value in counts.items()
+                                         if key.endswith('_evaluations'))),
+        'counts': dict(sorted(counts.items())),
+        'peak_memory': int(peak_memory),
+    }
+
+
+def get_metadata(quick) -> dict:
+    """Information on the environment the benchmarks were run in."""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCHMARK_DIR,
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'commit': commit,
+        'quick': quick,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'scipy': scipy.__version__,
+        'flint': flint.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def run_benchmarks(names, repeat, quick, output=None) -> dict:
+    """Run the benchmarks and store the results as JSON."""
+    # Cached results would make the repeats measure the cache lookups
+    model_cache.configure(enabled=False)
+    results = { 'metadata': get_metadata(quick), 'benchmarks': {} }
+    print(f'{"benchmark":45s} {"median (s)":>12s} {"min (s)":>10s} {"integrals":>9s} {"evals":>10s} {"peak (MB)":>10s}')
+    for name in names:
+        try:
+            result = run_benchmark(name, repeat, quick)
+        except Exception as error:
+            # A failing benchmark is recorded, the others are still run
+            results['benchmarks'][name] = { 'description': BENCHMARKS[name][0],
+                                            'error': f'{type(error).__name__}: {error}' }
+            print(f'{name:45s} failed with {results["benchmarks"][name]["error"]}')
+            continue
+        results['benchmarks'][name] = result
+        print(f'{name:45s} {result["time_median"]:12.4f} {result["time_min"]:10.4f} '
+              f'{result["integrals"]:9d} {result["integrand_evaluations"]:10d} '
+              f'{result["peak_memory"] / 1e6:10.2f}')
+
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        label = results['metadata']['commit'] or 'nocommit'
+        output = os.path.join(RESULTS_DIR, f'{datetime.now().strftime("%Y%m%d-%H%M%S")}_{label}.json')
+    with open(output, 'w') as handle:
+        json.dump(results, handle, indent=2)
+    print(f'Results written to {output}')
+    return results
+
+
+def compare_results(baseline, current, threshold) -> bool:
+    """Print the ratios of the current to the baseline results. Returns
+    True if a median time, count of integrals or evaluations or the peak
+    memory grew by more
+    than the threshold."""
+    print(f'Baseline: {baseline["metadata"]["commit"]} ({baseline["metadata"]["date"]})')
+    print(f'Current:  {current["metadata"]["commit"]} ({current["metadata"]["date"]})')
+    print(f'{"benchmark":45s} {"time":>8s} {"integral":>8s} {"evals":>8s} {"memory":>8s}')
+    regression = False
+    for name, result in current['benchmarks'].items():
+        if name not in baseline['benchmarks']:
+            print(f'{name:45s} not in the baseline')
+            continue
+        reference = baseline['benchmarks'][name]
+        if 'error' in result or 'error' in reference:
+            print(f'{name:45s} failed in ' + ( 'the current run' if 'error' in result else 'the baseline' ))
+            continue
+        ratios = []
+        for key in ['time_median', 'integrals', 'integrand_evaluations', 'peak_memory']:
+            # Results stored before a key was added have no ratio for it
+            ratios.append(result[key] / reference[key] if reference.get(key) else np.nan)
+        slower = [ ratio > 1 + threshold for ratio in ratios if np.isfinite(ratio) ]
+        regression |= any(slower)
+        print(f'{name:45s} ' + ' '.join(f'{ratio:8.2f}' for ratio in ratios)
+              + ('  <-- regression' if any(slower) else ''))
+    return regression
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-k', dest='keyword', default=None,
+                        help='Only run the benchmarks whose name contains this string.')
+    parser.add_argument('--repeat', type=int, default=None,
+                        help='Number of timed runs of every benchmark (default 5, 2 with --quick).')
+    parser.add_argument('--quick', action='store_true',
+                        help='Smaller sweeps, diff grid and fit, for a fast check.')
+    parser.add_argument('--output', default=None,
+                        help='JSON file for the results (default in benchmarks/results).')
+    parser.add_argument('--compare', nargs='+', metavar='RESULTS',
+                        help='Compare a baseline with a second results file, or with a new run.')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Relative growth reported as a regression by --compare.')
+    parser.add_argument('--list', action='store_true', help='List the benchmarks.')
+    args = parser.parse_args(argv)
+
+    names = [ name for name in BENCHMARKS if args.keyword is None or args.keyword in name ]
+    if args.list:
+        for name in names:
+            print(f'{name:45s} {BENCHMARKS[name][0]}')
+        return 0
+
+    if args.compare and len(args.compare) > 2:
+        parser.error('--compare takes a baseline and at most one more results file.')
+    if args.compare and len(args.compare) == 2:
+        with open(args.compare[1]) as handle:
+            current = json.load(handle)
+    else:
+        repeat = args.repeat if args.repeat is not None else ( 2 if args.quick else 5 )
+        current = run_benchmarks(names, repeat, args.quick, args.output)
+
+    if args.compare:
+        with open(args.compare[0]) as handle:
+            baseline = json.load(handle)
+        return int(compare_results(baseline, current, args.threshold))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,6 +2,10 @@
 from dataclasses import dataclass
 import numpy as np
 from pprint import pprint
+from catchemi.NewnsAndersonInstrumentation import instrumentation, timed_stage
+
+# np.trapz was renamed to np.trapezoid in numpy 2.0 and later removed
+trapezoid = getattr(np, 'trapezoid', None) or np.trapz
 
 @dataclass
 class NewnsAndersonAnalytical:
@@ -21,6 +25,8 @@ class NewnsAndersonAnalytical:
             Fermi energy in the units of eV
         U: float
             Coulomb interaction parameter in units of eV
+        verbose: bool
+            If True, the inputs and the self-consistent results are printed
     """ 
     beta_p: float
     eps_a: float
@@ -29,7 +35,9 @@ class NewnsAndersonAnalytical:
     beta: float
     fermi_energy: float
     U: float
+    verbose: bool = False
     grid_size = 20
+    tolerance = 1e-10
 
     def __post_init__(self):
         """Setup the quantities for a self-consistent calculation."""
@@ -44,90 +52,78 @@ class NewnsAndersonAnalytical:
         self.convert = 2 * self.beta
         self.U = self.U / self.convert
         self.eps_a = self.eps_a / self.convert
-        self.eps = self.eps / self.convert 
+        # The grid is kept sorted so that windows of it are found by bisection
+        self.eps = np.sort(np.asarray(self.eps, dtype=float)) / self.convert 
         self.eps_d = self.eps_d / self.convert
         self.fermi_energy = self.fermi_energy / self.convert
         # The quantities that will be of interest here 
         self.Delta = np.zeros(len(self.eps))
         self.Lambda = np.zeros(len(self.eps))
         self.rho_aa = np.zeros(len(self.eps))
+        # Buffers for the quantities that change with eps_sigma, reused
+        # by every call of calculate_energies
+        self._rho_aa_buffer = np.zeros(len(self.eps))
+        self._denominator_buffer = np.zeros(len(self.eps))
+        self._arctan_buffer = np.zeros(len(self.eps))
+        self._grid_parameters = None
+        # Counters and timers, which do nothing unless the
+        # instrumentation is enabled when the model is created
+        self.recorder = instrumentation.get_recorder(self)
         # Print out details of the quantities
-        input_data = {
-            "beta_p": self.beta_p,
-            "eps_a": self.eps_a,
-            "eps_d": self.eps_d,
-            "beta": self.beta,
-            "fermi_energy": self.fermi_energy,
-            "U": self.U,
-        }
-        pprint(input_data)
+        if self.verbose:
+            input_data = {
+                "beta_p": self.beta_p,
+                "eps_a": self.eps_a,
+                "eps_d": self.eps_d,
+                "beta": self.beta,
+                "fermi_energy": self.fermi_energy,
+                "U": self.U,
+            }
+            pprint(input_data)
 
     
+    def get_statistics(self) -> dict:
+        """Get the number of energies evaluated and the time spent in each
+        stage, if the instrumentation was enabled when the model was created."""
+        return self.recorder.get_statistics()
+
+    @timed_stage('self_consistency')
     def self_consistent_calculation(self):
         """ Calculate the self-consistency point for the given parameters."""
         if self.U == 0:
             # There is no columb interaction, so the self-consistency point is
-            print('No need for self-consistent calculation, U=0')
+            if self.verbose:
+                print('No need for self-consistent calculation, U=0')
             self.n_minus_sigma = 1.
             self.n_plus_sigma = 1.
         else:
-            # Find the lowest maximum value for varying n_down
-            lowest_energy = None
-            index_nup_overall = None
-            index_ndown_overall = None
-            # Store all the energies of the grid
-            self.energies_grid = np.zeros((len(self.nsigma_range), len(self.nmsigma_range)))
-            for j, n_down in enumerate(self.nmsigma_range):
-                # Fix n_minus sigma and determine energies for different 
-                # values of n_plus sigma
-                energies_down = np.zeros(len(self.nsigma_range))
-                for i, n_up in enumerate(self.nsigma_range):
-
-                    # Define the energies for up and down spins
-                    self.eps_sigma_up = self.eps_a + self.U * n_down 
-                    self.eps_sigma_down = self.eps_a + self.U * n_up
-
-                    # Calculate the 1electron energies
-                    # First calculate the spin up energy
-                    self.eps_sigma = self.eps_sigma_up
-                    self.calculate_energies()
-                    energies_down_ = self.DeltaE_1sigma
-                    # Now calculate the spin down energy
-                    self.eps_sigma = self.eps_sigma_down
-                    self.calculate_energies()
-                    energies_down_ += self.DeltaE_1sigma
-
-                    # Calculate the coulomb contribution
-                    coulomb_energy = self.U * n_down * n_up
-                    energies_down_ -= coulomb_energy
-
-                    # Subtract the adsorbate energy
-                    energies_down_ -= self.eps_a 
-
-                    # Store the energies to check if it is the lowest
-                    energies_down[i] = energies_down_
-
-                # determine the maximum value of the energy
-                maximum_energy = np.max(energies_down)
-                index_nup = np.argmax(energies_down)
-                # Store the energies for the grid
-                self.energies_grid[:, j] = energies_down
-                
-                # Choose whether to store this energy or not
-                if lowest_energy is not None:
-                    lowest_energy = maximum_energy if maximum_energy <= lowest_energy else lowest_energy
-                    index_nup_overall = index_nup if maximum_energy <= lowest_energy else index_nup_overall
-                    index_ndown_overall = j if maximum_energy <= lowest_energy else index_ndown_overall
-                else:
-                    # First run, store these quantities
-                    lowest_energy = maximum_energy
-                    index_nup_overall = index_nup
-                    index_ndown_overall = j
-            
-            # Determine the values that give the lowest energy
-            self.n_minus_sigma = self.nmsigma_range[index_ndown_overall]
-            self.n_plus_sigma = self.nsigma_range[index_nup_overall]
+            # The level of one spin only depends on the occupancy of the other,
+            # eps_sigma = eps_a + U n_-sigma, so the one electron energies are
+            # needed only once for every distinct occupancy on the grid.
+            n_values, inverse = np.unique(np.concatenate([self.nsigma_range, self.nmsigma_range]),
+                                          return_inverse=True)
+            energies_1sigma = np.array([ self._solve_spin(self.eps_a + self.U * n)[0] for n in n_values ])
+            # Energy of the spin down electron as a function of n_up (rows)
+            # and of the spin up electron as a function of n_down (columns)
+            energies_down = energies_1sigma[inverse[:len(self.nsigma_range)]]
+            energies_up = energies_1sigma[inverse[len(self.nsigma_range):]]
 
+            # Store all the energies of the grid
+            self.energies_grid = energies_down[:, np.newaxis] + energies_up[np.newaxis, :]
+            self.energies_grid -= self.U * np.outer(self.nsigma_range, self.nmsigma_range)
+            self.energies_grid -= self.eps_a
+
+            # Find the lowest maximum value for varying n_down; for equal
+            # maxima the last value of n_down is chosen
+            maximum_energies = np.max(self.energies_grid, axis=0)
+            index_ndown_overall = len(maximum_energies) - 1 - np.argmin(maximum_energies[::-1])
+            index_nup_overall = np.argmax(self.energies_grid[:, index_ndown_overall])
+
+            # Refine the point of the grid to the solution of the Hartree-Fock
+            # conditions n_up = n(eps_a + U n_down), n_down = n(eps_a + U n_up)
+            n_up = self._refine_self_consistency(self.nsigma_range[index_nup_overall])
+            self.n_plus_sigma = n_up
+            self.n_minus_sigma = self._solve_spin(self.eps_a + self.U * n_up)[1]
 
         # Store all the quantities for the self-consistency point
         self.eps_sigma_up = self.eps_a + self.U * self.n_minus_sigma 
@@ -136,11 +132,11 @@ class NewnsAndersonAnalytical:
         # Sum up the energies from both of the spins
         self.eps_sigma = self.eps_sigma_up
         self.calculate_energies()
-        self.rho_aa_up = self.rho_aa
+        self.rho_aa_up = self.rho_aa.copy()
         DeltaE_ = self.DeltaE_1sigma
         self.eps_sigma = self.eps_sigma_down
         self.calculate_energies()
-        self.rho_aa_down = self.rho_aa
+        self.rho_aa_down = self.rho_aa.copy()
         DeltaE_ += self.DeltaE_1sigma
 
         # The variable rhoaa will be the sum of the two rhos
@@ -157,59 +153,121 @@ class NewnsAndersonAnalytical:
         self.DeltaE = DeltaE_ 
 
         # Print out the final results
-        print('--------------------------')
-        print(f"Spin up expectation value   : {self.n_minus_sigma} e")
-        print(f"Spin down expectation value : {self.n_plus_sigma} e")
-        print(f"Self-consistency energy     : {self.DeltaE} (2beta)")
-
-
-    def calculate_energies(self):
-        """Calculate the 1e energies from the Newns-Anderson model."""
+        if self.verbose:
+            print('--------------------------')
+            print(f"Spin up expectation value   : {self.n_minus_sigma} e")
+            print(f"Spin down expectation value : {self.n_plus_sigma} e")
+            print(f"Self-consistency energy     : {self.DeltaE} (2beta)")
+
+    def _nearest_index(self, value) -> int:
+        """Index of the grid point closest to value, the lower one on a tie."""
+        index = np.searchsorted(self.eps, value)
+        if index == 0:
+            return 0
+        if index == len(self.eps):
+            return len(self.eps) - 1
+        if value - self.eps[index-1] <= self.eps[index] - value:
+            return index - 1
+        return index
+
+    @timed_stage('grid')
+    def _setup_grid(self):
+        """Compute the quantities that depend only on the grid, eps_d and beta_p."""
+        if np.any(np.isnan(self.eps)):
+            raise ValueError("The epsilon value is not valid.")
 
         # Energies referenced to the d-band center
         # Needed for some manipulations later
         self.eps_wrt_d = self.eps - self.eps_d
-        self.eps_sigma_wrt_d = self.eps_sigma - self.eps_d
 
         # Construct Delta in units of 2beta
         self.width_of_band =  1 
-        self.Delta = 2 * self.beta_p**2 * ( 1 - self.eps_wrt_d**2 )**0.5
-        self.Delta = np.nan_to_num(self.Delta)
+        with np.errstate(invalid='ignore'):
+            self.Delta[:] = 2 * self.beta_p**2 * ( 1 - self.eps_wrt_d**2 )**0.5
+        np.nan_to_num(self.Delta, copy=False)
 
         # Calculate the positions of the upper and lower band edge
         self.lower_band_edge = - self.width_of_band + self.eps_d
         self.upper_band_edge = + self.width_of_band + self.eps_d
-        index_lower_band_edge = np.argmin(np.abs(self.eps - self.lower_band_edge))
-        index_upper_band_edge = np.argmin(np.abs(self.eps - self.upper_band_edge))
+        index_lower_band_edge = self._nearest_index(self.lower_band_edge)
+        index_upper_band_edge = self._nearest_index(self.upper_band_edge)
         self.Delta_at_lower_band_edge = self.Delta[index_lower_band_edge]
         self.Delta_at_upper_band_edge = self.Delta[index_upper_band_edge]
 
-        # Construct Lambda in units of 2beta
-        lower_hilbert_args = []
-        upper_hilbert_args = []
-        for i, eps in enumerate(self.eps_wrt_d):
-            if np.abs(eps) <= self.width_of_band: 
-                self.Lambda[i] = 2 * self.beta_p**2 * eps 
-            elif eps > self.width_of_band:
-                self.Lambda[i] = 2 * self.beta_p**2 * ( eps - (eps**2 - 1)**0.5 )
-                upper_hilbert_args.append(i)
-            elif eps < -self.width_of_band:
-                self.Lambda[i] = 2 * self.beta_p**2 * ( eps + (eps**2 - 1)**0.5 )
-                lower_hilbert_args.append(i)
-            else:
-                raise ValueError("The epsilon value is not valid.")
-
+        # Construct Lambda in units of 2beta; the Hilbert transform of the
+        # semi-ellipse outside of the band, linear within it
+        root_outside_band = np.sqrt(np.maximum(self.eps_wrt_d**2 - 1, 0))
+        self.Lambda[:] = 2 * self.beta_p**2 * ( self.eps_wrt_d - np.sign(self.eps_wrt_d) * root_outside_band )
         self.Lambda_at_lower_band_edge = self.Lambda[index_lower_band_edge]
         self.Lambda_at_upper_band_edge = self.Lambda[index_upper_band_edge]
 
+        # Parts of the adsorbate density of states that do not depend on eps_sigma
+        self._rho_aa_numerator = self.Delta / np.pi
+        self._rho_aa_quadratic = self.eps_wrt_d**2 * ( 1 - 4 * self.beta_p**2 ) + 4 * self.beta_p**4
+        self._rho_aa_linear = 2 * self.eps_wrt_d * ( 1 - 2 * self.beta_p**2 )
+        # Numerator of the arctan of the energy integrand
+        self._arctan_numerator = -1 * self.Delta
+        # The states below the Fermi level
+        self._index_fermi_energy = np.searchsorted(self.eps, self.fermi_energy, side='left')
+
+        self._grid_parameters = ( self.beta_p, self.eps_d )
+
+    def _solve_spin(self, eps_sigma):
+        """Get the one electron energy and the occupancy of a single spin
+        with its level at eps_sigma."""
+        self.eps_sigma = eps_sigma
+        self.calculate_energies()
+        return self.DeltaE_1sigma, self.n_sigma
+
+    def _hartree_fock_residual(self, n_up) -> float:
+        """Residual of the Hartree-Fock conditions after going once around
+        the map n_up -> n_down -> n_up."""
+        n_down = self._solve_spin(self.eps_a + self.U * n_up)[1]
+        return self._solve_spin(self.eps_a + self.U * n_down)[1] - n_up
+
+    def _refine_self_consistency(self, n_up_guess) -> float:
+        """Find the root of the Hartree-Fock residual closest to the grid
+        estimate. The bracket starts one grid spacing around the estimate
+        and is widened until the residual changes sign; it always does on
+        [0, 1] as the occupancy is bounded by 0 and 1."""
+        spacing = 1.0 / ( self.grid_size - 1 )
+        while True:
+            lower = max(0.0, n_up_guess - spacing)
+            upper = min(1.0, n_up_guess + spacing)
+            residual_lower = self._hartree_fock_residual(lower)
+            residual_upper = self._hartree_fock_residual(upper)
+            if residual_lower * residual_upper <= 0:
+                break
+            if lower == 0.0 and upper == 1.0:
+                # The numerical occupancy strayed outside of [0, 1]; keep the grid estimate
+                return n_up_guess
+            spacing *= 2
+        if residual_lower == 0:
+            return lower
+        if residual_upper == 0:
+            return upper
+        # Only the self-consistent calculations need scipy.optimize
+        from scipy import optimize
+        return optimize.brentq(self._hartree_fock_residual, lower, upper, xtol=self.tolerance)
+
+
+    def calculate_energies(self):
+        """Calculate the 1e energies from the Newns-Anderson model."""
+
+        self.recorder.count('energy_evaluations', len(self.eps))
+        # Quantities on the grid only depend on eps_d and beta_p
+        if self._grid_parameters != ( self.beta_p, self.eps_d ):
+            self._setup_grid()
+        self.eps_sigma_wrt_d = self.eps_sigma - self.eps_d
+
         # ---------------- Adsorbate density of states ( in the units of 2 beta)
-        rho_aa_ = self.eps_wrt_d**2 * ( 1 - 4 * self.beta_p**2 )
-        rho_aa_ += - 2 * self.eps_wrt_d * self.eps_sigma_wrt_d * ( 1 - 2 * self.beta_p**2 )
-        rho_aa_ += 4 *self.beta_p**4 + self.eps_sigma_wrt_d**2
-        self.rho_aa = 2 * self.beta_p**2 * ( 1 - self.eps_wrt_d**2 )**0.5
-        self.rho_aa /= rho_aa_ 
-        self.rho_aa /= np.pi
-        self.rho_aa = np.nan_to_num(self.rho_aa)
+        denominator = self._denominator_buffer
+        np.multiply(self._rho_aa_linear, self.eps_sigma_wrt_d, out=denominator)
+        np.subtract(self._rho_aa_quadratic, denominator, out=denominator)
+        denominator += self.eps_sigma_wrt_d**2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            np.divide(self._rho_aa_numerator, denominator, out=self._rho_aa_buffer)
+        self.rho_aa = np.nan_to_num(self._rho_aa_buffer, copy=False)
 
         # ---------------- Check all the possible root combinations ----------------
         # Check if there is a virtual root
@@ -316,23 +374,26 @@ class NewnsAndersonAnalytical:
             upper_bound = self.fermi_energy
         else:
             upper_bound = self.upper_band_edge
-        occupied_states = [i for i in range(len(self.eps)) if self.lower_band_edge < self.eps[i] < upper_bound]
+        start = np.searchsorted(self.eps, self.lower_band_edge, side='right')
+        stop = np.searchsorted(self.eps, upper_bound, side='left')
+        stop = max(start, stop)
 
         # Determine the integrand 
-        energy_occ = self.eps_wrt_d[occupied_states]
-        numerator = - 2 * self.beta_p**2 * (1 - energy_occ**2)**0.5
-        numerator = np.nan_to_num(numerator)
-        denominator = energy_occ * (2*self.beta_p**2 - 1) + self.eps_sigma_wrt_d
+        energy_occ = self.eps_wrt_d[start:stop]
+        numerator = self._arctan_numerator[start:stop]
+        denominator = self._denominator_buffer[:stop-start]
+        np.multiply(energy_occ, 2*self.beta_p**2 - 1, out=denominator)
+        denominator += self.eps_sigma_wrt_d
 
         # This number will always be between [-pi, 0]
-        arctan_integrand = np.arctan2(numerator, denominator)
-        assert all(arctan_integrand < 0)
-        assert all(arctan_integrand > -np.pi)
+        arctan_integrand = np.arctan2(numerator, denominator, out=self._arctan_buffer[:stop-start])
+        assert np.all(arctan_integrand < 0)
+        assert np.all(arctan_integrand > -np.pi)
 
         if self.has_localised_occupied_state_positive and self.has_localised_occupied_state_negative:
             # Both positive and negative root are localised and occupied
             arctan_integrand += np.pi
-            self.arctan_component =  np.trapz( arctan_integrand, energy_occ )
+            self.arctan_component =  trapezoid( arctan_integrand, energy_occ )
             self.arctan_component /= np.pi
             self.energy = self.arctan_component
             self.energy += self.eps_l_sigma_pos 
@@ -340,26 +401,32 @@ class NewnsAndersonAnalytical:
         elif self.has_localised_occupied_state_positive:
             # Has only positive root and it is a localised occupied state 
             arctan_integrand += np.pi
-            self.arctan_component =  np.trapz( arctan_integrand, energy_occ )
+            self.arctan_component =  trapezoid( arctan_integrand, energy_occ )
             self.arctan_component /= np.pi
             self.energy = self.arctan_component
             self.energy += self.eps_l_sigma_pos
             self.energy -= self.fermi_energy
         elif self.has_localised_occupied_state_negative:
             # Has only negative root and it is a localised occupied state
-            self.arctan_component =  np.trapz( arctan_integrand, energy_occ )
+            self.arctan_component =  trapezoid( arctan_integrand, energy_occ )
             self.arctan_component /= np.pi
             self.energy = self.arctan_component
             self.energy -= self.eps_l_sigma_neg
             self.energy += self.upper_band_edge
         else:
             # Has no localised occupied states
-            self.arctan_component =  np.trapz( arctan_integrand, energy_occ )
+            self.arctan_component =  trapezoid( arctan_integrand, energy_occ )
             self.arctan_component /= np.pi
             self.energy = self.arctan_component
 
         # The one electron energy is just the difference of eigenvalues 
         self.DeltaE_1sigma = self.energy 
+
+        # Occupancy of the spin from the states within the band below the
+        # Fermi level and the localised states; this is the derivative of
+        # the one electron energy with respect to eps_sigma
+        self.n_sigma = trapezoid( self.rho_aa[:self._index_fermi_energy], self.eps[:self._index_fermi_energy] )
+        self.n_sigma += self.na_sigma_pos + self.na_sigma_neg
         # assert self.na_sigma_pos + self.na_sigma_neg <= 1.0
         # assert self.na_sigma_pos >= 0
         # assert self.na_sigma_neg >= 0
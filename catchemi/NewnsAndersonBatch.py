@@ -0,0 +1,223 @@
+"""Evaluate the Newns-Anderson model for many parameter sets at once."""
+
+import numpy as np
+from catchemi import NewnsAndersonNumerical
+from catchemi.NewnsAndersonNumerical import calculate_dband_filling, find_zeros_green_function
+from catchemi.NewnsAndersonQuadrature import get_quadrature_engine
+from catchemi.NewnsAndersonInstrumentation import instrumentation, timed_stage
+
+
+class NewnsAndersonBatch(NewnsAndersonNumerical):
+    """Perform the numerical Newns-Anderson model for arrays of parameters.
+
+    The parameters Vak, eps_a, eps_d and width can be any arrays that
+    broadcast against each other; they are stored as a struct of flat
+    column arrays so that the vectorized kernels of NewnsAndersonNumerical
+    broadcast them against the quadrature nodes. All integrals are done
+    with the fixed-node Gauss-Legendre panels of NewnsAndersonQuadrature
+    on segments that are split at the band edges and at the poles of the
+    Green's function, so that the whole batch is integrated in a handful
+    of NumPy passes.
+
+    n_panels: int
+        Number of Gauss-Legendre panels per segment.
+    """
+
+    # The parameters are broadcast and flattened when the batch is
+    # created, so they cannot be updated; a new batch is cheap to create
+    RESULT_DEPENDENCIES = {}
+
+    def __init__(self, Vak, eps_a, eps_d, width, eps,
+                 Delta0_mag=0.0, eps_sp_max=15, eps_sp_min=-15,
+                 precision=50, verbose=False, spin=2,
+                 n_panels=8):
+        super().__init__(Vak, eps_a, eps_d, width,
+                         eps, Delta0_mag, eps_sp_max,
+                         eps_sp_min, precision, verbose, spin,
+                         'gauss_legendre', n_panels)
+
+    def __post_init__(self):
+        """Broadcast the parameters against each other and store
+        them as columns, one row per parameter set."""
+        Vak, eps_a, eps_d, width = np.broadcast_arrays(
+            *[ np.asarray(x, dtype=float) for x in ( self.Vak, self.eps_a, self.eps_d, self.width ) ])
+        self.shape = Vak.shape
+        self.Vak = Vak.reshape(-1, 1)
+        self.eps_a = eps_a.reshape(-1, 1)
+        self.eps_d = eps_d.reshape(-1, 1)
+        self.width = width.reshape(-1, 1)
+        self.wd = self.width
+
+        self.eps = np.array(self.eps)
+        self.eps_min = np.min(self.eps)
+        self.eps_max = np.max(self.eps)
+        self.recorder = instrumentation.get_recorder(self)
+
+        if self.verbose:
+            print(f'Solving the Newns-Anderson model for {self.Vak.size} parameter sets')
+
+        # The node layout is shared by every parameter set and segment
+        self.engine = get_quadrature_engine(self.n_panels)
+
+        self.hybridisation_energy = None
+        self.occupancy = None
+        self.filling = None
+        self.calctype = 'float'
+
+    def _reshape_output(self, quantity) -> np.ndarray:
+        """Reshape a column of results to the broadcast shape of the inputs."""
+        return np.reshape(quantity, self.shape)
+
+    def get_hybridisation_energy(self) -> np.ndarray:
+        """Get the hybridisation energy for every parameter set."""
+        if self.hybridisation_energy is None:
+            self.calculate_hybridisation_energy()
+        return self._reshape_output(self.hybridisation_energy)
+
+    def get_occupancy(self) -> np.ndarray:
+        """Get the occupancy of the single particle state for every parameter set."""
+        if self.occupancy is None:
+            self.calculate_occupancy()
+        return self._reshape_output(self.occupancy)
+
+    @timed_stage('filling')
+    def get_dband_filling(self) -> np.ndarray:
+        """Get the filling of the d-band for every parameter set."""
+        if self.filling is None:
+            self._calculate_filling()
+        return self._reshape_output(self.filling)
+
+    @timed_stage('poles')
+    def find_poles_green_function(self) -> np.ndarray:
+        """Find the poles of the green function for all parameter sets.
+        As in NewnsAndersonNumerical there are three regions, below, inside
+        and above the d-band; the returned array has one column per region
+        and is nan where that region has no pole."""
+        self.poles = find_zeros_green_function(self._create_pole_function,
+                                               self.eps_min, self.eps_max,
+                                               self.eps_d[:, 0] - self.wd[:, 0],
+                                               self.eps_d[:, 0] + self.wd[:, 0])
+        return self.poles
+
+    def _get_breakpoints(self, lower_bound, upper_bound, poles=None) -> np.ndarray:
+        """Breakpoints at the band edges and the poles for every parameter set."""
+        if poles is None:
+            if not hasattr(self, 'poles'):
+                self.find_poles_green_function()
+            poles = self.poles
+        return super()._get_breakpoints(lower_bound, upper_bound, poles)
+
+    @timed_stage('energy')
+    def calculate_hybridisation_energy(self):
+        """Calculate the hybridisation energy for all parameter sets."""
+        breakpoints = self._get_breakpoints(self.eps_min, 0.0)
+        delta_E_, error = self.engine.integrate(self.recorder.counted('energy', self._create_energy_integrand_vec),
+                                                breakpoints)
+        self.hybridisation_energy_error = error * self.spin / np.pi
+
+        hybridisation_energy = delta_E_ * self.spin / np.pi
+        hybridisation_energy -= self.spin * self.eps_a[:, 0]
+
+        # Same treatment of the numerical noise as for a single parameter set
+        numerical_noise = ( hybridisation_energy > 0 ) \
+                        & ( hybridisation_energy < self.NUMERICAL_NOISE_THRESHOLD )
+        self.hybridisation_energy = np.where(numerical_noise, 0.0, hybridisation_energy)
+
+    @timed_stage('occupancy')
+    def calculate_occupancy(self):
+        """Calculate the occupancy of the single particle state for all parameter sets."""
+        if self.Delta0_mag == 0:
+            if not hasattr(self, 'poles'):
+                self.find_poles_green_function()
+            # Localised states are the poles outside the d-band and
+            # below the Fermi level; each contributes its residue
+            is_localised = np.isfinite(self.poles) & ( self.poles < 0 ) \
+                         & ( np.abs(self.create_reference_eps(self.poles)) > 1 )
+            poles = np.where(is_localised, self.poles, self.eps_d + 2 * self.wd)
+            residue = 1 / ( 1 - self._create_Lambda_prime_vec(poles) )
+            localised_occupancy = np.sum(np.where(is_localised, residue, 0.0), axis=-1)
+
+            # The states within the d-band are integrated
+            lower_integration_bound = np.minimum(0.0, self.eps_d - self.wd)
+            upper_integration_bound = np.minimum(0.0, self.eps_d + self.wd)
+            breakpoints = self._get_breakpoints(lower_integration_bound, upper_integration_bound)
+            self.occupancy, self.occupancy_error = self.engine.integrate(self.recorder.counted('occupancy', self._create_dos_vec),
+                                                                           breakpoints)
+            self.occupancy += localised_occupancy
+        else:
+            breakpoints = self._get_breakpoints(self.eps_min, 0.0)
+            self.occupancy, self.occupancy_error = self.engine.integrate(self.recorder.counted('occupancy', self._create_dos_vec),
+                                                                           breakpoints)
+
+    def _calculate_filling(self) -> np.ndarray:
+        """Calculate the filling from the metal density of states in closed form."""
+        self.filling = calculate_dband_filling(self.eps_d[:, 0], self.wd[:, 0], self.Vak[:, 0],
+                                               self.Delta0_mag, self.eps_sp_min, self.eps_sp_max,
+                                               self.eps_min, self.eps_max)
+        return self.filling
+
+
+class NewnsAndersonLinearRepulsionBatch(NewnsAndersonBatch):
+    """Batched counterpart of NewnsAndersonLinearRepulsion. All of
+    Vsd, eps_a, eps_d, width, alpha, beta and constant_offset can be
+    arrays that broadcast against each other."""
+
+    def __init__(self, Vsd, eps_a, eps_d, width, eps,
+                 Delta0_mag=0.0, eps_sp_max=15, eps_sp_min=-15,
+                 precision=50, verbose=False,
+                 alpha=0.0, beta=0.0, constant_offset=0.0, spin=2,
+                 add_largeS_contribution=False, n_panels=8):
+        Vsd, eps_a, eps_d, width, alpha, beta, constant_offset = np.broadcast_arrays(
+            *[ np.asarray(x, dtype=float) for x in ( Vsd, eps_a, eps_d, width, alpha, beta, constant_offset ) ])
+        assert np.all(alpha >= 0.0), "alpha must be positive."
+        assert np.all(beta >= 0.0), "beta must be positive."
+        Vak = np.sqrt(beta) * Vsd
+        super().__init__(Vak, eps_a, eps_d, width,
+                         eps, Delta0_mag, eps_sp_max,
+                         eps_sp_min, precision, verbose, spin,
+                         n_panels)
+        self.alpha = alpha.reshape(-1, 1)
+        self.beta = beta.reshape(-1, 1)
+        self.constant_offset = constant_offset.reshape(-1, 1)
+        self.add_largeS_contribution = add_largeS_contribution
+
+        self.chemisorption_energy = None
+        self.orthogonalisation_energy = None
+
+    def get_chemisorption_energy(self) -> np.ndarray:
+        """Get the chemisorption energy for every parameter set."""
+        if self.chemisorption_energy is None:
+            self.compute_chemisorption_energy()
+        return self._reshape_output(self.chemisorption_energy)
+
+    def get_orthogonalisation_energy(self) -> np.ndarray:
+        """Get the orthogonalisation energy for every parameter set."""
+        if self.orthogonalisation_energy is None:
+            self.compute_chemisorption_energy()
+        return self._reshape_output(self.orthogonalisation_energy)
+
+    @timed_stage('chemisorption')
+    def compute_chemisorption_energy(self):
+        """Compute the chemisorption energy as the sum of the hybridisation
+        energy, the linear orthogonalisation energy and the offset."""
+        self.get_hybridisation_energy()
+        self.get_occupancy()
+        self.get_dband_filling()
+
+        Vak = self.Vak[:, 0]
+        alpha = self.alpha[:, 0]
+        eps_a = self.eps_a[:, 0]
+        eps_d = self.eps_d[:, 0]
+
+        orthogonalisation_energy = -1 * alpha * Vak**2
+        if self.add_largeS_contribution:
+            largeS_cont1 = ( eps_a - eps_d )**2
+            largeS_cont1 += 4 * alpha * Vak**2 * ( eps_a + eps_d )
+            largeS_cont1 += 4 * Vak**2
+            largeS_cont2 = ( eps_a - eps_d )**2 + 4 * Vak**2
+            orthogonalisation_energy += 0.5 * ( np.sqrt(largeS_cont1) - np.sqrt(largeS_cont2) )
+        orthogonalisation_energy *= -1 * self.spin * ( self.occupancy + self.filling )
+        self.orthogonalisation_energy = orthogonalisation_energy
+
+        self.chemisorption_energy = self.hybridisation_energy + self.orthogonalisation_energy
+        self.chemisorption_energy += self.constant_offset[:, 0]
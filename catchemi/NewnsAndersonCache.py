@@ -0,0 +1,105 @@
+"""Process-wide memoization of the quantities of the Newns-Anderson model."""
+
+from collections import OrderedDict
+import threading
+
+
+class ModelCache:
+    """Least-recently-used cache for model evaluations keyed on the
+    physical parameters. Fits perturb one parameter at a time, so most
+    evaluations repeat a parameter set that has been seen before.
+
+    maxsize: int
+        Maximum number of entries; the least recently used entry
+        is evicted once the cache is full.
+    decimals: int
+        Number of decimals to which the parameters are rounded
+        to form the key.
+    enabled: bool
+        If False, nothing is stored and every lookup misses.
+    """
+
+    def __init__(self, maxsize=100000, decimals=10, enabled=True):
+        self.maxsize = maxsize
+        self.decimals = decimals
+        self.enabled = enabled
+        self._entries = OrderedDict()
+        # Models may be evaluated from several threads
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def configure(self, maxsize=None, decimals=None, enabled=None):
+        """Change the settings of the cache; changing the rounding
+        clears the cache as the old keys no longer apply."""
+        with self._lock:
+            if maxsize is not None:
+                self.maxsize = maxsize
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+            if decimals is not None and decimals != self.decimals:
+                self.decimals = decimals
+                self._entries.clear()
+            if enabled is not None:
+                self.enabled = enabled
+
+    def make_key(self, *parameters) -> tuple:
+        """Create a key from names and numbers, rounding the numbers.
+        Multiprecision numbers are rounded through their real part."""
+        key = []
+        for parameter in parameters:
+            if isinstance(parameter, str) or parameter is None:
+                key.append(parameter)
+            else:
+                key.append(round(float(parameter.real), self.decimals))
+        return tuple(key)
+
+    def get(self, key):
+        """Get the value stored for key, None if it is not stored."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        """Store a value for key, evicting the least recently used entry if needed."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """Remove all entries and reset the statistics."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def get_statistics(self) -> dict:
+        """Get the hit and miss statistics of the cache."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+
+# The cache shared by all the models in the process
+model_cache = ModelCache()
@@ -1,13 +1,46 @@
 """Compute the derivatives of the Newns-Anderson model."""
 
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-from flint import acb, arb, ctx
-from scipy import integrate
+from flint import acb, arb
 from catchemi import ( NewnsAndersonLinearRepulsion,
                        NewnsAndersonNumerical )
+from catchemi.NewnsAndersonNumerical import ( find_zeros_green_function, precision_context,
+                                              ADAPTIVE_TOLERANCE, MAX_DERIVATIVE_PANELS,
+                                              POLE_TOLERANCE )
+from catchemi.NewnsAndersonQuadrature import get_quadrature_engine
+from catchemi.NewnsAndersonInstrumentation import timed_stage
 from typing import Callable
 
 
+def _evaluate_hybridisation_energy_epsd(derivative_class, diff_grid) -> tuple:
+    """Evaluate the hybridisation energy and its derivative on part of
+    the grid in a worker process."""
+    derivative_class.diff_grid = diff_grid
+    return derivative_class.get_hybridisation_energy_and_prime_epsd()
+
+
+def _calculate_hybridisation_energy_epsd(derivative_class, diff_grid) -> np.ndarray:
+    """Calculate the hybridisation energy with calculate_hybridisation_energy
+    for one d-band centre of the grid at a time, in a worker process or in
+    this one. The parameters of the single d-band centre are restored."""
+    derivative_class._convert_to_float()
+    state = { name: getattr(derivative_class, name, None)
+              for name in ['eps_d', 'Vak', 'Vak_p', 'wd', 'wd_p', 'hybridisation_energy'] }
+    hybridisation_energy = np.zeros(len(diff_grid))
+    try:
+        for i, eps_d in enumerate(diff_grid):
+            derivative_class.eps_d = eps_d
+            # Regenerate Vak and wd
+            derivative_class._generate_current_Vak_wd()
+            derivative_class.calculate_hybridisation_energy()
+            hybridisation_energy[i] = derivative_class.hybridisation_energy
+    finally:
+        for name, value in state.items():
+            setattr(derivative_class, name, value)
+    return hybridisation_energy
+
+
 class NewnsAndersonDerivativeEpsd(NewnsAndersonNumerical):
     """Class for computing the derivate of quantities 
     from the Newns-Anderson model with respect to the
@@ -17,6 +50,10 @@ class NewnsAndersonDerivativeEpsd(NewnsAndersonNumerical):
     quantities on a grid. The latter option is useful for
     confirming that the derivative is computed as expected."""
 
+    # eps_d, Vak and wd are set anew for every point of the derivative,
+    # so none of the parameters can be updated
+    RESULT_DEPENDENCIES = {}
+
     def __init__(self, f_Vsd: Callable[[float], float],
                  f_Vsd_p: Callable[[float], float],
                  eps_a:float,
@@ -26,7 +63,7 @@ class NewnsAndersonDerivativeEpsd(NewnsAndersonNumerical):
                  eps_sp_max=15, eps_sp_min=-15,
                  precision=50, verbose=False,
                  alpha=0.0, beta=0.0, constant_offset=0.0,
-                 diff_grid=np.linspace(-4,-1), use_multiprec=False):
+                 diff_grid=None, use_multiprec=False):
         
         # Since we are taking the derivate with respece
         # to the d-band centre, we need to set the d-band
@@ -45,10 +82,10 @@ class NewnsAndersonDerivativeEpsd(NewnsAndersonNumerical):
         self.f_wd = f_wd
         self.f_wd_p = f_wd_p
 
-        # If the calculation needs to use multiprecision
+        # If the calculation needs to use multiprecision; the
+        # parameters stay floats and the integrands are evaluated
+        # with arb, giving the derivatives with error balls
         self.use_multiprec = use_multiprec
-        if self.use_multiprec:
-            raise NotImplementedError("Multiprecision not implemented yet.")
 
         # For this class, currently only Delta0 > 0 is supported
         if Delta0_mag <= 0.0:
@@ -64,52 +101,54 @@ class NewnsAndersonDerivativeEpsd(NewnsAndersonNumerical):
 
         # The grid on which the numerical derivative is computed
         # and the analytical derivative is reported
-        self.diff_grid = diff_grid
+        # The default grid is created for every object, so that
+        # objects never share a mutable grid
+        self.diff_grid = np.linspace(-4, -1) if diff_grid is None else diff_grid
     
     def get_Delta_prime_epsd(self, eps):
         """Get the derivative of Delta prime with epsd
         for the diff grid."""
-        if self.use_multiprec:
-            eps, = self._convert_to_acb(eps)
-        else:
-            eps, = self._convert_to_float(eps)
+        self._convert_to_float()
+        # The working precision only matters for multiprecision
+        with precision_context(self.precision):
+            if self.use_multiprec:
+                eps = acb(str(eps))
 
-        Delta_prime_epsd = np.zeros(len(self.diff_grid))
+            Delta_prime_epsd = np.zeros(len(self.diff_grid))
 
-        for i, eps_d in enumerate(self.diff_grid):
-            if self.use_multiprec:
-                self.eps_d = acb(str(eps_d))
-                Delta_prime_epsd[i] = self._calculate_Delta_prime_epsd(eps).real
-            else:
+            for i, eps_d in enumerate(self.diff_grid):
                 self.eps_d = eps_d
                 # Generate the current Vak and wd
                 self._generate_current_Vak_wd()
 
-                Delta_prime_epsd[i] = self._calculate_Delta_prime_epsd_reg(eps)
+                if self.use_multiprec:
+                    Delta_prime_epsd[i] = self._calculate_Delta_prime_epsd(eps).real
+                else:
+                    Delta_prime_epsd[i] = self._calculate_Delta_prime_epsd_reg(eps)
+
+            return Delta_prime_epsd
 
-        return Delta_prime_epsd
-    
     def get_Lambda_prime_epsd(self, eps):
         """Get the derivative of Lambda with respect to epsd
         for the diff grid."""
-        if self.use_multiprec:
-            eps, = self._convert_to_acb(eps)
-        else:
-            eps, = self._convert_to_float(eps)
-        Lambda_prime_epsd = np.zeros(len(self.diff_grid))
-
-        for i, eps_d in enumerate(self.diff_grid):
+        self._convert_to_float()
+        # The working precision only matters for multiprecision
+        with precision_context(self.precision):
             if self.use_multiprec:
-                self.eps_d = acb(str(eps_d))
-                Lambda_prime_epsd[i] = self._calculate_Lambda_prime_epsd(eps).real
-            else:
+                eps = acb(str(eps))
+            Lambda_prime_epsd = np.zeros(len(self.diff_grid))
+
+            for i, eps_d in enumerate(self.diff_grid):
                 self.eps_d = eps_d
                 # Generate the current Vak and wd
                 self._generate_current_Vak_wd()
 
-                Lambda_prime_epsd[i] = self._calculate_Lambda_prime_epsd_reg(eps)
-        return Lambda_prime_epsd
-        
+                if self.use_multiprec:
+                    Lambda_prime_epsd[i] = self._calculate_Lambda_prime_epsd(eps).real
+                else:
+                    Lambda_prime_epsd[i] = self._calculate_Lambda_prime_epsd_reg(eps)
+            return Lambda_prime_epsd
+
     def _calculate_Delta_prime_epsd(self, eps: acb) -> acb:
         """Compute the derivative of Delta with respect to 
         the d-band centre. This calculation will require
@@ -118,16 +157,22 @@ class NewnsAndersonDerivativeEpsd(NewnsAndersonNumerical):
         eps_r = self.create_reference_eps(eps)
         if acb.abs_upper(eps_r) < arb('1.0'):
             # Within the d-band
-            Delta_prime_epsd = acb('2.0') * acb.pow (self.Vak / self.wd, acb('2.0')) 
-            Delta_prime_epsd *= eps_r 
-            Delta_prime_epsd *= acb.pow(acb('1.0') - acb.pow(eps_r, acb('2.0')), acb('-0.5'))
+            root = acb.sqrt(acb('1.0') - acb.pow(eps_r, acb('2.0')))
+            Delta_prime_epsd_1 = acb('2.0') * self.Vak**2 / self.wd / root * eps_r
+            Delta_prime_epsd_1 *= ( 1 / self.wd + self.wd_p / self.wd * eps_r )
+            Delta_prime_epsd_2 = acb('2.0') * root
+            Delta_prime_epsd_2 *= ( 2 * self.Vak * self.Vak_p / self.wd - self.wd_p * self.Vak**2 / self.wd**2 )
+            Delta_prime_epsd = Delta_prime_epsd_1 + Delta_prime_epsd_2
         else:
             Delta_prime_epsd = acb('0.0')
         return Delta_prime_epsd
 
     def _generate_current_Vak_wd(self):
         """Utility to generate the current Vak and wd
-        based on the value of eps_d stored in self.eps_d."""
+        based on the value of eps_d stored in self.eps_d.
+        The functions are called once per eps_d with a float,
+        also for multiprecision calculations."""
+        self.eps_d = float(self.eps_d.real)
         Vak = np.sqrt(self.beta) * self.f_Vsd(self.eps_d)
         Vak_p = np.sqrt(self.beta) * self.f_Vsd_p(self.eps_d)
         wd = self.f_wd(self.eps_d)
@@ -165,6 +210,21 @@ class NewnsAndersonDerivativeEpsd(NewnsAndersonNumerical):
 
         return Delta_prime_epsd
     
+    def _calculate_Delta_prime_epsd_vec(self, eps) -> np.ndarray:
+        """Compute the derivative of Delta with respect to the
+        d-band centre on an array of energies; Vak, Vak_p, wd and
+        wd_p may be columns with one row per d-band centre."""
+        eps_r = self.create_reference_eps(eps)
+        in_band = np.abs(eps_r) < 1.0
+        # Guard the square root, the mask zeroes the rest
+        root = np.sqrt(np.where(in_band, 1.0 - eps_r**2, 1.0))
+
+        Delta_prime_epsd_1 = 2.0 * self.Vak**2 / self.wd / root * eps_r
+        Delta_prime_epsd_1 *= ( 1 / self.wd + self.wd_p / self.wd * eps_r )
+        Delta_prime_epsd_2 = 2 * root
+        Delta_prime_epsd_2 *= ( 2 * self.Vak * self.Vak_p / self.wd - self.wd_p * self.Vak**2 / self.wd**2)
+        return np.where(in_band, Delta_prime_epsd_1 + Delta_prime_epsd_2, 0.0)
+
     def get_Delta_prime_epsd_numerical(self, eps):
         """Compute the derivate of Delta with respect to
         the d-band centre using numerical differentiation.
@@ -190,23 +250,25 @@ class NewnsAndersonDerivativeEpsd(NewnsAndersonNumerical):
         """Compute the derivative of Lambda with respect
         to the d-band centre."""
         eps_r = self.create_reference_eps(eps)
+        common = acb('2.0') * self.Vak * self.Vak_p - self.wd_p / self.wd * self.Vak**2
+        # Derivative of the term linear in eps_r
+        D1 = acb('2.0') * self.Vak**2 / self.wd**2 * ( -1 - self.wd_p * eps_r )
+        D1 += acb('2.0') * eps_r / self.wd * common
         if acb.abs_lower(eps_r) <= arb('1.0'):
             # Within the d-band
-            Lambda_prime = acb('-1.0')
-        elif eps_r.real < arb('-1.0'):
+            return D1
+        # Derivative of the square root outside of the d-band
+        root = acb.sqrt(acb.pow(eps_r, acb('2.0')) - acb('1.0'))
+        D2 = acb('2.0') * ( self.Vak / self.wd )**2 / root * eps_r * ( -1 - self.wd_p * eps_r )
+        D2 += acb('2.0') * root / self.wd * common
+        if eps_r.real < arb('-1.0'):
             # Outside the d-band and at lower energies
-            Lambda_prime = acb('-1.0')
-            Lambda_prime -= eps_r * acb.pow(acb.pow(eps_r, acb('2.0')) - acb('1.'), acb('-0.5')) 
+            return D1 + D2
         elif eps_r.real > arb('1.0'): 
             # Outside the d-band and at higher energies
-            Lambda_prime = acb('-1.0')
-            Lambda_prime += eps_r * acb.pow(acb.pow(eps_r, acb('2.0')) - acb('1.'), acb('-0.5'))
+            return D1 - D2
         else:
             raise ValueError('eps_r is not in the right range.')
-
-        prefactor = acb('2.0') * acb.pow(self.Vak / self.wd, acb('2.0'))
-        Lambda_prime_epsd = prefactor * Lambda_prime
-        return Lambda_prime_epsd
     
     def _calculate_Lambda_prime_epsd_reg(self, eps: float) -> float:
         """Compute the derivative of Lambda with respect
@@ -252,6 +314,24 @@ class NewnsAndersonDerivativeEpsd(NewnsAndersonNumerical):
         return Lambda_prime_epsd
 
 
+    def _calculate_Lambda_prime_epsd_vec(self, eps) -> np.ndarray:
+        """Compute the derivative of Lambda with respect to the
+        d-band centre on an array of energies, with the same
+        treatment of the parameters as _calculate_Delta_prime_epsd_vec."""
+        eps_r = self.create_reference_eps(eps)
+        outside = np.abs(eps_r) > 1.0
+        root = np.sqrt(np.where(outside, eps_r**2 - 1, 1.0))
+
+        # Derivative of the term linear in eps_r
+        D1 = 2.0 * self.Vak**2 / self.wd**2 * ( -1.0 - self.wd_p * eps_r )
+        D1 += 2.0 * eps_r / self.wd * ( 2.0 * self.Vak * self.Vak_p - self.wd_p / self.wd * self.Vak**2 )
+        # Derivative of the square root outside of the d-band
+        D2 = 2 * (self.Vak / self.wd)**2 / root * eps_r * (-1 - self.wd_p * eps_r)
+        D2 += 2 * root / self.wd * (2 * self.Vak * self.Vak_p - self.wd_p / self.wd * self.Vak**2)
+
+        Lambda_prime_epsd = np.where(eps_r < -1.0, D1 + D2, D1)
+        return np.where(eps_r > 1.0, D1 - D2, Lambda_prime_epsd)
+
     def get_Lambda_prime_epsd_numerical(self, eps):
         """Compute the derivative of Lambda with respect
         to the d-band centre."""
@@ -269,110 +349,272 @@ class NewnsAndersonDerivativeEpsd(NewnsAndersonNumerical):
         Lambda_prime_epsd_numerical = np.gradient(Lambda_values, self.diff_grid)
         return Lambda_prime_epsd_numerical
 
-    def _create_dEhyb_deps(self, eps):
-        """Create the integrand for the derivative of the
-        hybridisation energy with the d-band centre."""
-        # Derivative functions
-        Delta_prime = self._calculate_Delta_prime_epsd
-        Lambda_prime = self._calculate_Lambda_prime_epsd
-
-        # Functions from the Newns Anderson model
-        eps_function = self._create_adsorbate_line
-        Delta = self._create_Delta_arb
-        Delta0 = self._create_Delta0_arb
-        Lambda = self._create_Lambda_arb
-
-        # Create the integrand
-        integrand_numerator  = Delta_prime(eps) * ( eps_function(eps) - Lambda(eps) ) 
-        integrand_numerator += ( Delta0(eps) + Delta(eps) ) * Lambda_prime(eps)
-        integrand_denominator  = acb.pow( eps_function(eps) - Lambda(eps), acb('2.0') )
-        integrand_denominator += acb.pow( Delta(eps) + Delta0(eps), acb('2.0') ) 
-
-        return integrand_numerator / integrand_denominator
-
-    def _create_dEhyb_deps_reg(self, eps):
-        """Create the integrand for the derivative of the
-        hybridisation energy with the d-band centre. This
-        calculation does not require multiprecision."""
-        # Derivative functions
-        Delta_prime = self._calculate_Delta_prime_epsd_reg
-        Lambda_prime = self._calculate_Lambda_prime_epsd_reg
-
-        # Functions from the Newns Anderson model
-        eps_function = self._create_adsorbate_line
-        Delta = self._create_Delta_reg
-        Delta0 = self._create_Delta0_reg
-        Lambda = self._create_Lambda_reg
-
-        # Create the integrand
-        integrand_numerator  = Delta_prime(eps) * ( eps_function(eps) - Lambda(eps) ) 
-        integrand_numerator += ( Delta0(eps) + Delta(eps) ) * Lambda_prime(eps)
-        integrand_denominator  = ( eps_function(eps) - Lambda(eps) )**2
-        integrand_denominator += ( Delta(eps) + Delta0(eps) )**2 
-
-        assert integrand_denominator > 0.0
+    def _create_dEhyb_deps_vec(self, eps) -> np.ndarray:
+        """Create the integrand for the derivative of the hybridisation
+        energy with the d-band centre on an array of energies."""
+        Delta = self._create_Delta_vec(eps) + self._create_Delta0_vec(eps)
+        denominator = self._create_adsorbate_line(eps) - self._create_Lambda_vec(eps)
+        integrand_numerator = self._calculate_Delta_prime_epsd_vec(eps) * denominator
+        integrand_numerator += Delta * self._calculate_Lambda_prime_epsd_vec(eps)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            integrand = integrand_numerator / ( denominator**2 + Delta**2 )
+        # Where both Delta and its derivative vanish the arctan is constant
+        integrand = np.nan_to_num(integrand, nan=0.0, posinf=0.0, neginf=0.0)
+        return np.where(eps > 0, 0.0, integrand)
+
+    def _create_hybridisation_integrands_vec(self, eps) -> np.ndarray:
+        """Create the energy integrand and its derivative with the d-band
+        centre together. eps has two identical blocks of rows, one per 
+        integrand, and only the first block is evaluated."""
+        eps = eps[:len(eps)//2]
+        return np.concatenate([ self._create_energy_integrand_vec(eps),
+                                self._create_dEhyb_deps_vec(eps) ])
+
+    @timed_stage('derivatives')
+    def _calculate_hybridisation_energy_and_prime_epsd_vec(self) -> tuple:
+        """Integrate the hybridisation energy and its derivative for all the
+        d-band centres of the diff grid in one pass over the Gauss-Legendre
+        panels. The number of panels is doubled for the d-band centres whose
+        integrals have not converged to ADAPTIVE_TOLERANCE, up to 
+        MAX_DERIVATIVE_PANELS; the others are not integrated again."""
+        n_points = len(self.Vak)
+        with self.recorder.stage('poles'):
+            poles = find_zeros_green_function(self._create_pole_function, self.eps_min, self.eps_max,
+                                              self.eps_d[:, 0] - self.wd[:, 0], self.eps_d[:, 0] + self.wd[:, 0])
+        breakpoints = self._get_breakpoints(self.eps_min, 0.0, poles)
+
+        columns = { name: getattr(self, name) for name in ['eps_d', 'Vak', 'Vak_p', 'wd', 'wd_p'] }
+        integrals = np.zeros((2, n_points))
+        pending = np.arange(n_points)
+        n_panels = self.n_panels
+        try:
+            while len(pending) > 0:
+                # Only the parameters of the pending d-band centres are integrated
+                for name, column in columns.items():
+                    setattr(self, name, column[pending])
+                engine = get_quadrature_engine(n_panels)
+                values, error = engine.integrate(self.recorder.counted('derivative',
+                                                     self._create_hybridisation_integrands_vec),
+                                                 np.concatenate([ breakpoints[pending], breakpoints[pending] ]))
+                integrals[:, pending] = values.reshape(2, -1)
+                if n_panels >= MAX_DERIVATIVE_PANELS:
+                    break
+                converged = error <= ADAPTIVE_TOLERANCE * np.maximum(1.0, np.abs(values))
+                pending = pending[~np.all(converged.reshape(2, -1), axis=0)]
+                n_panels *= 2
+        finally:
+            for name, column in columns.items():
+                setattr(self, name, column)
+
+        hybridisation_energy = integrals[0] * self.spin / np.pi
+        hybridisation_energy -= self.spin * self.eps_a
+        # Same treatment of the numerical noise as for a single d-band centre
+        numerical_noise = ( hybridisation_energy > 0 ) \
+                        & ( hybridisation_energy < self.NUMERICAL_NOISE_THRESHOLD )
+        hybridisation_energy = np.where(numerical_noise, 0.0, hybridisation_energy)
+        hybridisation_energy_prime_epsd = integrals[1] * self.spin / np.pi
+
+        # Where Delta vanishes, the arctan jumps by pi at the zeros of
+        # eps - eps_a - Lambda, which move with the d-band centre
+        Delta = self._create_Delta_vec(poles) + self._create_Delta0_vec(poles)
+        jumps = np.isfinite(poles) & ( poles < 0 ) & ( Delta == 0 )
+        poles = np.where(jumps, poles, self.eps_min)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            pole_derivatives = self._calculate_Lambda_prime_epsd_vec(poles) \
+                             / ( 1 - self._create_Lambda_prime_vec(poles) )
+        hybridisation_energy_prime_epsd += self.spin * np.sum(np.where(jumps, pole_derivatives, 0.0), axis=-1)
+
+        return hybridisation_energy, hybridisation_energy_prime_epsd
+
+    def get_hybridisation_energy_and_prime_epsd(self, n_jobs=1) -> tuple:
+        """Calculate the hybridisation energy and its derivative with
+        respect to the d-band centre for every point of the diff grid.
+        The points are evaluated together as columns of parameters; with
+        n_jobs > 1 the grid is split over a pool of worker processes, which
+        requires f_Vsd, f_Vsd_p, f_wd and f_wd_p to be picklable."""
+        assert n_jobs >= 1, "n_jobs must be at least one."
+        diff_grid = np.asarray(self.diff_grid, dtype=float)
+
+        if n_jobs > 1 and len(diff_grid) > 1:
+            chunks = np.array_split(diff_grid, min(n_jobs, len(diff_grid)))
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                results = list(executor.map(_evaluate_hybridisation_energy_epsd,
+                                            [self] * len(chunks), chunks))
+            return tuple(np.concatenate(quantity) for quantity in zip(*results))
 
+        self._convert_to_float()
+        # Store the parameters of a single d-band centre, the 
+        # columns are only used for this calculation
+        state = { name: getattr(self, name, None) for name in ['eps_d', 'Vak', 'Vak_p', 'wd', 'wd_p'] }
+        try:
+            self.eps_d = diff_grid[:, np.newaxis]
+            Vak = np.array([ self.f_Vsd(eps_d) for eps_d in diff_grid ], dtype=float)
+            Vak_p = np.array([ self.f_Vsd_p(eps_d) for eps_d in diff_grid ], dtype=float)
+            wd = np.array([ self.f_wd(eps_d) for eps_d in diff_grid ], dtype=float)
+            wd_p = np.array([ self.f_wd_p(eps_d) for eps_d in diff_grid ], dtype=float)
+            assert np.all(Vak >= 0.0), 'Coupling element must be positive.'
+            assert np.all(wd >= 0.0), 'Width must be positive.'
+            self.Vak = np.sqrt(self.beta) * Vak[:, np.newaxis]
+            self.Vak_p = np.sqrt(self.beta) * Vak_p[:, np.newaxis]
+            self.wd = wd[:, np.newaxis]
+            self.wd_p = wd_p[:, np.newaxis]
+            return self._calculate_hybridisation_energy_and_prime_epsd_vec()
+        finally:
+            for name, value in state.items():
+                setattr(self, name, value)
+
+    def _create_dEhyb_deps_segment_arb(self, t, region, Delta0) -> acb:
+        """Create the integrand for the derivative of the hybridisation
+        energy with the d-band centre, times the Jacobian of the change of
+        variables eps_r = sin(t) within the d-band (region 0) and 
+        eps_r = -+cosh(t) below (-1) and above (+1) it. The square roots
+        of 1 - eps_r^2 and eps_r^2 - 1 become cos(t) and sinh(t), so that
+        the integrand is analytic and finite up to the band edges, where
+        the derivatives of Delta and Lambda diverge."""
+        Vak = acb(self.Vak); Vak_p = acb(self.Vak_p)
+        wd = acb(self.wd); wd_p = acb(self.wd_p)
+        common = 2 * Vak * Vak_p - wd_p / wd * Vak**2
+        if region == 0:
+            eps_r = acb.sin(t); root = acb.cos(t)
+            Delta = 2 * Vak**2 / wd * root + Delta0
+            Lambda = 2 * Vak**2 / wd * eps_r
+        else:
+            eps_r = region * acb.cosh(t); root = acb.sinh(t)
+            Delta = Delta0
+            Lambda = 2 * Vak**2 / wd * ( eps_r - region * root )
+        # d eps = wd cos(t) dt within the d-band and wd sinh(t) dt 
+        # outside of it, up to the orientation of the integral
+        jacobian = wd * root
+        eps_function = self.eps_d + wd * eps_r - self.eps_a
+
+        # Derivative of the term linear in eps_r, times the Jacobian
+        Lambda_prime_epsd = 2 * Vak**2 / wd**2 * ( -1 - wd_p * eps_r ) * jacobian
+        Lambda_prime_epsd += 2 * eps_r / wd * common * jacobian
+        if region == 0:
+            Delta_prime_epsd = 2 * Vak**2 / wd * eps_r * ( 1 + wd_p * eps_r )
+            Delta_prime_epsd += 2 * root**2 * common
+        else:
+            Delta_prime_epsd = acb('0.0')
+            # Derivative of the square root
+            D2 = 2 * Vak**2 / wd * eps_r * ( -1 - wd_p * eps_r )
+            D2 += 2 * root**2 * common
+            Lambda_prime_epsd -= region * D2
+
+        integrand_numerator = Delta_prime_epsd * ( eps_function - Lambda )
+        integrand_numerator += Delta * Lambda_prime_epsd
+        integrand_denominator = ( eps_function - Lambda )**2 + Delta**2
         return integrand_numerator / integrand_denominator
 
+    @timed_stage('derivatives')
     def _calculate_hybridisation_energy_prime_epsd(self):
         """Calculate the hybridisation energy derivative with eps_d
-        at a certain eps_d value."""
-
-        # Numerically integrate the dos to find the occupancy
-        if self.use_multiprec:
-            dhyb_depsd = acb.integral(lambda x, _: self._create_dEhyb_deps(x), 
-                                                self.eps_min, 
-                                                arb('0.0'), 
-                                                )
-            dhyb_depsd *= acb('2.0') / acb.pi()
-            return dhyb_depsd.real
-        else:
-            dhyb_depsd = integrate.quad(lambda x: self._create_dEhyb_deps_reg(x),
-                                                self.eps_min,
-                                                0.0, limit=100)[0]
-            dhyb_depsd *= 2.0 / np.pi
-            return dhyb_depsd
-    
-    def get_hybridisation_energy_prime_epsd(self):
+        at a certain eps_d value with arb; the double precision
+        derivative goes through get_hybridisation_energy_and_prime_epsd."""
+        with precision_context(self.precision):
+            return self._calculate_hybridisation_energy_prime_epsd_arb()
+
+    def _calculate_hybridisation_energy_prime_epsd_arb(self) -> arb:
+        """Calculate the hybridisation energy derivative with eps_d with arb.
+        The range is split at the band edges, the sp-band edges and the zeros
+        of eps - eps_a - Lambda; each segment is integrated in the variable
+        of _create_dEhyb_deps_segment_arb for its region. Segments outside of
+        both bands do not contribute, apart from the jumps of the arctan at
+        the zeros there, which are added from the double precision zeros.
+        The radius of the result bounds the arb integrals over the segments
+        between the double precision breakpoints; the jumps get a radius
+        estimated from the tolerance of the zeros and the rounding of the
+        double precision, which is not rigorous."""
+        zeros = self._find_zeros_green_function()
+        breakpoints = np.unique(self._get_breakpoints(self.eps_min, 0.0, zeros)[0])
+        tolerance = np.power(2, -self.precision/2)
+
+        dhyb_depsd = acb('0.0')
+        for lower, upper in zip(breakpoints[:-1], breakpoints[1:]):
+            middle = ( lower + upper ) / 2
+            Delta0 = self._create_Delta0_reg(middle)
+            # Bounds of the segment in units of the width, clipped
+            # to the region in case of rounding at the band edges
+            eps_r = [ ( x - self.eps_d ) / self.wd for x in ( lower, upper ) ]
+            region = int(np.sign(self.create_reference_eps(middle))) \
+                     if np.abs(self.create_reference_eps(middle)) > 1 else 0
+            if region == 0:
+                bounds = [ acb(str(np.clip(x, -1.0, 1.0))).asin() for x in eps_r ]
+            elif Delta0 == 0:
+                continue
+            else:
+                bounds = [ acb(str(max(region * x, 1.0))).acosh() for x in eps_r ]
+            self.recorder.count('arb_integrals')
+            integrand = lambda t, _: self._create_dEhyb_deps_segment_arb(t, region, Delta0)
+            integral = acb.integral(self.recorder.counted('derivative', integrand),
+                                    bounds[0], bounds[1], rel_tol=tolerance)
+            # Below the d-band eps decreases with t
+            dhyb_depsd += -integral if region == -1 else integral
+        dhyb_depsd *= self.spin / acb.pi()
+
+        # Contribution of the jumps of the arctan below the Fermi level
+        for zero in zeros[np.isfinite(zeros)]:
+            if zero < 0 and self._create_Delta_reg(zero) + self._create_Delta0_reg(zero) == 0:
+                pole_derivative = self._get_pole_derivative_epsd(zero)
+                # The zero is known to within POLE_TOLERANCE
+                radius = abs(self._get_pole_derivative_epsd(zero + POLE_TOLERANCE)
+                             - self._get_pole_derivative_epsd(zero - POLE_TOLERANCE)) / 2
+                radius += 8 * np.finfo(float).eps * abs(pole_derivative)
+                dhyb_depsd += self.spin * acb(arb(pole_derivative, radius))
+
+        return dhyb_depsd.real
+
+    def _get_pole_derivative_epsd(self, pole) -> float:
+        """Derivative with eps_d of a zero of eps - eps_a - Lambda, at
+        which the arctan jumps, in double precision."""
+        return float(self._calculate_Lambda_prime_epsd_reg(pole)
+                     / ( 1 - self._create_Lambda_prime_vec(pole) ))
+
+    def get_hybridisation_energy_prime_epsd(self, n_jobs=1):
         """Calculate the derivative of the hybridisation energy
-        as a function of the d-band centre. if the flag get_hyb 
-        is True, the hybridisation energy will also be returned."""
+        as a function of the d-band centre. In double precision
+        the whole diff grid is integrated at once; with multiprecision
+        the radii of the error balls are stored in 
+        hybridisation_energy_prime_epsd_error. The radii bound the
+        arb integrals, while the contributions of the localised states
+        below the Fermi level only add an estimate of their double
+        precision error."""
 
-        if self.use_multiprec:
-            self._convert_to_acb()
-        else:
-            self._convert_to_float()
+        if not self.use_multiprec:
+            return self.get_hybridisation_energy_and_prime_epsd(n_jobs)[1]
 
+        self._convert_to_float()
         hybridisation_energy_prime_epsd = np.zeros(len(self.diff_grid))
+        self.hybridisation_energy_prime_epsd_error = np.zeros(len(self.diff_grid))
 
         for i, eps_d in enumerate(self.diff_grid):
-            # Treat eps_d correctly based on the 
-            # chosen numerical routine
-            if self.use_multiprec:
-                self.eps_d = acb(str(eps_d))
-            else:
-                self.eps_d = eps_d
+            self.eps_d = eps_d
             # Regenerate Vak and wd
             self._generate_current_Vak_wd()
 
             dEhyb_depsd = self._calculate_hybridisation_energy_prime_epsd()
 
-            hybridisation_energy_prime_epsd[i] = dEhyb_depsd
+            hybridisation_energy_prime_epsd[i] = float(dEhyb_depsd.mid())
+            self.hybridisation_energy_prime_epsd_error[i] = float(dEhyb_depsd.rad())
 
         return hybridisation_energy_prime_epsd
 
-    def get_hybridisation_energy_prime_epsd_numerical(self, get_hyb=False):
+    def get_hybridisation_energy_prime_epsd_numerical(self, get_hyb=False, n_jobs=1):
         """Calculate the derivative of the hybridisation energy 
         as a function of the d-band centre, but using the
-        numerical differentiation grid."""
-        self._convert_to_float()
-        hybridisation_energy = np.zeros(len(self.diff_grid))
-        for i, eps_d in enumerate(self.diff_grid):
-            self.eps_d = eps_d
-            # Regenerate Vak and wd
-            self._generate_current_Vak_wd()
-            self.calculate_hybridisation_energy()
-            hybridisation_energy[i] = self.hybridisation_energy
+        numerical differentiation grid. The energies come from
+        calculate_hybridisation_energy with the quadrature of the
+        model, one d-band centre at a time, so that the check does
+        not share the integrals of the analytical derivative. With
+        n_jobs > 1 the grid is split over a pool of worker processes."""
+        assert n_jobs >= 1, "n_jobs must be at least one."
+        diff_grid = np.asarray(self.diff_grid, dtype=float)
+        if n_jobs > 1 and len(diff_grid) > 1:
+            chunks = np.array_split(diff_grid, min(n_jobs, len(diff_grid)))
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                hybridisation_energy = np.concatenate(list(executor.map(
+                    _calculate_hybridisation_energy_epsd, [self] * len(chunks), chunks)))
+        else:
+            hybridisation_energy = _calculate_hybridisation_energy_epsd(self, diff_grid)
 
         # Take the gradient of the hybridisation energy
         hybridisation_energy_prime_epsd_numerical = np.gradient(hybridisation_energy, self.diff_grid)
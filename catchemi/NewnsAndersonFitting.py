@@ -0,0 +1,268 @@
+"""Fit the parameters of several adsorbates on the same set of surfaces."""
+
+from concurrent.futures import ProcessPoolExecutor
+import time
+import numpy as np
+from scipy.optimize import least_squares
+from catchemi import FitParametersNewnsAnderson
+from catchemi.NewnsAndersonCache import model_cache
+
+# Parameters of every single particle state, in the order of FitParametersNewnsAnderson
+FIT_PARAMETERS = [ 'alpha', 'beta', 'constant_offset' ]
+# Starting point of a single particle state without an earlier solution
+DEFAULT_GUESS = { 'alpha': 0.01, 'beta': np.pi * 0.6, 'constant_offset': 0.1 }
+
+
+class FitAdsorbatesNewnsAnderson:
+    """Fit alpha, beta and the constant offset of several adsorbates to
+    DFT energies on a common set of surfaces with least squares, using the
+    analytic Jacobian of FitParametersNewnsAnderson. The d-band centres,
+    widths and coupling elements of the surfaces are given once, and all
+    the fits share one pool of worker processes. The models themselves
+    depend on eps_a, alpha and beta and are not shared; what the fits do
+    share through the model cache are the integrals of the d-band of each
+    surface, which do not depend on the adsorbate.
+
+    The adsorbates are fitted either in sequence, each fit starting from
+    the solution of the adsorbate fitted before with the closest eps_a, or
+    jointly as one least squares problem, in which some of the parameters
+    can be shared by all adsorbates. Solutions are kept between calls of
+    fit, so that a repeated fit starts from the last solution.
+
+    metals: list
+        Names of the surfaces.
+    eps_d: list
+        d-band centre of every surface.
+    width: list
+        Width of the d-states of every surface.
+    Vsd: list
+        Coupling element of every surface.
+    eps: list
+        The range of energy values on which the fitting is done.
+    n_jobs: int
+        Number of worker processes shared by all the fits.
+    verbose: bool
+        If True, a summary of every fit is printed.
+
+    Further keyword arguments (Delta0_mag, eps_sp_max, eps_sp_min,
+    type_repulsion, occupancy_engine, ...) are passed on to
+    FitParametersNewnsAnderson.
+    """
+
+    def __init__(self, metals, eps_d, width, Vsd, eps, n_jobs=1, verbose=False, **kwargs):
+        assert len(metals) == len(eps_d) == len(width) == len(Vsd), \
+            "metals, eps_d, width and Vsd must have the same length."
+        assert n_jobs >= 1, "n_jobs must be at least one."
+        self.metals = list(metals)
+        self.eps_d = np.asarray(eps_d, dtype=float)
+        self.width = np.asarray(width, dtype=float)
+        self.Vsd = np.asarray(Vsd, dtype=float)
+        self.eps = eps
+        self.n_jobs = n_jobs
+        self.verbose = verbose
+        self.fitting_kwargs = kwargs
+
+        # Data and solutions of the adsorbates, in the order they were added
+        self.adsorbates = {}
+        self.solutions = {}
+        self._executor = None
+
+    def add_adsorbate(self, name, eps_a, energies, no_of_bonds=None, initial_guess=None):
+        """Add an adsorbate with one or more single particle states eps_a.
+        energies and no_of_bonds are dicts keyed on the metals; surfaces
+        without an energy are left out of the fit of this adsorbate.
+        initial_guess is a dict of alpha, beta and constant_offset, each
+        a value or a list with one value per single particle state."""
+        eps_a = np.atleast_1d(eps_a).astype(float).tolist()
+        indices = [ i for i, metal in enumerate(self.metals) if metal in energies ]
+        assert len(indices) > 0, f"No energies of {name} on the surfaces."
+        unknown = set(energies) - set(self.metals)
+        assert not unknown, f"Unknown metals {sorted(unknown)} for {name}."
+        if no_of_bonds is None:
+            no_of_bonds = {}
+
+        if initial_guess is not None:
+            initial_guess = { key: np.broadcast_to(initial_guess[key], len(eps_a)).astype(float)
+                              for key in FIT_PARAMETERS }
+        self.adsorbates[name] = {
+            'eps_a': eps_a,
+            'indices': indices,
+            'energies': np.array([ energies[self.metals[i]] for i in indices ], dtype=float),
+            'no_of_bonds': [ no_of_bonds.get(self.metals[i], 1) for i in indices ],
+            'initial_guess': initial_guess,
+        }
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        """Get the pool of worker processes shared by the fits."""
+        if self._executor is None and self.n_jobs > 1:
+            self._executor = ProcessPoolExecutor(max_workers=self.n_jobs)
+        return self._executor
+
+    def close(self):
+        """Shut down the pool of worker processes, if one was started."""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def _get_fitting_function(self, name) -> FitParametersNewnsAnderson:
+        """FitParametersNewnsAnderson for the surfaces of an adsorbate."""
+        adsorbate = self.adsorbates[name]
+        indices = adsorbate['indices']
+        return FitParametersNewnsAnderson(
+            Vsd=self.Vsd[indices].tolist(),
+            width=self.width[indices].tolist(),
+            eps_a=adsorbate['eps_a'],
+            eps=self.eps,
+            no_of_bonds=adsorbate['no_of_bonds'],
+            n_jobs=self.n_jobs,
+            executor=self._get_executor(),
+            **self.fitting_kwargs)
+
+    def _get_initial_guess(self, name) -> np.ndarray:
+        """Starting point of the fit of an adsorbate, ordered as the arguments
+        of fit_parameters. Every single particle state starts from, in order
+        of preference, the guess given for the adsorbate, its last solution,
+        or the solution of the state with the closest eps_a fitted so far."""
+        adsorbate = self.adsorbates[name]
+        if adsorbate['initial_guess'] is not None:
+            guess = adsorbate['initial_guess']
+            return np.concatenate([ guess[key] for key in FIT_PARAMETERS ])
+        if name in self.solutions:
+            solution = self.solutions[name]
+            return np.concatenate([ solution[key] for key in FIT_PARAMETERS ])
+
+        # Solved single particle states of the other adsorbates
+        solved = [ ( eps_a, { key: solution[key][i] for key in FIT_PARAMETERS } )
+                   for solution in self.solutions.values()
+                   for i, eps_a in enumerate(solution['eps_a']) ]
+        guess = { key: [] for key in FIT_PARAMETERS }
+        for eps_a in adsorbate['eps_a']:
+            if solved:
+                closest = min(solved, key=lambda state: abs(state[0] - eps_a))[1]
+            else:
+                closest = DEFAULT_GUESS
+            for key in FIT_PARAMETERS:
+                guess[key].append(closest[key])
+        return np.concatenate([ guess[key] for key in FIT_PARAMETERS ])
+
+    def _store_solution(self, name, fitting_function, args, diagnostics):
+        """Store the fitted parameters, the fitted energies and the diagnostics."""
+        adsorbate = self.adsorbates[name]
+        alpha, beta, constant_offset = fitting_function._parse_parameters(args)
+        eps_ds = self.eps_d[adsorbate['indices']]
+        fitted_energies = fitting_function.fit_parameters(args, eps_ds)
+        residuals = fitted_energies - adsorbate['energies']
+        self.solutions[name] = {
+            'eps_a': adsorbate['eps_a'],
+            'alpha': np.array(alpha, dtype=float),
+            'beta': np.array(beta, dtype=float),
+            'constant_offset': np.array(constant_offset, dtype=float),
+            'metals': [ self.metals[i] for i in adsorbate['indices'] ],
+            'fitted_energies': fitted_energies,
+            'rmse': float(np.sqrt(np.mean(residuals**2))),
+            'diagnostics': diagnostics,
+        }
+        if self.verbose:
+            solution = self.solutions[name]
+            print(f'{name}: alpha {solution["alpha"]}, beta {solution["beta"]}, '
+                  f'constant offset {solution["constant_offset"]}, rmse {solution["rmse"]:1.3f} eV, '
+                  f'{diagnostics["function_evaluations"]} evaluations in {diagnostics["time"]:1.2f} s')
+
+    def fit(self, names=None, mode='sequential', shared=(), **kwargs) -> dict:
+        """Fit the adsorbates in names, by default all of them.
+
+        mode: str
+            'sequential' to fit the adsorbates one after the other, or
+            'joint' to fit them as a single least squares problem.
+        shared: list
+            For 'joint', the parameters among alpha, beta and
+            constant_offset that take one value for all single particle
+            states of all adsorbates.
+
+        Further keyword arguments are passed on to least_squares.
+        Returns the solutions of the adsorbates, with the fitted parameters,
+        energies, the root mean square error and the diagnostics of the fit:
+        its time, the number of evaluations of the energies, the Jacobian
+        and the models, and the hits and misses of the model cache of this
+        process during the fit. The hits include repeated evaluations of
+        the same model as well as the d-band integrals of the surfaces."""
+        assert mode in ['sequential', 'joint'], "mode must be 'sequential' or 'joint'."
+        assert set(shared) <= set(FIT_PARAMETERS), f"shared must be among {FIT_PARAMETERS}."
+        assert mode == 'joint' or not shared, "Parameters can only be shared in a joint fit."
+        if names is None:
+            names = list(self.adsorbates)
+        if mode == 'sequential':
+            for name in names:
+                self._fit_joint([ name ], (), **kwargs)
+        else:
+            self._fit_joint(names, shared, **kwargs)
+        return { name: self.solutions[name] for name in names }
+
+    def _fit_joint(self, names, shared, **kwargs):
+        """Fit the adsorbates in names as one least squares problem. The
+        parameters are collected in one vector in which the shared parameters
+        appear once; index maps every argument of fit_parameters of every
+        adsorbate to its position in that vector."""
+        fitting_functions = [ self._get_fitting_function(name) for name in names ]
+        guesses = [ self._get_initial_guess(name) for name in names ]
+
+        initial_guess = []
+        indices = []
+        shared_position = {}
+        for name, guess in zip(names, guesses):
+            n_states = len(self.adsorbates[name]['eps_a'])
+            index = []
+            for k, key in enumerate(FIT_PARAMETERS):
+                for j in range(n_states):
+                    if key in shared and key in shared_position:
+                        index.append(shared_position[key])
+                        continue
+                    if key in shared:
+                        shared_position[key] = len(initial_guess)
+                    index.append(len(initial_guess))
+                    initial_guess.append(guess[k * n_states + j])
+            indices.append(np.array(index))
+
+        eps_ds = [ self.eps_d[self.adsorbates[name]['indices']] for name in names ]
+        energies = [ self.adsorbates[name]['energies'] for name in names ]
+        counts = {'function_evaluations': 0, 'jacobian_evaluations': 0, 'model_evaluations': 0,
+                  'function_time': 0.0, 'jacobian_time': 0.0}
+
+        def residuals(x):
+            start = time.perf_counter()
+            residual = []
+            for fitting_function, index, eps_d, energy in zip(fitting_functions, indices, eps_ds, energies):
+                residual.append(fitting_function.fit_parameters(x[index], eps_d) - energy)
+                counts['model_evaluations'] += len(eps_d) * len(fitting_function.eps_a)
+            counts['function_evaluations'] += 1
+            counts['function_time'] += time.perf_counter() - start
+            return np.concatenate(residual)
+
+        def jacobian(x):
+            start = time.perf_counter()
+            jacobian = np.zeros((sum(len(eps_d) for eps_d in eps_ds), len(x)))
+            row = 0
+            for fitting_function, index, eps_d in zip(fitting_functions, indices, eps_ds):
+                # The shared parameters collect the derivatives of all their arguments
+                block = fitting_function.jacobian(x[index], eps_d).T
+                np.add.at(jacobian[row:row + len(eps_d)], ( slice(None), index ), block)
+                counts['model_evaluations'] += len(eps_d) * len(fitting_function.eps_a)
+                row += len(eps_d)
+            counts['jacobian_evaluations'] += 1
+            counts['jacobian_time'] += time.perf_counter() - start
+            return jacobian
+
+        cache_statistics = model_cache.get_statistics()
+        start = time.perf_counter()
+        kwargs.setdefault('x_scale', 'jac')
+        result = least_squares(residuals, np.array(initial_guess, dtype=float), jac=jacobian, **kwargs)
+        diagnostics = dict(counts, time=time.perf_counter() - start,
+                           adsorbates=list(names), success=bool(result.success),
+                           message=result.message, cost=float(result.cost))
+        # Hits in this process only; the workers have caches of their own
+        cache_statistics_end = model_cache.get_statistics()
+        diagnostics['cache_hits'] = cache_statistics_end['hits'] - cache_statistics['hits']
+        diagnostics['cache_misses'] = cache_statistics_end['misses'] - cache_statistics['misses']
+
+        for name, fitting_function, index in zip(names, fitting_functions, indices):
+            self._store_solution(name, fitting_function, result.x[index], diagnostics)
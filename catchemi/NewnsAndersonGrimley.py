@@ -3,6 +3,7 @@
 import numpy as np
 from flint import acb, arb
 from catchemi import NewnsAndersonNumerical
+from catchemi.NewnsAndersonNumerical import _calculate_dband_filling_cached
 
 class NewnsAndersonGrimleyNumerical(NewnsAndersonNumerical):
     """Perform the Newns-Anderson-Grimley model for 
@@ -11,20 +12,42 @@ class NewnsAndersonGrimleyNumerical(NewnsAndersonNumerical):
     to modify the Delta and Lambda terms of the Newns-Anderson
     model to those derived by Grimley.""" 
 
+    # The overlap enters Delta and Lambda, so every result depends on alpha
+    RESULT_DEPENDENCIES = { result: dependencies | { 'alpha' } for result, dependencies
+                            in NewnsAndersonNumerical.RESULT_DEPENDENCIES.items() }
+
     def __init__(self, Vak, eps_a, eps_d, width, eps, 
                  Delta0_mag=0.0, eps_sp_max=15, eps_sp_min=-15,
                  precision=50, verbose=False,
-                 alpha=0.0, spin=2):
+                 alpha=0.0, spin=2, quadrature='adaptive', n_panels=4,
+                 occupancy_engine='arb', occupancy_tolerance=1e-10,
+                 precision_policy='fixed', energy_tolerance=1e-8):
 
         # Initialise the quantities using the Newns-Anderson parameters
         # In this class we will replace how Delta and Lambda are determined
         # including the overlap elements.
         super().__init__(Vak, eps_a, eps_d, width, 
                          eps, Delta0_mag, eps_sp_max,
-                         eps_sp_min, precision, verbose, spin)
+                         eps_sp_min, precision, verbose, spin,
+                         quadrature, n_panels, occupancy_engine,
+                         occupancy_tolerance, precision_policy,
+                         energy_tolerance)
         self.alpha = alpha
 
-        print('Incorporating orthogonalisation using the Newns-Anderson-Grimley model.')
+        if self.verbose:
+            print('Incorporating orthogonalisation using the Newns-Anderson-Grimley model.')
+
+    def _calculate_filling(self) -> float:
+        """Calculate the filling from the Grimley-weighted density of states
+        in closed form; the weight ( Sak * eps - Vak )^2 is a polynomial
+        in eps, so the integrals remain elementary."""
+        self._convert_to_float()
+        self.Sak = -1 * self.alpha * self.Vak
+        self.filling = _calculate_dband_filling_cached(
+            float(self.eps_d), float(self.wd), float(self.Vak), float(self.Delta0_mag),
+            float(self.eps_sp_min), float(self.eps_sp_max),
+            float(self.eps_min), float(self.eps_max), float(self.Sak))
+        return self.filling
 
     def _create_Delta_arb(self, eps) -> acb:
         """Create a function for Delta based on arb.
@@ -77,8 +100,36 @@ class NewnsAndersonGrimleyNumerical(NewnsAndersonNumerical):
             Delta = 0.0 
         return Delta
 
+    def _create_coupling_vec(self, eps) -> np.ndarray:
+        """Create the coupling ( Sak * eps - Vak )^2 that replaces Vak^2
+        and makes the semi-elliptic shapes depend on the energy."""
+        self.Sak = -1 * self.alpha * self.Vak
+        eps = np.asarray(eps, dtype=float)
+        return ( self.Sak * eps - self.Vak )**2
+
+    def _create_coupling_arb(self, eps) -> acb:
+        """Create the coupling ( Sak * eps - Vak )^2 with arb."""
+        self.Sak = -1 * self.alpha * self.Vak
+        return ( self.Sak * eps - self.Vak )**2
+
+    def _create_coupling_derivative_vec(self, eps, parameter) -> np.ndarray:
+        """Create the derivative of the coupling with respect to parameter.
+        With Sak = -alpha Vak the coupling is Vak^2 ( 1 + alpha eps )^2, 
+        so it can be differentiated with respect to 'Vak2', 'alpha' or 'eps'."""
+        eps = np.asarray(eps, dtype=float)
+        if parameter == 'Vak2':
+            return ( 1 + self.alpha * eps )**2
+        elif parameter == 'alpha':
+            return 2 * self.Vak**2 * ( 1 + self.alpha * eps ) * eps
+        elif parameter == 'eps':
+            return 2 * self.Vak**2 * ( 1 + self.alpha * eps ) * self.alpha
+        else:
+            raise ValueError(f'Cannot differentiate the coupling with respect to {parameter}')
+
     def _create_Lambda_arb(self, eps) -> acb:
         """Create the hilbert transform of Delta with arb."""
+        self.Sak = -1 * self.alpha * self.Vak
+
         eps_ref = self.create_reference_eps(eps)
 
         if eps_ref.real < arb(-1): 
@@ -103,6 +154,8 @@ class NewnsAndersonGrimleyNumerical(NewnsAndersonNumerical):
 
     def _create_Lambda_reg(self, eps) -> float:
         """Create the hilbert transform of Delta for regular manipulations."""
+        self.Sak = -1 * self.alpha * self.Vak
+
         eps_ref = self.create_reference_eps(eps)
 
         if eps_ref < -1: 
@@ -123,4 +176,4 @@ class NewnsAndersonGrimleyNumerical(NewnsAndersonNumerical):
         Lambda *= (self.Sak * eps - self.Vak)**2 
         Lambda /= self.wd
         Lambda *= 2
-        return Lambda
\ No newline at end of file
+        return Lambda
@@ -1,22 +1,51 @@
 """Determine the elements of the Newns-Anderson-Grimley model."""
 import numpy as np
 from catchemi import NewnsAndersonGrimleyNumerical
+from catchemi.NewnsAndersonQuadrature import get_quadrature_engine
+from catchemi.NewnsAndersonInstrumentation import timed_stage
 
 class NewnsAndersonGrimleyRepulsion(NewnsAndersonGrimleyNumerical):
     """Class meant to enable fitting of parameters to the Newns-Anderson
     Grimley model of chemisorption. This class is meant to facilitate
     incorporating repulsive interations through the Newns-Anderson Grimley
-    model of chemisorption."""
+    model of chemisorption.
+
+    single_pass: bool
+        If True, the hybridisation energies with alpha and with
+        alpha = 0 are integrated together on the same Gauss-Legendre
+        nodes, instead of with two separate integrals. It only applies
+        with quadrature='gauss_legendre'; with the adaptive quadrature
+        the two energies are always integrated separately.
+    """
+
+    # Vak is sqrt(beta) Vsd and is updated through them. Once the
+    # chemisorption energy is computed, hybridisation_energy holds that
+    # without overlap, which compute_chemisorption_energy cannot reuse,
+    # so it is discarded along with the chemisorption energy
+    RESULT_DEPENDENCIES = { result: dependencies - { 'Vak' } | { 'Vsd', 'beta' } for result, dependencies
+                            in NewnsAndersonGrimleyNumerical.RESULT_DEPENDENCIES.items() }
+    RESULT_DEPENDENCIES['orthogonalisation_energy'] = set().union(*RESULT_DEPENDENCIES.values()) \
+                                                    | { 'single_pass' }
+    RESULT_DEPENDENCIES['chemisorption_energy'] = RESULT_DEPENDENCIES['orthogonalisation_energy'] \
+                                                | { 'constant_offset' }
+    RESULT_DEPENDENCIES['hybridisation_energy'] = RESULT_DEPENDENCIES['chemisorption_energy']
 
     def __init__(self, Vsd, eps_a, eps_d, width, eps, 
                  Delta0_mag=0.0, eps_sp_max=15, eps_sp_min=-15,
                  precision=50, verbose=False,
-                 alpha=0.0, beta=0.0, constant_offset=0, spin=2):
+                 alpha=0.0, beta=0.0, constant_offset=0, spin=2,
+                 quadrature='adaptive', n_panels=4,
+                 occupancy_engine='arb', occupancy_tolerance=1e-10,
+                 precision_policy='fixed', energy_tolerance=1e-8,
+                 single_pass=False):
         Vak = np.sqrt(beta) * Vsd
         super().__init__(Vak, eps_a, eps_d, width, 
                          eps, Delta0_mag, eps_sp_max,
                          eps_sp_min, precision, verbose,
-                         alpha, spin)
+                         alpha, spin, quadrature, n_panels,
+                         occupancy_engine, occupancy_tolerance,
+                         precision_policy, energy_tolerance)
+        self.Vsd = Vsd
         self.alpha = alpha
         # store the initial value of alpha fed in
         self.alpha_initial = alpha
@@ -24,6 +53,7 @@ class NewnsAndersonGrimleyRepulsion(NewnsAndersonGrimleyNumerical):
         assert self.alpha >= 0.0, "alpha must be positive."
         assert self.beta >= 0.0, "beta must be positive."
         self.constant_offset = constant_offset
+        self.single_pass = single_pass
 
         # The goal is to find the chemisorption energy
         self.chemisorption_energy = None
@@ -32,6 +62,17 @@ class NewnsAndersonGrimleyRepulsion(NewnsAndersonGrimleyNumerical):
         # Store the spin
         self.spin = spin
     
+    def _update_derived_parameters(self, changed):
+        """Set Vak from the updated Vsd and beta, and the alpha
+        to which the calculations return."""
+        super()._update_derived_parameters(changed)
+        assert self.alpha >= 0.0, "alpha must be positive."
+        assert self.beta >= 0.0, "beta must be positive."
+        if 'alpha' in changed:
+            self.alpha_initial = self.alpha
+        if changed & { 'Vsd', 'beta' }:
+            self.Vak = np.sqrt(self.beta) * self.Vsd
+
     def get_chemisorption_energy(self):
         """Utility function for returning 
         the chemisorption energy."""
@@ -40,7 +81,10 @@ class NewnsAndersonGrimleyRepulsion(NewnsAndersonGrimleyNumerical):
         if self.chemisorption_energy is not None:
             return self.chemisorption_energy
         else:
-            self.compute_chemisorption_energy()
+            # Reuse the results for the same parameters if they are cached
+            if not self._load_chemisorption_from_cache():
+                self.compute_chemisorption_energy()
+                self._store_chemisorption_in_cache()
             return float(self.chemisorption_energy)
     
     def get_orthogonalisation_energy(self):
@@ -54,37 +98,95 @@ class NewnsAndersonGrimleyRepulsion(NewnsAndersonGrimleyNumerical):
             self.compute_chemisorption_energy()
             return float(self.orthogonalisation_energy)
         
+    @timed_stage('chemisorption')
     def compute_chemisorption_energy(self):
         """Compute the chemisorption energy based on the 
         parameters of the class, a linear repulsion term
         and the hybridisation energy coming from the 
         Newns-Anderson model."""
 
-        self.get_hybridisation_energy()
         self.get_occupancy()
         self.get_dband_filling()
 
+        # Only the Gauss-Legendre panels can integrate both energies at once
+        if self.single_pass and self.quadrature == 'gauss_legendre':
+            hyb_energy_alpha, hyb_energy = self._calculate_hybridisation_energies_single_pass()
+        else:
+            hyb_energy_alpha = self.get_hybridisation_energy()
+            # To isolate the orthogonolsation energy, set alpha to 
+            # zero and determine the no-repulsion energy. It does not
+            # depend on alpha, so it is shared between the steps of a fit.
+            self.alpha = 0.0
+            self.hybridisation_energy = None
+            hyb_energy = self.get_hybridisation_energy()
+            self.alpha = self.alpha_initial
+
         # The hybridisation energy is the chemisorption energy
         # for the Newns-Anderson Grimley model because it includes overlap.
-        self.chemisorption_energy = self.hybridisation_energy
-
-        # To isolate the orthogonolsation energy, set alpha to 
-        # zero and determine the no-repulsion energy, then 
-        # subtract it from the chemisorption energy.
-        self.alpha = 0.0
-        self.calculate_hybridisation_energy()
-        self.orthogonalisation_energy =  self.chemisorption_energy - self.hybridisation_energy
-        print('Orthogonalisation energy is %1.2f'%self.orthogonalisation_energy)
+        self.chemisorption_energy = hyb_energy_alpha
+        # Subtract the no-repulsion energy from the chemisorption energy.
+        self.orthogonalisation_energy =  self.chemisorption_energy - hyb_energy
+        if self.verbose:
+            print('Orthogonalisation energy is %1.2f'%self.orthogonalisation_energy)
         assert self.orthogonalisation_energy >= 0.0, "Orthogonalisation energy must be positive."
-        # Store the hybridisation energy for no alpha
-        hyb_energy = self.hybridisation_energy
-
-        # Now run it with the initial alpha again
-        # just to get the same quantities as what was asked for
-        self.alpha = self.alpha_initial
-        self.calculate_hybridisation_energy()
-        # Replace the hybridisation energies with the alpha=0 value
+        # Report the hybridisation energy for no alpha
         self.hybridisation_energy = hyb_energy
 
         # Add the constant offset to the chemisorption energy
-        self.chemisorption_energy += self.constant_offset
\ No newline at end of file
+        self.chemisorption_energy += self.constant_offset
+
+    @timed_stage('energy')
+    def _calculate_hybridisation_energies_single_pass(self) -> tuple:
+        """Calculate the hybridisation energies with alpha and with
+        alpha = 0 in a single pass. The zeros of eps - eps_a - Lambda of
+        both are combined into one set of breakpoints, so that both
+        integrands are evaluated on the same nodes as the two rows of
+        one integral of the Gauss-Legendre panels."""
+        self._convert_to_float()
+
+        zeros = []
+        for alpha in [ self.alpha_initial, 0.0 ]:
+            self.alpha = alpha
+            zeros.append(self._find_zeros_green_function())
+        breakpoints = self._get_breakpoints(self.eps_min, 0.0, np.concatenate(zeros))
+        breakpoints = np.repeat(breakpoints, 2, axis=0)
+
+        # One row for each value of alpha
+        self.alpha = np.array([ [self.alpha_initial], [0.0] ])
+        engine = get_quadrature_engine(self.n_panels)
+        delta_E_, error = engine.integrate(self.recorder.counted('energy', self._create_energy_integrand_vec),
+                                           breakpoints)
+        self.alpha = self.alpha_initial
+        self.Sak = -1 * self.alpha * self.Vak
+
+        hybridisation_energies = delta_E_ * self.spin / np.pi
+        hybridisation_energies -= self.spin * self.eps_a
+        self.hybridisation_energy_error = error[0] * self.spin / np.pi
+
+        # Same treatment of the numerical noise as for a single integral
+        numerical_noise = ( hybridisation_energies > 0 ) \
+                        & ( hybridisation_energies < self.NUMERICAL_NOISE_THRESHOLD )
+        hybridisation_energies = np.where(numerical_noise, 0.0, hybridisation_energies)
+
+        return float(hybridisation_energies[0]), float(hybridisation_energies[1])
+
+    def get_chemisorption_energy_derivatives(self) -> dict:
+        """Get the derivatives of the chemisorption energy with respect
+        to alpha, beta and constant_offset. The chemisorption energy is the
+        hybridisation energy at finite overlap, in which alpha and beta enter
+        through the coupling Vak^2 ( 1 + alpha eps )^2 with Vak^2 = beta Vsd^2."""
+        self.get_chemisorption_energy()
+        self.alpha = self.alpha_initial
+        self._convert_to_float()
+
+        # The energies set to zero as numerical noise do not vary
+        if self.chemisorption_energy - self.constant_offset == 0:
+            derivative_alpha = 0.0
+            derivative_Vak2 = 0.0
+        else:
+            derivative_alpha = self.calculate_hybridisation_energy_derivative('alpha')
+            derivative_Vak2 = self.calculate_hybridisation_energy_derivative('Vak2')
+
+        return {'alpha': derivative_alpha,
+                'beta': derivative_Vak2 * self.Vsd**2,
+                'constant_offset': 1.0}
@@ -0,0 +1,206 @@
+"""Counters, stage timers and trace export for the Newns-Anderson models."""
+
+from collections import defaultdict
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+import warnings
+import numpy as np
+
+
+class Recorder:
+    """Counters and stage timings of a single model object. Every count
+    and timing is also added to the totals of the process-wide
+    instrumentation, and with tracing on every stage is stored as an
+    event of the trace.
+
+    The counts are keyed on the name of the integral, e.g. for 'energy'
+    there are energy_evaluations (points at which the integrand was
+    evaluated) and, for quad, energy_subdivisions; quad_integrals and
+    arb_integrals count the integrals done with quad and acb.integral.
+    The timings are inclusive, so the time of the poles is also part of
+    the time of the energy if they are found while integrating it.
+    """
+    enabled = True
+
+    def __init__(self, name):
+        self.name = name
+        self.counts = defaultdict(int)
+        self.timings = defaultdict(float)
+
+    def count(self, key, value=1):
+        """Add value to the counter key."""
+        self.counts[key] += value
+        instrumentation._add_count(key, value)
+
+    def counted(self, key, integrand):
+        """Wrap an integrand so that the energies it is evaluated at are
+        counted as key_evaluations. The integrand can be scalar, vectorized
+        or an arb integrand taking the analytic flag."""
+        def counted_integrand(eps, *args):
+            self.count(f'{key}_evaluations', np.size(eps) if isinstance(eps, np.ndarray) else 1)
+            return integrand(eps, *args)
+        return counted_integrand
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Time the enclosed code as the stage name."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            self.timings[name] += duration
+            instrumentation._add_stage(self.name, name, start, duration)
+
+    def quad(self, key, integrand, lower_bound, upper_bound, **kwargs) -> tuple:
+        """integrate.quad, counting the evaluations and subdivisions of
+        the integral key. Returns the integral and its error estimate;
+        a warning of quad is issued as it would be without counting."""
+        # Imported on the first integral, as scipy.integrate is slow to import
+        from scipy import integrate
+        result = integrate.quad(integrand, lower_bound, upper_bound, full_output=1, **kwargs)
+        integral, error, infodict = result[:3]
+        if len(result) > 3:
+            warnings.warn(result[3], integrate.IntegrationWarning, stacklevel=2)
+        self.count('quad_integrals')
+        self.count(f'{key}_evaluations', infodict['neval'])
+        self.count(f'{key}_subdivisions', infodict['last'])
+        return integral, error
+
+    def get_statistics(self) -> dict:
+        """Get the counts and the timings (in seconds) of the stages."""
+        return {'counts': dict(self.counts), 'timings': dict(self.timings)}
+
+
+class NullRecorder:
+    """Recorder used while the instrumentation is disabled; every method
+    does the least possible work so that models are not slowed down."""
+    enabled = False
+
+    def count(self, key, value=1):
+        pass
+
+    def counted(self, key, integrand):
+        return integrand
+
+    def stage(self, name):
+        return contextlib.nullcontext()
+
+    def quad(self, key, integrand, lower_bound, upper_bound, **kwargs) -> tuple:
+        from scipy import integrate
+        return integrate.quad(integrand, lower_bound, upper_bound, **kwargs)
+
+    def get_statistics(self) -> dict:
+        return {'counts': {}, 'timings': {}}
+
+
+# Shared by all the models created while the instrumentation is disabled
+NULL_RECORDER = NullRecorder()
+
+
+def timed_stage(name):
+    """Decorator timing a method of a model as the stage name of its recorder."""
+    def decorate(method):
+        @functools.wraps(method)
+        def timed_method(self, *args, **kwargs):
+            if not self.recorder.enabled:
+                return method(self, *args, **kwargs)
+            with self.recorder.stage(name):
+                return method(self, *args, **kwargs)
+        return timed_method
+    return decorate
+
+
+class Instrumentation:
+    """Process-wide switch for the counters and timers of the models.
+    The models get their recorder when they are created, so the
+    instrumentation has to be enabled before the models are created.
+    Models evaluated in worker processes record into the instrumentation
+    of those processes.
+
+    enabled: bool
+        If False, the models get a recorder that does nothing.
+    trace: bool
+        If True, every stage is stored as an event that can be written
+        out with export_trace, in the Chrome trace event format read by
+        chrome://tracing and Perfetto.
+    """
+
+    def __init__(self, enabled=False, trace=False):
+        self.enabled = enabled
+        self.trace = trace
+        # Models may be evaluated from several threads
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+        self.counts = defaultdict(int)
+        self.timings = defaultdict(float)
+        self.events = []
+        self.objects = 0
+
+    def configure(self, enabled=None, trace=None):
+        """Change the settings; tracing implies that the instrumentation is enabled."""
+        with self._lock:
+            if enabled is not None:
+                self.enabled = enabled
+            if trace is not None:
+                self.trace = trace
+                self.enabled = self.enabled or trace
+
+    def get_recorder(self, model):
+        """Get the recorder of a newly created model."""
+        if not self.enabled:
+            return NULL_RECORDER
+        with self._lock:
+            self.objects += 1
+            return Recorder(f'{type(model).__name__}#{self.objects}')
+
+    def _add_count(self, key, value):
+        with self._lock:
+            self.counts[key] += value
+
+    def _add_stage(self, name, stage, start, duration):
+        with self._lock:
+            self.timings[stage] += duration
+            if self.trace:
+                self.events.append({
+                    'name': stage,
+                    'cat': name.split('#')[0],
+                    'ph': 'X',
+                    'ts': ( start - self._origin ) * 1e6,
+                    'dur': duration * 1e6,
+                    'pid': os.getpid(),
+                    'tid': threading.get_ident(),
+                    'args': {'object': name},
+                })
+
+    def clear(self):
+        """Reset the totals and remove the events of the trace."""
+        with self._lock:
+            self.counts.clear()
+            self.timings.clear()
+            self.events = []
+            self.objects = 0
+
+    def get_statistics(self) -> dict:
+        """Get the counts and timings summed over all the recorders."""
+        with self._lock:
+            return {
+                'objects': self.objects,
+                'counts': dict(self.counts),
+                'timings': dict(self.timings),
+            }
+
+    def export_trace(self, filename):
+        """Write the events of the trace to filename as JSON."""
+        with self._lock:
+            events = list(self.events)
+        with open(filename, 'w') as handle:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, handle)
+
+
+# The instrumentation shared by all the models in the process
+instrumentation = Instrumentation()
@@ -2,7 +2,9 @@
 
 import numpy as np
 from catchemi import NewnsAndersonNumerical
-from flint import acb, arb, ctx
+from catchemi.NewnsAndersonNumerical import calculate_dband_filling_derivative, precision_context
+from catchemi.NewnsAndersonInstrumentation import timed_stage
+from flint import acb, arb
 
 class NewnsAndersonLinearRepulsion(NewnsAndersonNumerical):
     """Class that provides the Newns-Anderson hybridisation
@@ -10,15 +12,32 @@ class NewnsAndersonLinearRepulsion(NewnsAndersonNumerical):
     It subclasses NewnsAndersonNumerical for the Hybridisation
     energy and adds the orthogonalisation penalty separately."""
 
+    # Vak is sqrt(beta) Vsd and is updated through them; alpha only enters
+    # the orthogonalisation energy and the constant offset only the
+    # chemisorption energy
+    RESULT_DEPENDENCIES = { result: dependencies - { 'Vak' } | { 'Vsd', 'beta' } for result, dependencies
+                            in NewnsAndersonNumerical.RESULT_DEPENDENCIES.items() }
+    RESULT_DEPENDENCIES['orthogonalisation_energy'] = set().union(*RESULT_DEPENDENCIES.values()) \
+                                                    | { 'alpha', 'add_largeS_contribution' }
+    RESULT_DEPENDENCIES['chemisorption_energy'] = RESULT_DEPENDENCIES['orthogonalisation_energy'] \
+                                                | { 'constant_offset' }
+
     def __init__(self, Vsd, eps_a, eps_d, width, eps, 
                  Delta0_mag=0.0, eps_sp_max=15, eps_sp_min=-15,
                  precision=50, verbose=False,
                  alpha=0.0, beta=0.0, constant_offset=0.0, spin=2,
-                 add_largeS_contribution=False):
+                 add_largeS_contribution=False, quadrature='adaptive',
+                 n_panels=4, occupancy_engine='arb',
+                 occupancy_tolerance=1e-10, precision_policy='fixed',
+                 energy_tolerance=1e-8):
         Vak = np.sqrt(beta) * Vsd
         super().__init__(Vak, eps_a, eps_d, width, 
                          eps, Delta0_mag, eps_sp_max,
-                         eps_sp_min, precision, verbose, spin)
+                         eps_sp_min, precision, verbose, spin,
+                         quadrature, n_panels, occupancy_engine,
+                         occupancy_tolerance, precision_policy,
+                         energy_tolerance)
+        self.Vsd = Vsd
         self.alpha = alpha
         self.beta = beta
         assert self.alpha >= 0.0, "alpha must be positive."
@@ -34,6 +53,14 @@ class NewnsAndersonLinearRepulsion(NewnsAndersonNumerical):
         # If required, add the contribution for large S
         self.add_largeS_contribution = add_largeS_contribution
     
+    def _update_derived_parameters(self, changed):
+        """Set Vak from the updated Vsd and beta."""
+        super()._update_derived_parameters(changed)
+        assert self.alpha >= 0.0, "alpha must be positive."
+        assert self.beta >= 0.0, "beta must be positive."
+        if changed & { 'Vsd', 'beta' }:
+            self.Vak = np.sqrt(self.beta) * self.Vsd
+
     def get_chemisorption_energy(self):
         """Utility function for returning 
         the chemisorption energy."""
@@ -42,7 +69,10 @@ class NewnsAndersonLinearRepulsion(NewnsAndersonNumerical):
         if self.chemisorption_energy is not None:
             return float(self.chemisorption_energy.real)
         else:
-            self.compute_chemisorption_energy()
+            # Reuse the results for the same parameters if they are cached
+            if not self._load_chemisorption_from_cache():
+                self.compute_chemisorption_energy()
+                self._store_chemisorption_in_cache()
             return float(self.chemisorption_energy.real)
     
     def get_orthogonalisation_energy(self):
@@ -56,6 +86,7 @@ class NewnsAndersonLinearRepulsion(NewnsAndersonNumerical):
             self.compute_chemisorption_energy()
             return float(self.orthogonalisation_energy.real)
         
+    @timed_stage('chemisorption')
     def compute_chemisorption_energy(self):
         """Compute the chemisorption energy based on the 
         parameters of the class, a linear repulsion term
@@ -65,28 +96,75 @@ class NewnsAndersonLinearRepulsion(NewnsAndersonNumerical):
         self.get_hybridisation_energy()
         self.get_occupancy()
         self.get_dband_filling()
-        self._convert_to_acb()
+        with precision_context(self.precision):
+            self._convert_to_acb()
+
+            # orthonogonalisation energy
+            self.orthogonalisation_energy =  -1 * self.alpha * self.Vak**2
+            # Add large S contribution
+            if self.add_largeS_contribution:
+                largeS_cont1 = acb.pow(self.eps_a - self.eps_d, 2) 
+                largeS_cont1 += 4 * self.alpha * self.Vak**2 * (self.eps_a + self.eps_d) 
+                largeS_cont1 += 4 * self.Vak**2
+                largeS_cont1 = acb.pow(largeS_cont1, 0.5)
+                largeS_cont2 = acb.pow(self.eps_a - self.eps_d, 2)
+                largeS_cont2 += 4 * self.Vak**2
+                largeS_cont2 = acb.pow(largeS_cont2, 0.5)
+                self.orthogonalisation_energy +=  0.5 * (largeS_cont1 - largeS_cont2)
+                # assert largeS_cont1.real - largeS_cont2.real <= arb('0.0')
+            # Multiply by the pre-factor
+            self.orthogonalisation_energy *= -1 * self.spin * ( self.occupancy.real +  self.filling.real )
+
+            assert self.orthogonalisation_energy.real >= arb('0.0')
+
+            # chemisorption energy is the sum of the hybridisation
+            # and the orthogonalisation energy
+            self.chemisorption_energy = self.hybridisation_energy + self.orthogonalisation_energy 
+            # Add the constant offset which is helpful for fitting routines
+            self.chemisorption_energy += self.constant_offset
+
+    def get_chemisorption_energy_derivatives(self) -> dict:
+        """Get the derivatives of the chemisorption energy with respect
+        to alpha, beta and constant_offset. The orthogonalisation energy
+        is spin ( n_a + f ) ( alpha Vak^2 - largeS ), so alpha only enters
+        it explicitly, while beta enters the hybridisation energy, the
+        occupancy and the filling through Vak^2 = beta Vsd^2."""
+        self.get_chemisorption_energy()
+        self._convert_to_float()
+        Vak2 = self.Vak**2
+        occupancy = float(self.occupancy.real)
+        filling = float(self.filling.real)
+
+        # The energies set to zero as numerical noise do not vary
+        if self.hybridisation_energy == 0:
+            hybridisation_derivative = 0.0
+        else:
+            hybridisation_derivative = self.calculate_hybridisation_energy_derivative('Vak2')
+        occupancy_derivative = self.calculate_occupancy_derivative('Vak2')
+        filling_derivative = float(calculate_dband_filling_derivative(
+            self.eps_d, self.wd, self.Vak, float(self.Delta0_mag),
+            self.eps_sp_min, self.eps_sp_max, self.eps_min, self.eps_max))
 
-        # orthonogonalisation energy
-        self.orthogonalisation_energy =  -1 * self.alpha * self.Vak**2
-        # Add large S contribution
+        # The repulsion per electron and its derivatives
+        repulsion = self.alpha * Vak2
+        repulsion_alpha = Vak2
+        repulsion_Vak2 = self.alpha
         if self.add_largeS_contribution:
-            largeS_cont1 = acb.pow(self.eps_a - self.eps_d, 2) 
-            largeS_cont1 += 4 * self.alpha * self.Vak**2 * (self.eps_a + self.eps_d) 
-            largeS_cont1 += 4 * self.Vak**2
-            largeS_cont1 = acb.pow(largeS_cont1, 0.5)
-            largeS_cont2 = acb.pow(self.eps_a - self.eps_d, 2)
-            largeS_cont2 += 4 * self.Vak**2
-            largeS_cont2 = acb.pow(largeS_cont2, 0.5)
-            self.orthogonalisation_energy +=  0.5 * (largeS_cont1 - largeS_cont2)
-            # assert largeS_cont1.real - largeS_cont2.real <= arb('0.0')
-        # Multiply by the pre-factor
-        self.orthogonalisation_energy *= -1 * self.spin * ( self.occupancy.real +  self.filling.real )
+            largeS_cont1 = ( self.eps_a - self.eps_d )**2
+            largeS_cont1 += 4 * self.alpha * Vak2 * ( self.eps_a + self.eps_d )
+            largeS_cont1 += 4 * Vak2
+            largeS_cont1 = np.sqrt(largeS_cont1)
+            largeS_cont2 = np.sqrt(( self.eps_a - self.eps_d )**2 + 4 * Vak2)
+            repulsion -= 0.5 * ( largeS_cont1 - largeS_cont2 )
+            repulsion_alpha -= Vak2 * ( self.eps_a + self.eps_d ) / largeS_cont1
+            repulsion_Vak2 -= ( self.alpha * ( self.eps_a + self.eps_d ) + 1 ) / largeS_cont1
+            repulsion_Vak2 += 1 / largeS_cont2
 
-        assert self.orthogonalisation_energy.real >= arb('0.0')
+        derivative_alpha = self.spin * ( occupancy + filling ) * repulsion_alpha
+        derivative_Vak2 = hybridisation_derivative
+        derivative_Vak2 += self.spin * ( occupancy_derivative + filling_derivative ) * repulsion
+        derivative_Vak2 += self.spin * ( occupancy + filling ) * repulsion_Vak2
 
-        # chemisorption energy is the sum of the hybridisation
-        # and the orthogonalisation energy
-        self.chemisorption_energy = self.hybridisation_energy + self.orthogonalisation_energy 
-        # Add the constant offset which is helpful for fitting routines
-        self.chemisorption_energy += self.constant_offset
\ No newline at end of file
+        return {'alpha': derivative_alpha,
+                'beta': derivative_Vak2 * self.Vsd**2,
+                'constant_offset': 1.0}
@@ -1,15 +1,208 @@
 """ Perform the Newns-Anderson model calculations."""
 
+from contextlib import contextmanager
 from dataclasses import dataclass
+import threading
 import numpy as np
-from scipy import integrate
-from scipy import optimize
 from flint import acb, arb, ctx
+from catchemi.NewnsAndersonQuadrature import get_quadrature_engine
+from catchemi.NewnsAndersonCache import model_cache
+from catchemi.NewnsAndersonInstrumentation import instrumentation, timed_stage
+
+# Largest number of Gauss-Legendre panels per segment used to
+# converge the integrals of the derivatives to a tolerance
+MAX_DERIVATIVE_PANELS = 512
+# Default tolerance of quad, which the adaptive integrals use
+ADAPTIVE_TOLERANCE = 1.49e-8
+# Absolute tolerance and maximum number of iterations
+# with which the poles of the Green's function are located
+POLE_TOLERANCE = 2e-12
+POLE_ITERATIONS = 100
+# Largest precision in decimal digits to which an arb integral is
+# escalated under the 'escalate' precision policy
+MAX_ESCALATION_PRECISION = 800
+
+# Parameters of the model grouped by what they describe; every result
+# of a model depends on a combination of these, see RESULT_DEPENDENCIES
+ADSORBATE_PARAMETERS = frozenset([ 'eps_a' ])
+METAL_PARAMETERS = frozenset([ 'Vak', 'eps_d', 'width', 'Delta0_mag',
+                               'eps_sp_min', 'eps_sp_max', 'eps' ])
+INTEGRATION_SETTINGS = frozenset([ 'precision', 'quadrature', 'n_panels', 'occupancy_engine',
+                                   'occupancy_tolerance', 'precision_policy', 'energy_tolerance' ])
+
+# flint keeps a single working precision for the whole process,
+# so the arb computations of the models hold this lock while they run
+_PRECISION_LOCK = threading.RLock()
+
+
+@contextmanager
+def precision_context(precision):
+    """Run the enclosed arb computations with a working precision of
+    precision decimal digits, restoring the previous precision on exit.
+    The precision of flint is shared by all threads, so the contexts of
+    different threads are serialised; within a context the precision may
+    be changed further and contexts may be nested."""
+    with _PRECISION_LOCK:
+        previous_precision = ctx.dps
+        ctx.dps = precision
+        try:
+            yield
+        finally:
+            ctx.dps = previous_precision
+
+
+def _semi_ellipse_antiderivatives(x) -> tuple:
+    """Elementary antiderivatives of sqrt(1 - x^2), x sqrt(1 - x^2) and
+    x^2 sqrt(1 - x^2), with x clipped to the band [-1, 1]."""
+    x = np.clip(x, -1, 1)
+    root = np.sqrt(1 - x**2)
+    F0 = ( x * root + np.arcsin(x) ) / 2
+    F1 = - root**3 / 3
+    F2 = ( np.arcsin(x) - x * root * ( 1 - 2 * x**2 ) ) / 8
+    return F0, F1, F2
+
+
+def _integrate_semi_ellipse(x_lower, x_upper, A, B) -> np.ndarray:
+    """Integrate sqrt(1 - x^2) (A + B x)^2 between x_lower and x_upper,
+    both clipped to the band [-1, 1]."""
+    F0_u, F1_u, F2_u = _semi_ellipse_antiderivatives(x_upper)
+    F0_l, F1_l, F2_l = _semi_ellipse_antiderivatives(x_lower)
+    return A**2 * ( F0_u - F0_l ) + 2 * A * B * ( F1_u - F1_l ) + B**2 * ( F2_u - F2_l )
+
+
+def calculate_dband_filling(eps_d, wd, Vak, Delta0_mag, eps_sp_min, eps_sp_max, 
+                            eps_min, eps_max, Sak=0.0) -> np.ndarray:
+    """Filling of the semi-elliptic Delta plus the constant Delta0 between
+    eps_sp_min and eps_sp_max, i.e. the integral of Delta + Delta0 up to the
+    Fermi level over that on [eps_min, eps_max]. A finite Sak weights Delta by
+    ( Sak * eps - Vak )^2 as in the Newns-Anderson-Grimley model. All the
+    arguments may be arrays that broadcast against each other."""
+    # With eps = eps_d + wd * x the weight is ( A + B x )^2
+    A = Sak * eps_d - Vak
+    B = Sak * wd
+    def _integrate_Delta(lower, upper):
+        # The normalisation 2 / wd of Delta cancels with deps = wd dx
+        Delta = 2 * _integrate_semi_ellipse(( lower - eps_d ) / wd, ( upper - eps_d ) / wd, A, B)
+        overlap = np.minimum(upper, eps_sp_max) - np.maximum(lower, eps_sp_min)
+        return Delta + Delta0_mag * np.maximum(overlap, 0.0)
+    filling_numerator = _integrate_Delta(eps_min, 0.0)
+    filling_denominator = _integrate_Delta(eps_min, eps_max)
+    return filling_numerator / filling_denominator
+
+
+def calculate_dband_filling_derivative(eps_d, wd, Vak, Delta0_mag, eps_sp_min, eps_sp_max,
+                                       eps_min, eps_max) -> np.ndarray:
+    """Derivative of calculate_dband_filling without overlap with respect
+    to Vak^2. Delta is proportional to Vak^2 while Delta0 is not, so the
+    filling is ( Vak^2 a + b ) / ( Vak^2 c + d ), where a and c are the
+    integrals of Delta per unit Vak^2 and b and d those of Delta0."""
+    def _integrate(lower, upper):
+        Delta = 2 * _integrate_semi_ellipse(( lower - eps_d ) / wd, ( upper - eps_d ) / wd, 1.0, 0.0)
+        overlap = np.minimum(upper, eps_sp_max) - np.maximum(lower, eps_sp_min)
+        return Delta, Delta0_mag * np.maximum(overlap, 0.0)
+    a, b = _integrate(eps_min, 0.0)
+    c, d = _integrate(eps_min, eps_max)
+    return ( a * d - b * c ) / ( Vak**2 * c + d )**2
+
+
+def _calculate_dband_integrals_cached(eps_d, wd, Delta0_mag, eps_sp_min, eps_sp_max,
+                                      eps_min, eps_max) -> tuple:
+    """Integrals of the d-band that depend on the surface alone, cached in
+    the model cache: for the range up to the Fermi level and for [eps_min,
+    eps_max], the integrals of sqrt(1 - x^2) x^k for k = 0, 1, 2 and that
+    of Delta0. Vak and Sak change with the adsorbate and with beta and
+    alpha during a fit, so only these integrals are shared between all
+    the adsorbates on a surface and all the steps of their fits."""
+    key = model_cache.make_key('dband_integrals', eps_d, wd, Delta0_mag,
+                               eps_sp_min, eps_sp_max, eps_min, eps_max)
+    integrals = model_cache.get(key)
+    if integrals is None:
+        lower = _semi_ellipse_antiderivatives(( eps_min - eps_d ) / wd)
+        integrals = []
+        for upper_energy in [ 0.0, eps_max ]:
+            upper = _semi_ellipse_antiderivatives(( upper_energy - eps_d ) / wd)
+            overlap = min(upper_energy, eps_sp_max) - max(eps_min, eps_sp_min)
+            integrals.append(tuple(float(F_u - F_l) for F_u, F_l in zip(upper, lower))
+                             + ( Delta0_mag * max(overlap, 0.0), ))
+        integrals = tuple(integrals)
+        model_cache.put(key, integrals)
+    return integrals
+
+
+def _calculate_dband_filling_cached(eps_d, wd, Vak, Delta0_mag, eps_sp_min, eps_sp_max,
+                                    eps_min, eps_max, Sak=0.0) -> float:
+    """Version of calculate_dband_filling for a single parameter set,
+    combining the cached integrals of the surface with the weight
+    ( A + B x )^2 of the adsorbate."""
+    A = Sak * eps_d - Vak
+    B = Sak * wd
+    # The normalisation 2 / wd of Delta cancels with deps = wd dx
+    filling_numerator, filling_denominator = [
+        2 * ( A**2 * I0 + 2 * A * B * I1 + B**2 * I2 ) + Delta0
+        for I0, I1, I2, Delta0 in _calculate_dband_integrals_cached(
+            eps_d, wd, Delta0_mag, eps_sp_min, eps_sp_max, eps_min, eps_max) ]
+    return filling_numerator / filling_denominator
+
+
+def find_zeros_green_function(pole_function, eps_min, eps_max, lower_edge, upper_edge,
+                              xtol=POLE_TOLERANCE, maxiter=POLE_ITERATIONS) -> np.ndarray:
+    """Find the zeros of pole_function, which is eps - eps_a - Lambda, in
+    the three regions below, inside and above the d-band for arrays of
+    parameters at once. pole_function is called with an array whose last
+    axis runs over the regions and must broadcast the parameters against it;
+    lower_edge and upper_edge are the edges of the d-band for every parameter
+    set. A region contains a zero only if pole_function changes sign between
+    its ends, as eps - eps_a - Lambda increases monotonically outside the
+    d-band. Within the brackets the zeros are refined with the Anderson-Bjorck
+    variant of regula falsi, which converges superlinearly without leaving
+    the bracket. Returns an array with one column per region that is nan
+    where the region has no zero."""
+    lower_edge = np.asarray(lower_edge, dtype=float)
+    upper_edge = np.asarray(upper_edge, dtype=float)
+    a = np.stack([ np.full_like(lower_edge, eps_min), lower_edge, upper_edge ], axis=-1)
+    b = np.stack([ lower_edge, upper_edge, np.full_like(upper_edge, eps_max) ], axis=-1)
+    f_a = pole_function(a)
+    f_b = pole_function(b)
+    # There is a zero in the region only if the function changes sign
+    has_zero = ( f_a * f_b <= 0 ) & ( a < b )
+
+    for _ in range(maxiter):
+        active = has_zero & ( np.abs(b - a) > xtol ) & ( f_b != 0 )
+        if not np.any(active):
+            break
+        # The ends have opposite signs and f_b is not zero, so that
+        # the secant through them is well defined for active regions
+        with np.errstate(invalid='ignore', divide='ignore'):
+            c = np.where(active, ( a * f_b - b * f_a ) / ( f_b - f_a ), b)
+        f_c = pole_function(c)
+        # Keep the bracket; if the same end is kept twice its value
+        # is scaled down so that the other end moves as well
+        crossed = np.sign(f_c) != np.sign(f_b)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            scale = 1 - f_c / f_b
+        scale = np.where(scale > 0, scale, 0.5)
+        f_a = np.where(active, np.where(crossed, f_b, f_a * scale), f_a)
+        a = np.where(active & crossed, b, a)
+        b = np.where(active, c, b)
+        f_b = np.where(active, f_c, f_b)
+
+    return np.where(has_zero, b, np.nan)
+
 
 @dataclass
 class NewnsAndersonNumerical:
     """Perform numerical calculations of the Newns-Anderson model to get 
-    the chemisorption energy."""
+    the chemisorption energy.
+
+    The arb computations run in a precision_context with the precision
+    of the object, so objects with different precisions can be evaluated
+    concurrently in the threads of one process. The parameters of an 
+    object change during its calculations, so a single object should not
+    be evaluated from several threads at once.
+
+    The parameters can be changed with update, which only discards the
+    results that depend on them, so that one object can be reused for a
+    sweep over the parameters."""
 
     Vak: float
     eps_a: float
@@ -22,7 +215,20 @@ class NewnsAndersonNumerical:
     precision: int = 50
     verbose: bool = False
     spin: float = 2
+    quadrature: str = 'adaptive'
+    n_panels: int = 4
+    occupancy_engine: str = 'arb'
+    occupancy_tolerance: float = 1e-10
+    precision_policy: str = 'fixed'
+    energy_tolerance: float = 1e-8
     NUMERICAL_NOISE_THRESHOLD = 1e-2
+    # Parameters on which every result depends; the filling of the
+    # d-band does not depend on the adsorbate or on the integrals
+    RESULT_DEPENDENCIES = {
+        'hybridisation_energy': ADSORBATE_PARAMETERS | METAL_PARAMETERS | INTEGRATION_SETTINGS | { 'spin' },
+        'occupancy': ADSORBATE_PARAMETERS | METAL_PARAMETERS | INTEGRATION_SETTINGS,
+        'filling': METAL_PARAMETERS,
+    }
 
     def __post_init__(self):
         """Perform numerical calculations of the Newns-Anderson model 
@@ -31,21 +237,88 @@ class NewnsAndersonNumerical:
         self.eps_max = np.max(self.eps) 
         self.wd = self.width
         self.eps = np.array(self.eps)
+        # Counters and timers, which do nothing unless the
+        # instrumentation is enabled when the model is created
+        self.recorder = instrumentation.get_recorder(self)
+        self._validate_settings()
 
         if self.verbose:
             print(f'Solving the Newns-Anderson model for eps_a = {self.eps_a:1.2f} eV',
                   f'and eps_d = {self.eps_d:1.2f} and w_d = {self.width:1.2f}')
 
-        # Choose the precision to which the quantities are calculated
-        ctx.dps = self.precision
-
         # The outputs from the model are the hybridisation
         # energy and the occupancy of the single particle state
         self.hybridisation_energy = None
         self.occupancy = None
+        # Error estimates of the integrals, if the engine provides one
+        self.hybridisation_energy_error = None
+        self.occupancy_error = None
+        # Precision of the arb integrals if they were escalated to arb
+        self.hybridisation_energy_precision = None
+        self.occupancy_precision = None
+        # The filling of the d-band is computed on the first request
+        self.filling = None
         
         # Everything start as a float
         self.calctype = 'float'
+
+    def _validate_settings(self):
+        """Check the choice of the integration engines."""
+        # The hybridisation energy is either integrated adaptively with
+        # quad or on the fixed nodes of the Gauss-Legendre panels
+        assert self.quadrature in ['adaptive', 'gauss_legendre'], \
+            "quadrature must be 'adaptive' or 'gauss_legendre'."
+        # The occupancy is computed either with arb (the reference)
+        # or in double precision with error control
+        assert self.occupancy_engine in ['arb', 'float'], \
+            "occupancy_engine must be 'arb' or 'float'."
+        # With 'escalate' both integrals are first done in double precision
+        # and only redone with arb if their error estimate exceeds the
+        # energy_tolerance or occupancy_tolerance; the engines above then
+        # only choose the double precision integration
+        assert self.precision_policy in ['fixed', 'escalate'], \
+            "precision_policy must be 'fixed' or 'escalate'."
+
+    def update(self, **parameters):
+        """Change parameters of the model in place, e.g. update(eps_a=-2.0).
+        Only the results that depend on a changed parameter, as listed in
+        RESULT_DEPENDENCIES, are discarded and computed again when they are
+        next requested; changing eps_a, for example, keeps the filling of
+        the d-band. Returns the model, so that calls can be chained."""
+        updatable = set().union(*self.RESULT_DEPENDENCIES.values()) | { 'verbose' }
+        for name in parameters:
+            assert name in updatable, f"{name} cannot be updated."
+        # The parameters are compared and set as floats
+        self._convert_to_float()
+        changed = set()
+        for name, value in parameters.items():
+            if np.array_equal(getattr(self, name), value):
+                continue
+            setattr(self, name, value)
+            changed.add(name)
+        if not changed:
+            return self
+
+        self._update_derived_parameters(changed)
+        for result, dependencies in self.RESULT_DEPENDENCIES.items():
+            if changed & dependencies:
+                setattr(self, result, None)
+                # Along with the details of how the result was computed
+                for detail in [ f'{result}_error', f'{result}_precision' ]:
+                    if hasattr(self, detail):
+                        setattr(self, detail, None)
+        return self
+
+    def _update_derived_parameters(self, changed):
+        """Set the quantities that are derived from the changed parameters."""
+        if 'width' in changed:
+            self.wd = self.width
+        if 'eps' in changed:
+            self.eps = np.array(self.eps)
+            self.eps_min = np.min(self.eps)
+            self.eps_max = np.max(self.eps)
+        if changed & INTEGRATION_SETTINGS:
+            self._validate_settings()
         
     def _convert_to_acb(self, *args) -> None:
         """Convert the important quantities to arb so 
@@ -97,46 +370,85 @@ class NewnsAndersonNumerical:
             self.beta = float(self.beta.real)
         return args
 
+    def _get_cache_key(self, quantity) -> tuple:
+        """Key of a quantity in the model cache, made of the class, the
+        quantity and every parameter and setting of the calculation.
+        The key does not contain constant_offset, which is added on top."""
+        parameters = [ self.Vak, self.eps_a, self.eps_d, self.wd, self.Delta0_mag,
+                       self.eps_sp_min, self.eps_sp_max, self.eps_min, self.eps_max,
+                       self.spin, self.precision, self.quadrature, self.n_panels, 
+                       self.occupancy_engine, self.occupancy_tolerance,
+                       self.precision_policy, self.energy_tolerance ]
+        # Parameters of the repulsive contributions
+        for name in [ 'alpha', 'add_largeS_contribution', 'single_pass' ]:
+            if hasattr(self, name):
+                parameters.append(getattr(self, name))
+        return model_cache.make_key(type(self).__name__, quantity, *parameters)
+
     def get_hybridisation_energy(self) -> float:
         """Get the hybridisation energy."""
         if self.hybridisation_energy is None:
-            self.calculate_hybridisation_energy()
+            # The error estimate is cached along with the energy
+            key = self._get_cache_key('hybridisation_energy')
+            cached = model_cache.get(key)
+            if cached is None:
+                self.calculate_hybridisation_energy()
+                model_cache.put(key, ( self.hybridisation_energy, self.hybridisation_energy_error ))
+            else:
+                self.hybridisation_energy, self.hybridisation_energy_error = cached
         return self.hybridisation_energy
 
     def get_occupancy(self) -> float:
         """Get the occupancy of the single particle state."""
         if self.occupancy is None:
-            self.calculate_occupancy()
+            key = self._get_cache_key('occupancy')
+            cached = model_cache.get(key)
+            if cached is None:
+                self.calculate_occupancy()
+                model_cache.put(key, ( self.occupancy, self.occupancy_error ))
+            else:
+                self.occupancy, self.occupancy_error = cached
         return float(self.occupancy.real)
+
+    def _load_chemisorption_from_cache(self) -> bool:
+        """Restore the results of compute_chemisorption_energy from the
+        model cache; returns False if they have not been cached yet."""
+        cached = model_cache.get(self._get_cache_key('chemisorption_energy'))
+        if cached is None:
+            return False
+        chemisorption_energy, self.orthogonalisation_energy, self.hybridisation_energy, \
+            self.hybridisation_energy_error, self.occupancy, self.occupancy_error, self.filling = cached
+        self.chemisorption_energy = chemisorption_energy + self.constant_offset
+        return True
+
+    def _store_chemisorption_in_cache(self):
+        """Store the results of compute_chemisorption_energy in the model cache."""
+        model_cache.put(self._get_cache_key('chemisorption_energy'),
+                        ( self.chemisorption_energy - self.constant_offset,
+                          self.orthogonalisation_energy, self.hybridisation_energy,
+                          self.hybridisation_energy_error, self.occupancy,
+                          self.occupancy_error, self.filling ))
     
     def get_dos_on_grid(self) -> np.ndarray:
         """Get the density of states."""
-        eps_function = self._create_adsorbate_line
-        Delta = self._create_Delta_reg
-        Delta0 = self._create_Delta0_reg
-        Lambda = self._create_Lambda_reg
         self._convert_to_float()
-        dos = np.zeros(len(self.eps))
-        for i, eps_ in enumerate(self.eps):
-            numerator = Delta(eps_) + Delta0(eps_) 
-            denominator = ( eps_function(eps_) - Lambda(eps_) )**2 + ( Delta(eps_) + Delta0(eps_) ) **2 
-            dos[i] = numerator / denominator / np.pi
+        eps_function = self._create_adsorbate_line(self.eps)
+        Delta = self._create_Delta_vec(self.eps) + self._create_Delta0_vec(self.eps)
+        Lambda = self._create_Lambda_vec(self.eps)
+        dos = Delta / ( ( eps_function - Lambda )**2 + Delta**2 ) / np.pi
         return dos
 
     def get_Delta_on_grid(self) -> np.ndarray:
         """Get Delta on supplied grid."""
-        Delta = self._create_Delta_reg
-        Delta0 = self._create_Delta0_reg
         self._convert_to_float()
-        Delta_val = np.array([Delta(e) for e in self.eps])
-        Delta_val += np.array([Delta0(e) for e in self.eps])
+        Delta_val = self._create_Delta_vec(self.eps)
+        Delta_val += self._create_Delta0_vec(self.eps)
         return Delta_val 
     
     def get_Lambda_on_grid(self) -> np.ndarray:
         """Get Lambda on supplied grid."""
-        Lambda = self._create_Lambda_reg
         self._convert_to_float()
-        Lambda_val = np.array([Lambda(e) for e in self.eps])
+        Lambda_val = self._create_Lambda_vec(self.eps)
         return Lambda_val 
     
     def get_energy_diff_on_grid(self) -> np.ndarray:
@@ -145,9 +457,17 @@ class NewnsAndersonNumerical:
         self._convert_to_float()
         return eps_function(self.eps)
 
+    def get_statistics(self) -> dict:
+        """Get the counts of the integrand evaluations and integrals, and
+        the time spent in each stage, if the instrumentation was enabled
+        when the model was created."""
+        return self.recorder.get_statistics()
+
+    @timed_stage('filling')
     def get_dband_filling(self):
         """Get the filling of the d-band."""
-        self._calculate_filling()
+        if self.filling is None:
+            self._calculate_filling()
         return self.filling.real 
 
     def create_reference_eps(self, eps):
@@ -170,6 +490,12 @@ class NewnsAndersonNumerical:
         else:
             return 0.0
 
+    def _create_Delta0_vec(self, eps) -> np.ndarray:
+        """Create Delta0 on an array of energies."""
+        eps = np.asarray(eps, dtype=float)
+        in_sp_band = ( eps > self.eps_sp_min ) & ( eps < self.eps_sp_max )
+        return np.where(in_sp_band, self.Delta0_mag, 0.0)
+
     def _create_Delta_arb(self, eps) -> acb:
         """Create a function for Delta based on arb."""
         eps_ref = self.create_reference_eps(eps) 
@@ -210,6 +536,40 @@ class NewnsAndersonNumerical:
             Delta = 0.0 
         return Delta
 
+    def _create_coupling_vec(self, eps):
+        """Create the coupling that multiplies the semi-elliptic shapes
+        of Delta and Lambda; in the Newns-Anderson model it is Vak^2."""
+        return self.Vak**2
+
+    def _create_coupling_arb(self, eps) -> acb:
+        """Create the coupling with arb, see _create_coupling_vec."""
+        return acb(self.Vak)**2
+
+    def _create_coupling_derivative_vec(self, eps, parameter):
+        """Create the derivative of the coupling with respect to 
+        parameter, either 'Vak2' (that is, Vak^2) or 'eps'."""
+        if parameter == 'Vak2':
+            return 1.0
+        elif parameter == 'eps':
+            return 0.0
+        else:
+            raise ValueError(f'Cannot differentiate the coupling with respect to {parameter}')
+
+    def _create_Delta_shape_vec(self, eps) -> np.ndarray:
+        """Create the semi-ellipse of Delta for a unit coupling; the 
+        in-band and out-of-band branches are selected through masks."""
+        eps_ref = self.create_reference_eps(np.asarray(eps, dtype=float))
+        in_band = np.abs(eps_ref) < 1
+        # Clip so that the square root is only ever taken
+        # of positive numbers, the mask zeroes the rest
+        Delta = np.sqrt(np.clip(1. - eps_ref**2, 0.0, None))
+        Delta = Delta * 2 / self.wd
+        return np.where(in_band, Delta, 0.0)
+
+    def _create_Delta_vec(self, eps) -> np.ndarray:
+        """Create Delta on an array of energies."""
+        return self._create_coupling_vec(eps) * self._create_Delta_shape_vec(eps)
+
     def _create_Lambda_arb(self, eps) -> acb:
         """Create the hilbert transform of Delta with arb."""
         eps_ref = self.create_reference_eps(eps)
@@ -258,6 +618,21 @@ class NewnsAndersonNumerical:
         Lambda *= 2
         return Lambda
 
+    def _create_Lambda_shape_vec(self, eps) -> np.ndarray:
+        """Create the hilbert transform of the semi-ellipse for a unit coupling."""
+        eps_ref = self.create_reference_eps(np.asarray(eps, dtype=float))
+        root = np.sqrt(np.clip(eps_ref**2 - 1, 0.0, None))
+        # Below the lower edge of the d-band the root is added,
+        # above the upper edge it is subtracted and inside the 
+        # d-band Lambda is linear in the reference energy
+        Lambda = np.where(eps_ref < -1, eps_ref + root, eps_ref)
+        Lambda = np.where(eps_ref > 1, eps_ref - root, Lambda)
+        return Lambda * 2 / self.wd
+
+    def _create_Lambda_vec(self, eps) -> np.ndarray:
+        """Create the hilbert transform of Delta on an array of energies."""
+        return self._create_coupling_vec(eps) * self._create_Lambda_shape_vec(eps)
+
     def _create_Lambda_prime_arb(self, eps) -> acb:
         """Create the derivative of the hilbert transform of Lambda with arb."""
         eps_ref = self.create_reference_eps(eps)
@@ -276,70 +651,99 @@ class NewnsAndersonNumerical:
         Lambda_prime /= self.wd**2
         return Lambda_prime
 
+    def _create_Lambda_shape_prime_vec(self, eps) -> np.ndarray:
+        """Create the derivative of the hilbert transform of the semi-ellipse
+        for a unit coupling. The derivative diverges at the band edges, so it
+        is only meaningful strictly inside or strictly outside the d-band."""
+        eps_ref = self.create_reference_eps(np.asarray(eps, dtype=float))
+        outside = np.abs(eps_ref) > 1
+        # Guard the square root and the division for points inside the band
+        root = np.sqrt(np.where(outside, eps_ref**2 - 1, 1.0))
+        Lambda_prime = np.where(eps_ref < -1, 1 + eps_ref / root, 1.0)
+        Lambda_prime = np.where(eps_ref > 1, 1 - eps_ref / root, Lambda_prime)
+        return Lambda_prime * 2 / self.wd**2
+
+    def _create_Lambda_shape_second_vec(self, eps) -> np.ndarray:
+        """Create the second derivative of the hilbert transform of the
+        semi-ellipse for a unit coupling, zero inside the d-band."""
+        eps_ref = self.create_reference_eps(np.asarray(eps, dtype=float))
+        outside = np.abs(eps_ref) > 1
+        root = np.sqrt(np.where(outside, eps_ref**2 - 1, 1.0))
+        Lambda_second = np.where(eps_ref < -1, -1 / root**3, 0.0)
+        Lambda_second = np.where(eps_ref > 1, 1 / root**3, Lambda_second)
+        return Lambda_second * 2 / self.wd**3
+
+    def _create_Lambda_prime_vec(self, eps) -> np.ndarray:
+        """Create the derivative of the hilbert transform on an array of energies."""
+        return self.Vak**2 * self._create_Lambda_shape_prime_vec(eps)
+
     def _create_adsorbate_line(self, eps):
         """Create the line that the adsorbate passes through."""
         return eps - self.eps_a
 
-    def find_poles_green_function(self) -> list:
-        """Find the poles of the green function. In the case that Delta=0
-        these points will not be the poles, but are important to pass 
-        on to the integrator anyhow."""
-        self.poles = []
-
-        # In case Delta0 is not-zero, there will be no poles
-        if self.Delta0_mag > 0:
-            self.poles.append([False, False, False])
-            return self.poles
-
-        # If Delta0 is zero, there will be three possible
-        # poles, one on the left and one on the right and 
-        # one within Delta. 
-        # determine where they are based on the intersection
-        # between eps - eps_a - Lambda = 0
-        eps_function = self._create_adsorbate_line
-        Lambda = self._create_Lambda_reg
-
-        # Find the epsilon value as which the Lambda and eps_function are equal
-        # These poles will have to be explicitly mentioned during the integration
-        # There are three possible regions where there might be a root
-        # 1. Region above eps_d + wd
-        # 2. Region between eps_d - wd and eps_d + wd
-        # 3. Region below eps_d - wd
-        # If the optimizer excepts, then there is no intersection 
-        # within that sub-region
+    def _create_pole_function(self, eps) -> np.ndarray:
+        """The poles of the Green's function are the zeros of this function."""
+        return self._create_adsorbate_line(eps) - self._create_Lambda_vec(eps)
 
-        # Find the poles in the energy region that is below the d-band
-        try:
-            pole_lower = optimize.brentq(lambda x: eps_function(x) - Lambda(x), 
-                                         self.eps_min,
-                                         self.eps_d - self.wd,)
-            self.poles.append(pole_lower)
-        except ValueError:
-            self.poles.append(None)
-
-        # Find the pole in the middle of the d-band, if any
-        try:
-            pole_middle = optimize.brentq(lambda x: eps_function(x) - Lambda(x),
-                                          self.eps_d - self.wd,
-                                          self.eps_d + self.wd)
-            self.poles.append(pole_middle)
-        except ValueError:
-            self.poles.append(None)
-
-        # Find the poles in the energy region that is above the d-band
-        try:
-            pole_higher = optimize.brentq(lambda x: eps_function(x) - Lambda(x),
-                                          self.eps_d + self.wd,
-                                          self.eps_max )
-            self.poles.append(pole_higher)
-        except ValueError:
-            self.poles.append(None)
+    def find_poles_green_function(self) -> np.ndarray:
+        """Find the poles of the green function. In the case that Delta0
+        is finite these points will not be the poles, but are important
+        to pass on to the integrator anyhow. Returns an array of three
+        candidates, below, inside and above the d-band, which is nan
+        where there is no pole."""
+        self._convert_to_float()
+        self.poles = self._find_zeros_green_function()
 
         if self.verbose:
             print(f'Poles of the green function:{self.poles}')
         
         return self.poles
 
+    @timed_stage('poles')
+    def _find_zeros_green_function(self) -> np.ndarray:
+        """Find the energies at which eps - eps_a - Lambda vanishes. These
+        are the poles of the green function if Delta0 is zero; otherwise 
+        they are the centres of the sharpest features of the integrands."""
+        # The zeros only depend on the adsorbate and the d-band, so
+        # they are shared by all the integrals of the same model
+        key = model_cache.make_key('zeros_green_function', type(self).__name__,
+                                   self.Vak, self.eps_a, self.eps_d, self.wd,
+                                   self.eps_min, self.eps_max, getattr(self, 'alpha', None))
+        zeros = model_cache.get(key)
+        if zeros is None:
+            # There are three possible regions where there might be a root
+            # 1. Region below eps_d - wd
+            # 2. Region between eps_d - wd and eps_d + wd
+            # 3. Region above eps_d + wd
+            zeros = find_zeros_green_function(self._create_pole_function,
+                                              self.eps_min, self.eps_max,
+                                              self.eps_d - self.wd, self.eps_d + self.wd)
+            model_cache.put(key, zeros)
+        # Copy so that the cached zeros cannot be modified
+        return zeros.copy()
+
+    def _get_band_edges(self) -> tuple:
+        """Lower and upper edges of the d-band, eps_d -+ wd for the semi-ellipse."""
+        return self.eps_d - self.wd, self.eps_d + self.wd
+
+    def _get_breakpoints(self, lower_bound, upper_bound, poles) -> np.ndarray:
+        """Breakpoints for the fixed-node integrals between lower_bound and
+        upper_bound: the edges of the d- and sp-bands and the poles, clipped
+        to the integration range. poles has one row of three per parameter
+        set with nan for absent poles, which produce segments of zero length."""
+        poles = np.atleast_2d(np.asarray(poles, dtype=float))
+        column = lambda x: np.broadcast_to(x, (len(poles), 1))
+        lower_bound = column(lower_bound)
+        upper_bound = column(upper_bound)
+        lower_edge, upper_edge = self._get_band_edges()
+        points = np.concatenate([ column(lower_edge),
+                                  np.where(np.isnan(poles), lower_bound, poles),
+                                  column(upper_edge),
+                                  column(self.eps_sp_min),
+                                  column(self.eps_sp_max) ], axis=-1)
+        points = np.clip(points, lower_bound, upper_bound)
+        return np.concatenate([ lower_bound, points, upper_bound ], axis=-1)
+
     def _create_dos(self, eps) -> acb:
         """Create the density of states."""
         eps_function = self._create_adsorbate_line
@@ -351,31 +755,69 @@ class NewnsAndersonNumerical:
         denominator = ( eps_function(eps) - Lambda(eps) )**2 + ( Delta(eps) + Delta0(eps) )**2 
         return numerator / denominator / acb.pi()
 
+    def _create_dos_vec(self, eps) -> np.ndarray:
+        """Create the density of states on an array of energies."""
+        numerator = self._create_Delta_vec(eps) + self._create_Delta0_vec(eps)
+        denominator = ( self._create_adsorbate_line(eps) - self._create_Lambda_vec(eps) )**2
+        denominator += numerator**2
+        # At a pole with Delta = 0 the density of states is a delta 
+        # function, which has to be accounted for separately.
+        with np.errstate(invalid='ignore', divide='ignore'):
+            dos = numerator / denominator / np.pi
+        return np.nan_to_num(dos, nan=0.0, posinf=0.0)
+
     def _calculate_filling(self) -> float:
-        """Calculate the filling from the metal density of states."""
+        """Calculate the filling from the metal density of states. The 
+        integrals of the semi-elliptic Delta and the constant Delta0 are 
+        elementary, so the filling is computed in closed form and cached."""
+        self._convert_to_float()
+        self.filling = _calculate_dband_filling_cached(
+            float(self.eps_d), float(self.wd), float(self.Vak), float(self.Delta0_mag),
+            float(self.eps_sp_min), float(self.eps_sp_max),
+            float(self.eps_min), float(self.eps_max))
+        return self.filling
+
+    def _calculate_filling_numerical(self) -> float:
+        """Calculate the filling from the metal density of states
+        by numerically integrating Delta and Delta0."""
         self._convert_to_float()
         # Filling contribution coming from the d-states
-        filling_numerator = integrate.quad(self._create_Delta_reg, 
+        filling_numerator = self.recorder.quad('filling', self._create_Delta_reg, 
                             self.eps_min, 0,
                             limit=100)[0]
         # Filling contribution coming from the sp-states
-        filling_numerator += integrate.quad(self._create_Delta0_reg,
+        filling_numerator += self.recorder.quad('filling', self._create_Delta0_reg,
                              self.eps_min, 0,
                              limit=100)[0]
         # Filling contribution to the denomitor coming from the d-states 
-        filling_denominator = integrate.quad(self._create_Delta_reg,
+        filling_denominator = self.recorder.quad('filling', self._create_Delta_reg,
                             self.eps_min, self.eps_max,
                             limit=100)[0]
         # Filling contribution to the denomitor coming from the sp-states
-        filling_denominator += integrate.quad(self._create_Delta0_reg,
+        filling_denominator += self.recorder.quad('filling', self._create_Delta0_reg,
                                 self.eps_min, self.eps_max,
                                 limit=100)[0]
         self.filling = filling_numerator / filling_denominator
         return filling_numerator / filling_denominator
 
+    @timed_stage('occupancy')
     def calculate_occupancy(self):
         """Calculate the density of states from the Newns-Anderson model."""
-        # If a dos is required, then switch to arb
+        if self.precision_policy == 'escalate':
+            self._calculate_occupancy_escalate()
+        elif self.occupancy_engine == 'float':
+            # Double precision with adaptive error control
+            self._calculate_occupancy_float()
+        else:
+            # If a dos is required, then switch to arb
+            with precision_context(self.precision):
+                self._calculate_occupancy_arb()
+        if self.verbose:
+            print(f'Single particle occupancy: {self.occupancy}')
+
+    def _calculate_occupancy_arb(self):
+        """Calculate the occupancy with arb, at the working precision of
+        the enclosing precision context."""
         if self.Delta0_mag == 0:
             # Determine the points of the singularity
             self.find_poles_green_function()
@@ -383,8 +825,9 @@ class NewnsAndersonNumerical:
 
             localised_occupancy = acb('0.0')
             for pole in self.poles:
-                if pole is not None:
+                if np.isfinite(pole):
                     # The pole has to exist 
+                    pole = float(pole)
                     if pole.real < 0: 
                         # The pole has to be below the Fermi 
                         # level to be counted in the occupancy
@@ -400,7 +843,8 @@ class NewnsAndersonNumerical:
             # # Add in the integral for the states within the Delta function
             lower_integration_bound = min(0.0, float((self.eps_d - self.wd).real) )
             upper_integration_bound = min(0.0, float((self.eps_d + self.wd).real) )
-            self.occupancy = acb.integral(lambda x, _: self._create_dos(x),
+            self.recorder.count('arb_integrals')
+            self.occupancy = acb.integral(self.recorder.counted('occupancy', lambda x, _: self._create_dos(x)),
                                                 lower_integration_bound,
                                                 upper_integration_bound)
             self.occupancy += localised_occupancy
@@ -408,12 +852,190 @@ class NewnsAndersonNumerical:
         else:
             self._convert_to_acb()
             # Numerically integrate the dos to find the occupancy
-            self.occupancy = acb.integral(lambda x, _: self._create_dos(x), 
+            self.recorder.count('arb_integrals')
+            self.occupancy = acb.integral(self.recorder.counted('occupancy', lambda x, _: self._create_dos(x)), 
                                                 self.eps_min, 
                                                 arb('0.0'), 
                                                 rel_tol=np.power(2, -self.precision/2))
-        if self.verbose:
-            print(f'Single particle occupancy: {self.occupancy}')
+
+    def _calculate_occupancy_escalate(self):
+        """Calculate the occupancy in double precision and redo the
+        integral with arb if its error estimate exceeds occupancy_tolerance.
+        The residues of the localised states are exact in double precision."""
+        self._calculate_occupancy_float()
+        if np.isfinite(self.occupancy_error) and \
+           self.occupancy_error <= self.occupancy_tolerance * max(1.0, abs(self.occupancy)):
+            return
+
+        if self.Delta0_mag == 0:
+            lower_integration_bound = min(0.0, self.eps_d - self.wd)
+            upper_integration_bound = min(0.0, self.eps_d + self.wd)
+        else:
+            lower_integration_bound = self.eps_min
+            upper_integration_bound = 0.0
+        localised_occupancy = self.occupancy - self._occupancy_integral
+        occupancy, self.occupancy_precision = self._integrate_arb('dos',
+                                                  lower_integration_bound, upper_integration_bound,
+                                                  self.poles, self.occupancy_tolerance)
+        self.occupancy = float(occupancy.mid()) + localised_occupancy
+        self.occupancy_error = float(occupancy.rad())
+
+    def _create_segment_integrand_arb(self, t, analytic, region, Delta0, quantity) -> acb:
+        """Create the density of states ('dos') or the energy integrand
+        ('energy') with arb, times the Jacobian of the change of variables
+        eps_r = sin(t) within the d-band (region 0) and eps_r = -+cosh(t)
+        below (-1) and above (+1) it. The square roots of 1 - eps_r^2 and
+        eps_r^2 - 1 become cos(t) and sinh(t), so the integrand is analytic
+        within every segment between the band edges."""
+        if region == 0:
+            eps_r = acb.sin(t); root = acb.cos(t)
+            Delta_shape = 2 * root / self.wd
+            Lambda_shape = 2 * eps_r / self.wd
+        else:
+            eps_r = region * acb.cosh(t); root = acb.sinh(t)
+            Delta_shape = acb(0)
+            Lambda_shape = 2 * ( eps_r - region * root ) / self.wd
+        eps = self.eps_d + self.wd * eps_r
+        coupling = self._create_coupling_arb(eps)
+        Delta = coupling * Delta_shape + Delta0
+        eps_function = self._create_adsorbate_line(eps) - coupling * Lambda_shape
+        # d eps = wd cos(t) dt within the d-band and wd sinh(t) dt 
+        # outside of it, up to the orientation of the integral
+        jacobian = self.wd * root
+
+        if quantity == 'dos':
+            integrand = Delta / ( eps_function**2 + Delta**2 ) / acb.pi()
+        elif acb.abs_lower(Delta) > acb.abs_upper(eps_function):
+            # arctan2(Delta, eps_function) - pi = - pi / 2 - atan(eps_function / Delta),
+            # with atan written with logarithms to check their branch cuts
+            ratio = acb(0, 1) * eps_function / Delta
+            atan = ( acb.log(1 - ratio, analytic=analytic) - acb.log(1 + ratio, analytic=analytic) ) \
+                 * acb(0, 0.5)
+            integrand = - acb.pi() / 2 - atan
+        elif eps_function.real > 0 or eps_function.real < 0:
+            # arctan2(Delta, eps_function) - pi = atan(Delta / eps_function) - pi 
+            # above the zero of eps_function and atan(Delta / eps_function) below
+            ratio = acb(0, 1) * Delta / eps_function
+            atan = ( acb.log(1 - ratio, analytic=analytic) - acb.log(1 + ratio, analytic=analytic) ) \
+                 * acb(0, 0.5)
+            integrand = atan - acb.pi() if eps_function.real > 0 else atan
+        else:
+            # Neither form is known to be analytic, the ball is bisected
+            return acb('nan')
+        return integrand * jacobian
+
+    def _integrate_arb(self, quantity, lower_bound, upper_bound, zeros, tolerance) -> tuple:
+        """Integrate the density of states or the energy integrand with arb
+        between lower_bound and upper_bound, split at the breakpoints of the
+        fixed-node integrals. Within the d-band and wherever Delta0 is finite
+        every segment is integrated in the variable of
+        _create_segment_integrand_arb for its region; elsewhere Delta = 0 
+        and the integrands are constant between the zeros. The precision is
+        doubled from precision until the radius of the result is within 
+        tolerance, up to MAX_ESCALATION_PRECISION. Returns the integral and
+        the precision in decimal digits that was used."""
+        breakpoints = np.unique(self._get_breakpoints(lower_bound, upper_bound, zeros)[0])
+        precision = self.precision
+        # The radius of the result is typically some ten times the 
+        # goal of acb.integral, which is tightened at every step
+        goal = tolerance / 100
+        key = 'occupancy' if quantity == 'dos' else quantity
+        with precision_context(precision):
+            while True:
+                ctx.dps = precision
+                integral = acb(0)
+                for lower, upper in zip(breakpoints[:-1], breakpoints[1:]):
+                    middle = ( lower + upper ) / 2
+                    Delta0 = self._create_Delta0_reg(middle)
+                    eps_r = [ self.create_reference_eps(x) for x in ( lower, upper ) ]
+                    region = int(np.sign(eps_r[0] + eps_r[1])) \
+                             if np.abs(self.create_reference_eps(middle)) > 1 else 0
+                    if region != 0 and Delta0 == 0:
+                        # Only the jump of the arctan contributes
+                        if quantity == 'energy' and self._create_pole_function(middle) > 0:
+                            integral -= acb.pi() * acb(str(upper - lower))
+                        continue
+                    # Bounds in the variable of the region, clipped in
+                    # case of rounding at the band edges
+                    if region == 0:
+                        bounds = [ acb(str(np.clip(x, -1.0, 1.0))).asin() for x in eps_r ]
+                    else:
+                        bounds = [ acb(str(max(region * x, 1.0))).acosh() for x in eps_r ]
+                    self.recorder.count('arb_integrals')
+                    integrand = lambda t, analytic: self._create_segment_integrand_arb(
+                                    t, analytic, region, Delta0, quantity)
+                    segment = acb.integral(self.recorder.counted(key, integrand),
+                                           bounds[0], bounds[1], 
+                                           rel_tol=goal, abs_tol=goal)
+                    # Below the d-band eps decreases with t
+                    integral += -segment if region == -1 else segment
+                integral = integral.real
+                if integral.rad() <= tolerance * max(1.0, abs(float(integral.mid()))) \
+                   or precision >= MAX_ESCALATION_PRECISION:
+                    return integral, precision
+                precision *= 2
+                goal /= 100
+                self.recorder.count('arb_escalations')
+
+    def _create_dos_reg(self, eps) -> float:
+        """Create the density of states for regular manipulations."""
+        numerator = self._create_Delta_reg(eps) + self._create_Delta0_reg(eps)
+        denominator = ( self._create_adsorbate_line(eps) - self._create_Lambda_reg(eps) )**2 
+        denominator += numerator**2
+        return numerator / denominator / np.pi
+
+    def _calculate_occupancy_float(self):
+        """Calculate the occupancy in double precision. The density of states
+        is integrated with adaptive quadrature to an absolute and relative
+        tolerance of occupancy_tolerance, with the band edges, the sp-band
+        edges and the zeros of eps - eps_a - Lambda passed as breakpoints.
+        The error estimate of quad is stored in occupancy_error.
+
+        Against tight reference integrals (quad at 1e-12 and dense Simpson
+        rules) the float engine is accurate to the requested tolerance. It
+        agrees with the arb engine to about 1e-8 for Delta0 = 0, where the
+        arb integral only covers the d-band. For Delta0 > 0 the two differ
+        by up to about 1e-3: the arb integrand is only piecewise analytic, 
+        while acb.integral assumes analyticity over the whole range, so the 
+        float engine is the more accurate of the two in that case."""
+        self._convert_to_float()
+
+        localised_occupancy = 0.0
+        if self.Delta0_mag == 0:
+            self.find_poles_green_function()
+            for pole in self.poles:
+                # Localised states are the poles below the Fermi 
+                # level and outside of the d-band, where Delta = 0
+                if np.isfinite(pole) and pole < 0 \
+                   and ( pole < self.eps_d - self.wd or pole > self.eps_d + self.wd ):
+                    Lambda_prime = self._create_Lambda_prime_vec(pole)
+                    assert Lambda_prime <= 0.0
+                    localised_occupancy += 1.0 / ( 1.0 - Lambda_prime )
+            # The rest of the states are within the d-band
+            lower_integration_bound = min(0.0, self.eps_d - self.wd)
+            upper_integration_bound = min(0.0, self.eps_d + self.wd)
+            points = list(self.poles)
+        else:
+            lower_integration_bound = self.eps_min
+            upper_integration_bound = 0.0
+            points = list(self.find_poles_green_function())
+            points += [ self.eps_d - self.wd, self.eps_d + self.wd,
+                        self.eps_sp_min, self.eps_sp_max ]
+
+        points = [ point for point in points if np.isfinite(point)
+                   and lower_integration_bound < point < upper_integration_bound ]
+        if upper_integration_bound > lower_integration_bound:
+            occupancy, self.occupancy_error = self.recorder.quad('occupancy', self._create_dos_reg,
+                                                lower_integration_bound,
+                                                upper_integration_bound,
+                                                points = tuple(points) if points else None,
+                                                epsabs = self.occupancy_tolerance,
+                                                epsrel = self.occupancy_tolerance,
+                                                limit = 200)
+        else:
+            occupancy, self.occupancy_error = 0.0, 0.0
+        self._occupancy_integral = occupancy
+        self.occupancy = occupancy + localised_occupancy
 
     def _create_energy_integrand(self, eps):
         """Create the energy integrand of the system."""
@@ -436,6 +1058,14 @@ class NewnsAndersonNumerical:
             assert arctan_integrand >= -np.pi, "Arctan integrand must be greater than -pi"
             return arctan_integrand
     
+    def _create_energy_integrand_vec(self, eps) -> np.ndarray:
+        """Create the energy integrand on an array of energies."""
+        numerator = self._create_Delta_vec(eps) + self._create_Delta0_vec(eps)
+        denominator = self._create_adsorbate_line(eps) - self._create_Lambda_vec(eps)
+        arctan_integrand = np.arctan2(numerator, denominator) - np.pi
+        return np.where(eps > 0, 0.0, arctan_integrand)
+
+    @timed_stage('energy')
     def calculate_hybridisation_energy(self):
         """Calculate the energy from the Newns-Anderson model."""
 
@@ -443,18 +1073,170 @@ class NewnsAndersonNumerical:
         self._convert_to_float()
         self.find_poles_green_function()
 
-        poles_to_consider = [pole for pole in self.poles if pole is not None]
-        delta_E_ = integrate.quad(self._create_energy_integrand, 
-                            self.eps_min, 0,
-                            points = tuple(poles_to_consider),
-                            limit=100)[0]
+        if self.quadrature == 'gauss_legendre':
+            # Split at the zeros of eps - eps_a - Lambda even if Delta0 
+            # is finite, as the integrand changes rapidly around them
+            breakpoints = self._get_breakpoints(self.eps_min, 0.0, self.poles)
+            engine = get_quadrature_engine(self.n_panels)
+            delta_E_, error = engine.integrate(self.recorder.counted('energy', self._create_energy_integrand_vec),
+                                               breakpoints)
+            delta_E_ = delta_E_[0]; error = error[0]
+        elif self.precision_policy == 'escalate':
+            # Splitting at the band edges as well lets quad reach the 
+            # tolerance in double precision for most parameter sets
+            points = self._get_breakpoints(self.eps_min, 0.0, self.poles)[0]
+            points = np.unique(points[( points > self.eps_min ) & ( points < 0 )])
+            tolerance = self.energy_tolerance * np.pi / self.spin
+            delta_E_, error = self.recorder.quad('energy', self._create_energy_integrand, 
+                                self.eps_min, 0,
+                                points = tuple(points) if len(points) else None,
+                                epsabs = tolerance, epsrel = tolerance,
+                                limit=200)
+        else:
+            poles_to_consider = self.poles[np.isfinite(self.poles)]
+            delta_E_, error = self.recorder.quad('energy', self._create_energy_integrand, 
+                                self.eps_min, 0,
+                                points = tuple(poles_to_consider),
+                                limit=100)
+
+        if self.precision_policy == 'escalate' and \
+           not error * self.spin / np.pi <= self.energy_tolerance * max(1.0, abs(delta_E_ * self.spin / np.pi)):
+            # Redo the integral with arb; the tolerance is in the units of the energy
+            delta_E_, self.hybridisation_energy_precision = self._integrate_arb('energy',
+                                                              self.eps_min, 0.0, self.poles,
+                                                              self.energy_tolerance * np.pi / self.spin)
+            error = float(delta_E_.rad()); delta_E_ = float(delta_E_.mid())
 
         self.hybridisation_energy = delta_E_ * self.spin / np.pi 
         self.hybridisation_energy -= self.spin * self.eps_a
+        # Error estimate of the integral in the same units
+        self.hybridisation_energy_error = error * self.spin / np.pi
 
         # Check if DeltaE is positive and within the NUMERICAL_NOISE_THRESHOLD
         if self.hybridisation_energy > 0 and self.hybridisation_energy < self.NUMERICAL_NOISE_THRESHOLD:
             self.hybridisation_energy = 0
 
         if self.verbose:
-            print(f'Energy of the system: {self.hybridisation_energy} eV')
\ No newline at end of file
+            print(f'Energy of the system: {self.hybridisation_energy} eV')
+
+    def _create_energy_integrand_derivative_vec(self, eps, parameter) -> np.ndarray:
+        """Create the derivative of the energy integrand with respect to a
+        parameter of the coupling. Delta and Lambda are both proportional
+        to the coupling, so the derivative of the arctan is
+        ( (eps - eps_a - Lambda) dDelta + Delta dLambda ) / ( (eps - eps_a - Lambda)^2 + Delta^2 )."""
+        coupling_derivative = self._create_coupling_derivative_vec(eps, parameter)
+        Delta_derivative = coupling_derivative * self._create_Delta_shape_vec(eps)
+        Lambda_derivative = coupling_derivative * self._create_Lambda_shape_vec(eps)
+        numerator = self._create_Delta_vec(eps) + self._create_Delta0_vec(eps)
+        denominator = self._create_adsorbate_line(eps) - self._create_Lambda_vec(eps)
+        # Where both Delta and its derivative vanish the arctan is constant
+        with np.errstate(invalid='ignore', divide='ignore'):
+            integrand = ( denominator * Delta_derivative + numerator * Lambda_derivative ) \
+                      / ( denominator**2 + numerator**2 )
+        integrand = np.nan_to_num(integrand, nan=0.0, posinf=0.0, neginf=0.0)
+        return np.where(eps > 0, 0.0, integrand)
+
+    def _create_dos_derivative_vec(self, eps, parameter) -> np.ndarray:
+        """Create the derivative of the density of states with respect to a
+        parameter of the coupling on an array of energies."""
+        coupling_derivative = self._create_coupling_derivative_vec(eps, parameter)
+        Delta_derivative = coupling_derivative * self._create_Delta_shape_vec(eps)
+        Lambda_derivative = coupling_derivative * self._create_Lambda_shape_vec(eps)
+        numerator = self._create_Delta_vec(eps) + self._create_Delta0_vec(eps)
+        denominator = self._create_adsorbate_line(eps) - self._create_Lambda_vec(eps)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            dos_derivative = Delta_derivative * ( denominator**2 - numerator**2 )
+            dos_derivative += 2 * denominator * numerator * Lambda_derivative
+            dos_derivative /= np.pi * ( denominator**2 + numerator**2 )**2
+        return np.nan_to_num(dos_derivative, nan=0.0, posinf=0.0, neginf=0.0)
+
+    def _get_pole_derivatives(self, poles, parameter) -> np.ndarray:
+        """Derivatives of the zeros of eps - eps_a - Lambda with respect to a
+        parameter of the coupling, from differentiating the condition that
+        they are zeros: dpole = dLambda / ( 1 - Lambda' )."""
+        poles = np.asarray(poles, dtype=float)
+        Lambda_shape = self._create_Lambda_shape_vec(poles)
+        Lambda_prime = self._create_coupling_derivative_vec(poles, 'eps') * Lambda_shape
+        Lambda_prime += self._create_coupling_vec(poles) * self._create_Lambda_shape_prime_vec(poles)
+        return self._create_coupling_derivative_vec(poles, parameter) * Lambda_shape / ( 1 - Lambda_prime )
+
+    def _integrate_derivative(self, integrand, lower_bound, upper_bound, zeros,
+                              tolerance=None) -> float:
+        """Integrate the derivative of an integrand of the model between
+        lower_bound and upper_bound on the fixed nodes of the Gauss-Legendre
+        panels, with the breakpoints of the integrals of the model itself.
+        If a tolerance is given, the number of panels is doubled until the
+        error estimate is below it, up to MAX_DERIVATIVE_PANELS."""
+        breakpoints = self._get_breakpoints(lower_bound, upper_bound, zeros)
+        n_panels = self.n_panels
+        while True:
+            engine = get_quadrature_engine(n_panels)
+            derivative, error = engine.integrate(self.recorder.counted('derivative', integrand), breakpoints)
+            if tolerance is None or n_panels >= MAX_DERIVATIVE_PANELS \
+               or error[0] <= tolerance * max(1.0, abs(derivative[0])):
+                return derivative[0]
+            n_panels *= 2
+
+    @timed_stage('derivatives')
+    def calculate_hybridisation_energy_derivative(self, parameter='Vak2') -> float:
+        """Calculate the derivative of the hybridisation energy with respect
+        to a parameter of the coupling, 'Vak2' (that is, Vak^2) and for the
+        Newns-Anderson-Grimley model also 'alpha'. The integrand is
+        differentiated under the integral. Where Delta vanishes, the arctan
+        jumps by pi at the zeros of eps - eps_a - Lambda, which move with the
+        parameter and contribute spin times their derivative. The derivative
+        does not account for the energies that are set to zero as numerical noise."""
+        self._convert_to_float()
+        zeros = self._find_zeros_green_function()
+
+        integrand = lambda eps: self._create_energy_integrand_derivative_vec(eps, parameter)
+        # Same accuracy as the integral of the energy itself
+        tolerance = None if self.quadrature == 'gauss_legendre' else ADAPTIVE_TOLERANCE
+        derivative = self._integrate_derivative(integrand, self.eps_min, 0.0, zeros,
+                                                tolerance=tolerance)
+        derivative *= self.spin / np.pi
+
+        # Contribution of the jumps of the arctan below the Fermi level
+        zeros = zeros[np.isfinite(zeros)]
+        Delta = self._create_Delta_vec(zeros) + self._create_Delta0_vec(zeros)
+        jumps = zeros[( zeros < 0 ) & ( Delta == 0 )]
+        derivative += self.spin * np.sum(self._get_pole_derivatives(jumps, parameter))
+
+        return derivative
+
+    @timed_stage('derivatives')
+    def calculate_occupancy_derivative(self, parameter='Vak2') -> float:
+        """Calculate the derivative of the occupancy with respect to a parameter
+        of the coupling in double precision to occupancy_tolerance, whichever
+        engine computes the occupancy itself. For Delta0 = 0 the derivatives of
+        the residues 1 / ( 1 - Lambda' ) of the localised states are added to
+        the derivative of the integral over the d-band, as in calculate_occupancy."""
+        self._convert_to_float()
+        zeros = self._find_zeros_green_function()
+
+        localised_derivative = 0.0
+        if self.Delta0_mag == 0:
+            for pole in zeros:
+                if np.isfinite(pole) and pole < 0 \
+                   and ( pole < self.eps_d - self.wd or pole > self.eps_d + self.wd ):
+                    residue = 1.0 / ( 1.0 - self._create_Lambda_prime_vec(pole) )
+                    # Lambda' changes with the parameter and with the pole
+                    Lambda_prime_derivative = self._create_coupling_derivative_vec(pole, parameter) \
+                                            * self._create_Lambda_shape_prime_vec(pole)
+                    Lambda_prime_derivative += self._create_coupling_vec(pole) \
+                                             * self._create_Lambda_shape_second_vec(pole) \
+                                             * self._get_pole_derivatives(pole, parameter)
+                    localised_derivative += residue**2 * Lambda_prime_derivative
+            lower_integration_bound = min(0.0, self.eps_d - self.wd)
+            upper_integration_bound = min(0.0, self.eps_d + self.wd)
+        else:
+            lower_integration_bound = self.eps_min
+            upper_integration_bound = 0.0
+
+        if upper_integration_bound <= lower_integration_bound:
+            return float(localised_derivative)
+        integrand = lambda eps: self._create_dos_derivative_vec(eps, parameter)
+        derivative = self._integrate_derivative(integrand, lower_integration_bound,
+                                                upper_integration_bound, zeros,
+                                                tolerance=self.occupancy_tolerance)
+        return float(derivative + localised_derivative)
@@ -1,8 +1,39 @@
 """Perform fitting for the parameters in the model."""
 
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 from catchemi import NewnsAndersonLinearRepulsion, NewnsAndersonGrimleyRepulsion
 
+
+def _evaluate_chemisorption(fitting_class, add_largeS_contribution, parameters) -> tuple:
+    """Evaluate the model for a single metal and single particle state.
+    Defined at the module level so that it can be sent to worker processes;
+    returns the chemisorption, hybridisation and orthogonalisation energies,
+    the occupancy and the filling as floats."""
+    chemisorption = fitting_class(**parameters)
+    if add_largeS_contribution:
+        # Make sure that the largeS contribution is
+        # used when the type of repulsion is linear_mod
+        chemisorption.add_largeS_contribution = True
+
+    e_chem = chemisorption.get_chemisorption_energy()
+    e_hyb = chemisorption.get_hybridisation_energy()
+    e_ortho = chemisorption.get_orthogonalisation_energy()
+    occupancy = chemisorption.get_occupancy()
+    filling = chemisorption.get_dband_filling()
+
+    return float(e_chem), float(e_hyb), float(e_ortho), float(occupancy), float(filling)
+
+
+def _evaluate_chemisorption_derivatives(fitting_class, add_largeS_contribution, parameters) -> dict:
+    """Evaluate the derivatives of the chemisorption energy for a single
+    metal and single particle state; the counterpart of _evaluate_chemisorption."""
+    chemisorption = fitting_class(**parameters)
+    if add_largeS_contribution:
+        chemisorption.add_largeS_contribution = True
+    return chemisorption.get_chemisorption_energy_derivatives()
+
+
 class FitParametersNewnsAnderson:
     """Class for fitting the Newns-Anderson model to the
     DFT energies.
@@ -33,6 +64,37 @@ class FitParametersNewnsAnderson:
             where linear is just the two-state repulsion, linear_mod
             is the two-state repulsion with the modification of the
             large-S contributions and grimley is the Grimley repulsion.
+    quadrature: str
+            Integration of the hybridisation energy, either 'adaptive'
+            or on the fixed nodes of 'gauss_legendre' panels.
+    n_panels: int
+            Number of panels per segment for 'gauss_legendre'.
+    occupancy_engine: str
+            Integration of the occupancy, either with 'arb' or in
+            double precision with 'float'.
+    occupancy_tolerance: float
+            Absolute and relative tolerance of the 'float' occupancy.
+    precision_policy: str
+            Either 'fixed', where the engines above are used as they
+            are, or 'escalate', where both integrals are done in double
+            precision and only redone with arb if their error estimates
+            exceed energy_tolerance or occupancy_tolerance.
+    energy_tolerance: float
+            Tolerance of the hybridisation energy for 'escalate'.
+    single_pass: bool
+            For the grimley repulsion, integrate the hybridisation
+            energies with and without overlap together on the
+            nodes of the 'gauss_legendre' panels.
+    n_jobs: int
+            Number of worker processes over which the evaluations
+            for the different metals and single particle states are
+            distributed. The default of 1 evaluates them serially in
+            this process. The pool is started on the first call of
+            fit_parameters and reused until close is called.
+    executor: ProcessPoolExecutor
+            A pool of worker processes shared with other fits, used
+            instead of starting one when n_jobs is larger than 1. It
+            is not shut down by close.
 
     Outputs:
 
@@ -54,8 +116,19 @@ class FitParametersNewnsAnderson:
         self.no_of_bonds = kwargs.get('no_of_bonds', np.ones(len(self.Vsd)))
         self.spin = kwargs.get('spin', 2)
         self.type_repulsion = kwargs.get('type_repulsion', 'linear')
+        self.quadrature = kwargs.get('quadrature', 'adaptive')
+        self.n_panels = kwargs.get('n_panels', 4)
+        self.occupancy_engine = kwargs.get('occupancy_engine', 'arb')
+        self.occupancy_tolerance = kwargs.get('occupancy_tolerance', 1e-10)
+        self.precision_policy = kwargs.get('precision_policy', 'fixed')
+        self.energy_tolerance = kwargs.get('energy_tolerance', 1e-8)
+        self.single_pass = kwargs.get('single_pass', False)
+        self.n_jobs = kwargs.get('n_jobs', 1)
 
         self.validate_inputs()
+        self._executor = kwargs.get('executor', None)
+        # Only a pool started by this object is shut down by close
+        self._owns_executor = self._executor is None
         
     def validate_inputs(self):
         """Check if everything is the same length and
@@ -65,10 +138,32 @@ class FitParametersNewnsAnderson:
         assert self.eps_a != None, "eps_a is not defined."
         assert self.type_repulsion in ['linear', 'linear_mod', 'grimley'], \
             "type_repulsion must be 'linear' or 'grimley'."
-        if isinstance(self.eps_a, list):
+        if isinstance(self.eps_a, list) and self.verbose:
             print('Multiple eps_a have been passed.')
         if isinstance(self.eps_a, float) or isinstance(self.eps_a, int):
             self.eps_a = [self.eps_a]
+        assert self.n_jobs >= 1, "n_jobs must be at least one."
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        """Get the pool of worker processes, starting it if needed.
+        The pool is kept between calls of fit_parameters, as every
+        step of the fit evaluates the model again."""
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.n_jobs)
+            self._owns_executor = True
+        return self._executor
+
+    def close(self):
+        """Shut down the pool of worker processes, if one was started."""
+        if self._executor is not None and self._owns_executor:
+            self._executor.shutdown()
+        self._executor = None
+
+    def __getstate__(self):
+        """The pool of worker processes cannot be pickled."""
+        state = self.__dict__.copy()
+        state['_executor'] = None
+        return state
 
     def _validate_guesses(self, alpha, beta, constant_offset):
         """Check the validity of the length of the input."""
@@ -89,11 +184,9 @@ class FitParametersNewnsAnderson:
 
         return alpha, beta, constant_offset
 
-    def fit_parameters(self, args, eps_ds) -> np.ndarray:
-        """Fit parameters of alpha, beta and constant offset
-        of the NewnsAndersonModel including repulsive interations
-        to DFT energies."""
-
+    def _parse_parameters(self, args) -> tuple:
+        """Split the parameters of the fit into alpha, beta and the
+        constant offset for every single particle state."""
         # alpha, beta, constant_offset = args
         alpha = args[0:len(self.eps_a)]
         beta = args[len(self.eps_a):2*len(self.eps_a)]
@@ -106,6 +199,72 @@ class FitParametersNewnsAnderson:
         alpha = [ abs(a) for a in alpha ]
         beta =  [ abs(b) for b in beta ]
 
+        return alpha, beta, constant_offset
+
+    def _evaluate_tasks(self, function, alpha, beta, constant_offset, eps_ds):
+        """Evaluate function for every metal and single particle state,
+        either serially or on the pool of worker processes. The results
+        are returned as an iterator, metal by metal and, for every metal,
+        in the order of the single particle states."""
+        # Choose the function to use for the repulsive
+        # contributions based on the type of repulsion used
+        if self.type_repulsion in [ 'linear', 'linear_mod' ]:
+            fitting_class = NewnsAndersonLinearRepulsion
+        elif self.type_repulsion == 'grimley':
+            fitting_class = NewnsAndersonGrimleyRepulsion
+        add_largeS_contribution = self.type_repulsion == 'linear_mod'
+
+        # Every metal and single particle state is an independent
+        # evaluation; collect them metal by metal
+        tasks = []
+        for i, eps_d in enumerate(eps_ds):
+            for eps_a, alpha_i, beta_i, constant_offset_i in zip(self.eps_a, alpha, beta, constant_offset):
+                tasks.append(dict(
+                    Vsd = self.Vsd[i],
+                    eps_a = eps_a,
+                    eps_d = eps_d,
+                    width = self.width[i],
+                    eps = self.eps,
+                    Delta0_mag = self.Delta0_mag,
+                    eps_sp_max = self.eps_sp_max,
+                    eps_sp_min = self.eps_sp_min,
+                    precision = self.precision,
+                    verbose = self.verbose,
+                    alpha = alpha_i,
+                    beta = beta_i,
+                    constant_offset = constant_offset_i,
+                    spin = self.spin,
+                    quadrature = self.quadrature,
+                    n_panels = self.n_panels,
+                    occupancy_engine = self.occupancy_engine,
+                    occupancy_tolerance = self.occupancy_tolerance,
+                    precision_policy = self.precision_policy,
+                    energy_tolerance = self.energy_tolerance,
+                    ))
+                if self.type_repulsion == 'grimley':
+                    tasks[-1]['single_pass'] = self.single_pass
+
+        if self.n_jobs > 1:
+            # map returns the results in the order of the tasks
+            results = self._get_executor().map(function,
+                                               [fitting_class] * len(tasks),
+                                               [add_largeS_contribution] * len(tasks),
+                                               tasks,
+                                               chunksize=max(1, len(tasks) // (4 * self.n_jobs)))
+        else:
+            results = map(function,
+                          [fitting_class] * len(tasks),
+                          [add_largeS_contribution] * len(tasks),
+                          tasks)
+        return iter(results)
+
+    def fit_parameters(self, args, eps_ds) -> np.ndarray:
+        """Fit parameters of alpha, beta and constant offset
+        of the NewnsAndersonModel including repulsive interations
+        to DFT energies."""
+
+        alpha, beta, constant_offset = self._parse_parameters(args)
+
         # Determine the chemisorption energy for the 
         # materials for which we have eps_d values
         chemi_energy = []
@@ -118,17 +277,10 @@ class FitParametersNewnsAnderson:
         # Store the filling
         filling_factor = []
 
-        for i, eps_d in enumerate(eps_ds):
-            Vsd = self.Vsd[i]
-            width = self.width[i]
-
-            # Choose the function to use for the repulsive
-            # contributions based on the type of repulsion used
-            if self.type_repulsion in [ 'linear', 'linear_mod' ]:
-                fitting_class = NewnsAndersonLinearRepulsion
-            elif self.type_repulsion == 'grimley':
-                fitting_class = NewnsAndersonGrimleyRepulsion
+        results = self._evaluate_tasks(_evaluate_chemisorption, alpha, beta,
+                                       constant_offset, eps_ds)
 
+        for i, eps_d in enumerate(eps_ds):
             # Iterate over each single particle state to get 
             # a different value of the energies.
             hyb_energy_i = []
@@ -137,42 +289,18 @@ class FitParametersNewnsAnderson:
             filling_i = []
             chemi_energy_i = []
 
-            for eps_a, alpha_i, beta_i, constant_offset_i in zip(self.eps_a, alpha, beta, constant_offset):
-                chemisorption = fitting_class( 
-                    Vsd = Vsd,
-                    eps_a = eps_a,
-                    eps_d = eps_d,
-                    width = width,
-                    eps = self.eps,
-                    Delta0_mag = self.Delta0_mag,
-                    eps_sp_max = self.eps_sp_max,
-                    eps_sp_min = self.eps_sp_min,
-                    precision = self.precision,
-                    verbose = self.verbose,
-                    alpha = alpha_i,
-                    beta = beta_i,
-                    constant_offset = constant_offset_i,
-                    spin = self.spin,
-                    )
-            
-                if self.type_repulsion == 'linear_mod':
-                    # Make sure that the largeS contribution is
-                    # used when the type of repulsion is linear_mod
-                    chemisorption.add_largeS_contribution = True
-                
+            for _ in self.eps_a:
+                e_chem, e_hyb, e_ortho, occupancy, filling = next(results)
                 # Store the chemisorption energy
-                e_chem = chemisorption.get_chemisorption_energy()
                 chemi_energy_i.append(e_chem)
                 # Store the hybridisation energies
-                e_hyb = chemisorption.get_hybridisation_energy() 
                 hyb_energy_i.append(e_hyb)
                 # Store the orthogonalisation energies
-                e_ortho = chemisorption.get_orthogonalisation_energy() 
                 ortho_energy_i.append(e_ortho)
                 # Store the occupancy
-                occ_i.append(chemisorption.get_occupancy())
+                occ_i.append(occupancy)
                 # Store the filling
-                filling_i.append(chemisorption.get_dband_filling())
+                filling_i.append(filling)
 
             # Store the energies
             if len(self.eps_a) > 1:
@@ -215,4 +343,35 @@ class FitParametersNewnsAnderson:
             print("constant_offset:", constant_offset)
             print("")
 
-        return chemi_energy
\ No newline at end of file
+        return chemi_energy
+
+    def jacobian(self, args, eps_ds) -> np.ndarray:
+        """Jacobian of fit_parameters with respect to args, that is, 
+        the alpha, beta and constant offset of every single particle
+        state. The derivatives are computed analytically by the models
+        instead of through finite differences of the energies. The
+        Jacobian has one row per parameter and one column per material,
+        which is the layout expected by fjacb in scipy.odr; least_squares
+        expects its transpose."""
+        alpha, beta, constant_offset = self._parse_parameters(args)
+        n_states = len(self.eps_a)
+        # The parameters enter the model through their absolute values
+        sign_alpha = np.where(np.asarray(args[0:n_states]) < 0, -1, 1)
+        sign_beta = np.where(np.asarray(args[n_states:2*n_states]) < 0, -1, 1)
+
+        results = self._evaluate_tasks(_evaluate_chemisorption_derivatives, alpha, beta,
+                                       constant_offset, eps_ds)
+
+        jacobian = np.zeros((3 * n_states, len(eps_ds)))
+        for i in range(len(eps_ds)):
+            # The energies of the single particle states are summed
+            for j in range(n_states):
+                derivatives = next(results)
+                jacobian[j, i] = sign_alpha[j] * derivatives['alpha']
+                jacobian[n_states + j, i] = sign_beta[j] * derivatives['beta']
+                jacobian[2 * n_states + j, i] = derivatives['constant_offset']
+
+        # Same treatment of bonds as the chemisorption energy
+        jacobian = np.multiply(jacobian, self.no_of_bonds)
+
+        return jacobian
@@ -0,0 +1,312 @@
+"""Newns-Anderson model with Gaussian, Lorentzian and skewed d-band shapes."""
+
+import copy
+from dataclasses import dataclass
+import math
+import numpy as np
+from scipy.special import ndtr, wofz
+from catchemi.NewnsAndersonNumerical import NewnsAndersonNumerical, find_zeros_green_function
+from catchemi.NewnsAndersonCache import model_cache
+from catchemi.NewnsAndersonInstrumentation import timed_stage
+
+# Shapes of Delta; 'semi_ellipse' is that of NewnsAndersonNumerical
+BAND_SHAPES = [ 'semi_ellipse', 'gaussian', 'lorentzian', 'skewed' ]
+# Number of points on which Lambda' is sampled to find where
+# eps - eps_a - Lambda decreases, see _find_zeros_green_function
+ZERO_SEARCH_POINTS = 4001
+# Resonances of the density of states narrower than this (in eV)
+# are integrated analytically, see _calculate_occupancy_float
+NARROW_PEAK_WIDTH = 1e-2
+# Relative step in Vak^2 of the central difference of the occupancy
+OCCUPANCY_DERIVATIVE_STEP = 1e-4
+
+
+def shape_parameters_from_moments(moments, shape='gaussian') -> dict:
+    """Parameters of NewnsAndersonShapeNumerical from the moments of a
+    projected density of states, as in examples/inputs/pdos_moments.json,
+    with the d_band_centre as eps_d and the width as width. The skewness of
+    the 'skewed' shape places the upper edge of its support at
+    d_band_upper_edge; it is clipped to [-1, 1], beyond which Delta would
+    become negative, so that the upper edge is only matched within
+    3/4 and 5/4 of the width above the d-band centre."""
+    assert shape in BAND_SHAPES, f"shape must be one of {BAND_SHAPES}."
+    parameters = { 'eps_d': moments['d_band_centre'], 'width': moments['width'],
+                   'shape': shape, 'skewness': 0.0 }
+    if shape == 'skewed':
+        # The upper edge is eps_d + wd ( 1 - skewness / 4 )
+        distance = ( moments['d_band_upper_edge'] - moments['d_band_centre'] ) / moments['width']
+        parameters['skewness'] = float(np.clip(4 * ( 1 - distance ), -1, 1))
+    return parameters
+
+
+@dataclass
+class NewnsAndersonShapeNumerical(NewnsAndersonNumerical):
+    """NewnsAndersonNumerical with a choice of the shape of Delta. Each
+    shape has an area of pi per unit coupling, as the semi-ellipse, and a
+    closed-form Hilbert transform, so that Delta and Lambda come from the
+    same complex function G = Lambda - i Delta on arrays of energies:
+
+    'semi_ellipse': the semi-ellipse of NewnsAndersonNumerical.
+    'gaussian': a Gaussian centred at eps_d with a standard deviation of
+        wd / 2, the same as that of the semi-ellipse, with G given by the
+        Faddeeva function.
+    'lorentzian': a Lorentzian centred at eps_d with a half width of wd / 2,
+        which has the same height as the semi-ellipse.
+    'skewed': the semi-ellipse of half width wd times ( 1 + skewness x ),
+        with x the reference energy within the band, for a skewness between
+        -1 and 1. A positive skewness moves the states to the top of the
+        band; the band is shifted so that eps_d remains the centre of Delta.
+
+    The zeros of eps - eps_a - Lambda, the integrals and the filling then go
+    through the machinery of NewnsAndersonNumerical in double precision, so
+    that occupancy_engine must be 'float' and precision_policy 'fixed'.
+    """
+
+    shape: str = 'gaussian'
+    skewness: float = 0.0
+    occupancy_engine: str = 'float'
+    RESULT_DEPENDENCIES = { result: dependencies | { 'shape', 'skewness' } for result, dependencies
+                            in NewnsAndersonNumerical.RESULT_DEPENDENCIES.items() }
+
+    def _validate_settings(self):
+        """Check the shape and the choice of the integration engines."""
+        super()._validate_settings()
+        assert self.shape in BAND_SHAPES, f"shape must be one of {BAND_SHAPES}."
+        assert -1 <= self.skewness <= 1, "skewness must be between -1 and 1."
+        assert self.skewness == 0 or self.shape == 'skewed', "Only the 'skewed' shape has a skewness."
+        # There are no arb versions of the shapes
+        assert self.occupancy_engine == 'float', "occupancy_engine must be 'float' for the band shapes."
+        assert self.precision_policy == 'fixed', "precision_policy must be 'fixed' for the band shapes."
+
+    def _update_derived_parameters(self, changed):
+        """Set the quantities that are derived from the changed parameters."""
+        super()._update_derived_parameters(changed)
+        if changed & { 'shape', 'skewness' }:
+            self._validate_settings()
+
+    def _get_cache_key(self, quantity) -> tuple:
+        """Key of a quantity in the model cache, including the shape."""
+        return super()._get_cache_key(quantity) + model_cache.make_key(self.shape, self.skewness)
+
+    def create_reference_eps(self, eps):
+        """Create the reference energy within the semi-ellipse underlying
+        the 'semi_ellipse' and 'skewed' shapes. For the latter the band
+        is shifted by - skewness wd / 4, the mean of x ( 1 + skewness x )."""
+        return ( eps - self.eps_d + self.skewness * self.wd / 4 ) / self.wd
+
+    def _get_band_edges(self) -> tuple:
+        """Edges of the support of Delta for the semi-ellipses and eps_d -+ wd,
+        which hold most of the states, for the Gaussian and the Lorentzian."""
+        centre = self.eps_d - self.skewness * self.wd / 4
+        return centre - self.wd, centre + self.wd
+
+    def _create_green_function_shape_vec(self, eps, order=0) -> np.ndarray:
+        """Create G = Lambda - i Delta for a unit coupling on an array of
+        energies, or its first or second derivative with respect to eps."""
+        eps = np.asarray(eps, dtype=float)
+        if self.shape == 'gaussian':
+            # G = -i sqrt(pi) / ( sigma sqrt(2) ) w(z) with z = ( eps - eps_d ) / ( sigma sqrt(2) )
+            scale = self.wd / 2 * np.sqrt(2)
+            z = ( eps - self.eps_d ) / scale
+            w = wofz(z)
+            # w' = - 2 z w + 2 i / sqrt(pi) and w'' = - 2 w - 2 z w'
+            w_prime = - 2 * z * w + 2j / np.sqrt(np.pi)
+            derivatives = [ w, w_prime, - 2 * w - 2 * z * w_prime ]
+            return -1j * np.sqrt(np.pi) / scale * derivatives[order] / scale**order
+        elif self.shape == 'lorentzian':
+            G = 1 / ( eps - self.eps_d + 0.5j * self.wd )
+            return [ G, - G**2, 2 * G**3 ][order]
+        else:
+            # The semi-ellipse of NewnsAndersonNumerical times ( 1 + skewness x )
+            x = self.create_reference_eps(eps)
+            Delta = super()._create_Delta_shape_vec(eps)
+            Lambda = super()._create_Lambda_shape_vec(eps)
+            if order == 0:
+                return ( 1 + self.skewness * x ) * ( Lambda - 1j * Delta ) - self.skewness / self.wd
+            Lambda_prime = super()._create_Lambda_shape_prime_vec(eps)
+            if order == 1:
+                return self.skewness / self.wd * Lambda + ( 1 + self.skewness * x ) * Lambda_prime
+            # The derivatives are only needed for Lambda, outside of the band
+            Lambda_second = super()._create_Lambda_shape_second_vec(eps)
+            return 2 * self.skewness / self.wd * Lambda_prime + ( 1 + self.skewness * x ) * Lambda_second
+
+    def _create_Delta_shape_vec(self, eps) -> np.ndarray:
+        """Create the shape of Delta for a unit coupling."""
+        return - self._create_green_function_shape_vec(eps).imag
+
+    def _create_Lambda_shape_vec(self, eps) -> np.ndarray:
+        """Create the hilbert transform of the shape of Delta for a unit coupling."""
+        return self._create_green_function_shape_vec(eps).real
+
+    def _create_Lambda_shape_prime_vec(self, eps) -> np.ndarray:
+        """Create the derivative of the hilbert transform for a unit coupling."""
+        return np.real(self._create_green_function_shape_vec(eps, order=1))
+
+    def _create_Lambda_shape_second_vec(self, eps) -> np.ndarray:
+        """Create the second derivative of the hilbert transform for a unit coupling."""
+        return np.real(self._create_green_function_shape_vec(eps, order=2))
+
+    def _create_green_function_shape_reg(self, eps) -> complex:
+        """Create G for a unit coupling at a single energy without arrays,
+        as quad calls the integrands one energy at a time."""
+        if self.shape == 'gaussian':
+            scale = self.wd / 2 * math.sqrt(2)
+            return -1j * math.sqrt(math.pi) / scale * complex(wofz(( eps - self.eps_d ) / scale))
+        elif self.shape == 'lorentzian':
+            return 1 / complex(eps - self.eps_d, self.wd / 2)
+        x = self.create_reference_eps(eps)
+        if abs(x) < 1:
+            G = complex(x, - math.sqrt(1 - x**2))
+        else:
+            G = x - math.copysign(math.sqrt(x**2 - 1), x)
+        return ( 1 + self.skewness * x ) * 2 * G / self.wd - self.skewness / self.wd
+
+    def _create_Delta_reg(self, eps) -> float:
+        """Create Delta for a single energy."""
+        return - self.Vak**2 * self._create_green_function_shape_reg(eps).imag
+
+    def _create_Lambda_reg(self, eps) -> float:
+        """Create Lambda for a single energy."""
+        return self.Vak**2 * self._create_green_function_shape_reg(eps).real
+
+    def _create_dos_reg(self, eps) -> float:
+        """Create the density of states at a single energy from one evaluation of G."""
+        G = self.Vak**2 * self._create_green_function_shape_reg(eps)
+        Delta = self._create_Delta0_reg(eps) - G.imag
+        return Delta / ( ( eps - self.eps_a - G.real )**2 + Delta**2 ) / math.pi
+
+    def _create_energy_integrand(self, eps) -> float:
+        """Create the energy integrand at a single energy from one evaluation of G."""
+        if eps > 0:
+            return 0.0
+        G = self.Vak**2 * self._create_green_function_shape_reg(eps)
+        Delta = self._create_Delta0_reg(eps) - G.imag
+        return math.atan2(Delta, eps - self.eps_a - G.real) - math.pi
+
+    @timed_stage('poles')
+    def _find_zeros_green_function(self) -> np.ndarray:
+        """Find the zeros of eps - eps_a - Lambda. The function decreases
+        only where Lambda' > 1, which for these shapes is a single interval
+        around the band if it exists at all, found by sampling Lambda' on
+        ZERO_SEARCH_POINTS energies. Below, within and above that interval
+        the function is monotonic, so that find_zeros_green_function finds
+        each of the up to three zeros from the interval as the 'band'."""
+        key = model_cache.make_key('zeros_green_function', type(self).__name__, self.shape,
+                                   self.skewness, self.Vak, self.eps_a, self.eps_d, self.wd,
+                                   self.eps_min, self.eps_max)
+        zeros = model_cache.get(key)
+        if zeros is None:
+            eps = np.linspace(self.eps_min, self.eps_max, ZERO_SEARCH_POINTS)
+            decreasing = eps[self._create_Lambda_prime_vec(eps) > 1]
+            if len(decreasing):
+                # One point beyond the sampled interval on either side
+                spacing = eps[1] - eps[0]
+                lower_edge = max(decreasing[0] - spacing, self.eps_min)
+                upper_edge = min(decreasing[-1] + spacing, self.eps_max)
+            else:
+                lower_edge = upper_edge = self.eps_d
+            zeros = find_zeros_green_function(self._create_pole_function, self.eps_min, self.eps_max,
+                                              lower_edge, upper_edge)
+            model_cache.put(key, zeros)
+        return zeros.copy()
+
+    def _calculate_filling(self) -> float:
+        """Calculate the filling from the elementary integrals of Delta and Delta0."""
+        self._convert_to_float()
+        def _integrate_Delta(lower, upper):
+            if self.shape == 'gaussian':
+                sigma = self.wd / 2
+                Delta = np.pi * ( ndtr(( upper - self.eps_d ) / sigma) - ndtr(( lower - self.eps_d ) / sigma) )
+            elif self.shape == 'lorentzian':
+                gamma = self.wd / 2
+                Delta = np.arctan(( upper - self.eps_d ) / gamma) - np.arctan(( lower - self.eps_d ) / gamma)
+            else:
+                # Antiderivatives of 2 sqrt(1 - x^2) ( 1 + skewness x ) in x
+                def antiderivative(eps):
+                    x = np.clip(self.create_reference_eps(eps), -1, 1)
+                    root = np.sqrt(1 - x**2)
+                    return x * root + np.arcsin(x) - 2 * self.skewness * root**3 / 3
+                Delta = antiderivative(upper) - antiderivative(lower)
+            overlap = min(upper, self.eps_sp_max) - max(lower, self.eps_sp_min)
+            return self.Vak**2 * Delta + self.Delta0_mag * max(overlap, 0.0)
+        self.filling = float(_integrate_Delta(self.eps_min, 0.0) / _integrate_Delta(self.eps_min, self.eps_max))
+        return self.filling
+
+    def _calculate_occupancy_float(self):
+        """Calculate the occupancy in double precision. The tails of the
+        Gaussian and the Lorentzian are never exactly zero, so that the
+        localised states become resonances of a width Delta / ( 1 - Lambda' )
+        that quad cannot resolve. Every zero of eps - eps_a - Lambda with a
+        resonance narrower than NARROW_PEAK_WIDTH is integrated as the
+        Lorentzian of that width, which is subtracted from the density of
+        states integrated with quad. For Delta = 0 this is the residue
+        1 / ( 1 - Lambda' ) of a localised state, as for the semi-ellipse."""
+        self._convert_to_float()
+        zeros = self.find_poles_green_function()
+        zeros = zeros[np.isfinite(zeros)]
+        Delta = self._create_Delta_vec(zeros) + self._create_Delta0_vec(zeros)
+        slope = 1 - self._create_Lambda_prime_vec(zeros)
+        narrow = ( slope > 0 ) & ( Delta < NARROW_PEAK_WIDTH * slope )
+        peaks = [ ( float(peak), float(width), float(slope) ) for peak, width, slope
+                  in zip(zeros[narrow], Delta[narrow], slope[narrow]) ]
+
+        def integrate_peaks(lower, upper):
+            # Integral of the Lorentzians Delta / ( ( slope ( eps - peak ) )^2 + Delta^2 ) / pi
+            return sum(( math.atan2(slope * ( upper - peak ), width) - math.atan2(slope * ( lower - peak ), width) )
+                       / slope for peak, width, slope in peaks) / math.pi
+
+        def integrand(eps):
+            dos = self._create_dos_reg(eps)
+            for peak, width, slope in peaks:
+                dos -= width / ( ( slope * ( eps - peak ) )**2 + width**2 ) / math.pi
+            return dos
+
+        lower_integration_bound = self.eps_min
+        upper_integration_bound = 0.0
+        points = list(zeros) + list(self._get_band_edges()) + [ self.eps_sp_min, self.eps_sp_max ]
+        points = [ point for point in points
+                   if lower_integration_bound < point < upper_integration_bound ]
+        if upper_integration_bound > lower_integration_bound:
+            occupancy, self.occupancy_error = self.recorder.quad('occupancy', integrand,
+                                                lower_integration_bound,
+                                                upper_integration_bound,
+                                                points = tuple(points) if points else None,
+                                                epsabs = self.occupancy_tolerance,
+                                                epsrel = self.occupancy_tolerance,
+                                                limit = 200)
+            occupancy += integrate_peaks(lower_integration_bound, upper_integration_bound)
+        else:
+            occupancy, self.occupancy_error = 0.0, 0.0
+        self._occupancy_integral = occupancy
+        self.occupancy = occupancy
+
+    def calculate_occupancy_derivative(self, parameter='Vak2') -> float:
+        """Calculate the derivative of the occupancy with respect to Vak^2.
+        The semi-ellipse uses the derivative of NewnsAndersonNumerical. For
+        the other shapes the narrow resonances, which the occupancy adds
+        back analytically, move and change their width with Vak^2, so the
+        occupancy is differentiated as a central difference with a relative
+        step of OCCUPANCY_DERIVATIVE_STEP, each side computed as the
+        occupancy itself."""
+        if self.shape == 'semi_ellipse':
+            return super().calculate_occupancy_derivative(parameter)
+        if parameter != 'Vak2':
+            raise ValueError(f'Cannot differentiate the occupancy with respect to {parameter}')
+        return self._calculate_occupancy_derivative_numerical()
+
+    @timed_stage('derivatives')
+    def _calculate_occupancy_derivative_numerical(self) -> float:
+        """Central difference of the occupancy in Vak^2."""
+        self._convert_to_float()
+        Vak2 = self.Vak**2
+        step = OCCUPANCY_DERIVATIVE_STEP * ( Vak2 if Vak2 > 0 else 1.0 )
+        # A forward difference if the step would make Vak^2 negative
+        Vak2_values = [ max(Vak2 - step, 0.0), Vak2 + step ]
+        occupancies = []
+        for value in Vak2_values:
+            # A copy, so that the occupancy of this model is not replaced
+            model = copy.copy(self)
+            model.Vak = math.sqrt(value)
+            model._calculate_occupancy_float()
+            occupancies.append(model.occupancy)
+        return float(( occupancies[1] - occupancies[0] ) / ( Vak2_values[1] - Vak2_values[0] ))
@@ -0,0 +1,255 @@
+"""Tabulate the chemisorption energy for fast lookup in screening studies."""
+
+from concurrent.futures import ProcessPoolExecutor
+import itertools
+import json
+import os
+import numpy as np
+from scipy.interpolate import RegularGridInterpolator
+from catchemi import NewnsAndersonLinearRepulsion, NewnsAndersonGrimleyRepulsion
+
+# Quantities stored in the table, one array each
+TABLE_QUANTITIES = [ 'chemisorption_energy', 'hybridisation_energy',
+                     'orthogonalisation_energy', 'occupancy' ]
+# Order of the axes of the table
+TABLE_AXES = [ 'eps_d', 'width', 'Vsd' ]
+# Name of the file with the axes and the parameters of a saved table
+TABLE_METADATA = 'table.json'
+
+
+def _evaluate_table_point(type_repulsion, model_kwargs, point) -> tuple:
+    """Evaluate the quantities of the table for one point (eps_d, width, Vsd).
+    Parameter sets for which the model fails are stored as nan."""
+    eps_d, width, Vsd = point
+    try:
+        if type_repulsion == 'grimley':
+            model = NewnsAndersonGrimleyRepulsion(Vsd=Vsd, eps_d=eps_d, width=width, **model_kwargs)
+        else:
+            model = NewnsAndersonLinearRepulsion(Vsd=Vsd, eps_d=eps_d, width=width,
+                                                 add_largeS_contribution=type_repulsion == 'linear_mod',
+                                                 **model_kwargs)
+        chemisorption_energy = model.get_chemisorption_energy()
+        return ( chemisorption_energy, float(np.real(model.hybridisation_energy)),
+                 float(model.orthogonalisation_energy.real), model.get_occupancy() )
+    except (AssertionError, ValueError, ArithmeticError):
+        return ( np.nan, ) * len(TABLE_QUANTITIES)
+
+
+class ChemisorptionTable:
+    """Table of the chemisorption energy, its components and the occupancy
+    of an adsorbate over a grid of d-band centres, widths and coupling
+    elements, interpolated with splines. A table is built once with build,
+    stored with save as a directory of .npy files and a JSON file, and
+    loaded with load, memory mapping the arrays.
+
+    axes: dict
+        Strictly increasing values of eps_d, width and Vsd of the grid.
+    values: dict
+        Arrays of the quantities in TABLE_QUANTITIES on the grid, of
+        shape ( len(eps_d), len(width), len(Vsd) ).
+    parameters: dict
+        Parameters of the adsorbate and of the model used to build the table.
+    error_bounds: dict
+        Largest difference between the table and the model at the
+        validation points for each quantity, if the table was validated.
+    method: str
+        Interpolation method of RegularGridInterpolator; 'cubic' by
+        default, 'linear' for the fastest queries. The splines cannot
+        pass through the points at which the model failed, so quantities
+        with nan on the grid are always interpolated linearly; queries
+        in the cells next to a failed point then return nan.
+    """
+
+    def __init__(self, axes, values, parameters, error_bounds=None, method='cubic'):
+        self.axes = { name: np.asarray(axes[name], dtype=float) for name in TABLE_AXES }
+        self.values = values
+        self.parameters = parameters
+        self.error_bounds = error_bounds if error_bounds is not None else {}
+        self.method = method
+        shape = tuple(len(self.axes[name]) for name in TABLE_AXES)
+        for name in TABLE_QUANTITIES:
+            assert self.values[name].shape == shape, f"{name} does not match the axes."
+        # The interpolators are set up on the first query of a quantity
+        self._interpolators = {}
+
+    @classmethod
+    def build(cls, eps_d, width, Vsd, eps_a, alpha, beta, Delta0_mag, eps,
+              type_repulsion='linear', constant_offset=0.0,
+              eps_sp_max=15, eps_sp_min=-15, precision=50, spin=2,
+              occupancy_engine='float', n_validation=100, n_jobs=1,
+              method='cubic', verbose=False, **model_kwargs):
+        """Build the table by evaluating NewnsAndersonLinearRepulsion
+        ('linear' and 'linear_mod', the latter with the large-S
+        contribution) or NewnsAndersonGrimleyRepulsion ('grimley') at every
+        point of the grid spanned by eps_d, width and Vsd. The occupancy is
+        integrated in double precision by default, as the interpolation error
+        of the table is far larger than that of the float integral.
+
+        The error bounds are the largest differences between the table and
+        the model at n_validation random points within the grid. The points
+        are evaluated over n_jobs worker processes; further keyword arguments
+        are passed on to the model."""
+        assert type_repulsion in ['linear', 'linear_mod', 'grimley'], \
+            "type_repulsion must be 'linear', 'linear_mod' or 'grimley'."
+        axes = { 'eps_d': eps_d, 'width': width, 'Vsd': Vsd }
+        for name, axis in axes.items():
+            axis = np.asarray(axis, dtype=float)
+            assert axis.ndim == 1 and len(axis) >= 4, f"{name} needs at least four points."
+            assert np.all(np.diff(axis) > 0), f"{name} must be strictly increasing."
+            axes[name] = axis
+
+        model_kwargs.update(eps_a=eps_a, alpha=alpha, beta=beta, Delta0_mag=Delta0_mag,
+                            eps=eps, eps_sp_max=eps_sp_max, eps_sp_min=eps_sp_min,
+                            precision=precision, spin=spin, occupancy_engine=occupancy_engine)
+        points = list(itertools.product(*[ axes[name] for name in TABLE_AXES ]))
+        if verbose:
+            print(f'Building a table of {len(points)} points')
+        results = cls._evaluate_points(type_repulsion, model_kwargs, points, n_jobs)
+
+        shape = tuple(len(axes[name]) for name in TABLE_AXES)
+        values = { name: results[:, i].reshape(shape) for i, name in enumerate(TABLE_QUANTITIES) }
+        failed = np.any(np.isnan(results), axis=1)
+        failed_points = int(np.sum(failed))
+        if verbose and failed_points:
+            print(f'The model failed at {failed_points} points (eps_d, width, Vsd), stored as nan:')
+            for point in np.array(points)[failed]:
+                print(f'  {tuple(float(x) for x in point)}')
+
+        parameters = {
+            'type_repulsion': type_repulsion,
+            'eps_a': eps_a,
+            'alpha': alpha,
+            'beta': beta,
+            'Delta0_mag': Delta0_mag,
+            'constant_offset': constant_offset,
+            'eps_min': float(np.min(eps)),
+            'eps_max': float(np.max(eps)),
+            'n_eps': len(eps),
+            'eps_sp_max': eps_sp_max,
+            'eps_sp_min': eps_sp_min,
+            'precision': precision,
+            'spin': spin,
+            'occupancy_engine': occupancy_engine,
+            'failed_points': failed_points,
+        }
+        parameters.update({ key: value for key, value in model_kwargs.items()
+                            if key not in parameters and key != 'eps' })
+        table = cls(axes, values, parameters, method=method)
+
+        if n_validation > 0:
+            # Random points within the grid, reproducible between builds
+            random_state = np.random.default_rng(0)
+            validation_points = np.column_stack([ random_state.uniform(axes[name][0], axes[name][-1], n_validation)
+                                                  for name in TABLE_AXES ])
+            reference = cls._evaluate_points(type_repulsion, model_kwargs, validation_points, n_jobs)
+            for i, name in enumerate(TABLE_QUANTITIES):
+                # Points at which the model or the table is nan are skipped
+                difference = np.abs(table._interpolate(name, validation_points) - reference[:, i])
+                difference = difference[np.isfinite(difference)]
+                table.error_bounds[name] = float(np.max(difference)) if len(difference) else np.nan
+            if verbose:
+                print(f'Error bounds of the table: {table.error_bounds}')
+
+        return table
+
+    @staticmethod
+    def _evaluate_points(type_repulsion, model_kwargs, points, n_jobs) -> np.ndarray:
+        """Evaluate the quantities of the table at a list of points, serially
+        or over a pool of worker processes; one row per point."""
+        assert n_jobs >= 1, "n_jobs must be at least one."
+        arguments = ( itertools.repeat(type_repulsion), itertools.repeat(model_kwargs), points )
+        if n_jobs == 1:
+            results = list(map(_evaluate_table_point, *arguments))
+        else:
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                results = list(executor.map(_evaluate_table_point, *arguments,
+                                            chunksize=max(1, len(points) // ( 4 * n_jobs ))))
+        return np.array(results, dtype=float).reshape(len(points), len(TABLE_QUANTITIES))
+
+    def save(self, directory):
+        """Store the table as one .npy file per quantity and a JSON
+        file with the axes, the parameters and the error bounds."""
+        os.makedirs(directory, exist_ok=True)
+        for name in TABLE_QUANTITIES:
+            np.save(os.path.join(directory, f'{name}.npy'), np.asarray(self.values[name]))
+        metadata = {
+            'axes': { name: self.axes[name].tolist() for name in TABLE_AXES },
+            'parameters': self.parameters,
+            'error_bounds': self.error_bounds,
+        }
+        with open(os.path.join(directory, TABLE_METADATA), 'w') as handle:
+            json.dump(metadata, handle, indent=2, default=float)
+
+    @classmethod
+    def load(cls, directory, mmap=True, method='cubic'):
+        """Load a table stored with save. With mmap the arrays are memory
+        mapped, so that processes reading the same table share its pages."""
+        with open(os.path.join(directory, TABLE_METADATA)) as handle:
+            metadata = json.load(handle)
+        values = { name: np.load(os.path.join(directory, f'{name}.npy'),
+                                 mmap_mode='r' if mmap else None)
+                   for name in TABLE_QUANTITIES }
+        return cls(metadata['axes'], values, metadata['parameters'],
+                   metadata['error_bounds'], method=method)
+
+    def _get_method(self, name, method=None) -> str:
+        """Interpolation method of a quantity: method, by default that of
+        the table, or 'linear' if the quantity has failed points."""
+        method = method or self.method
+        if method != 'linear' and not np.all(np.isfinite(self.values[name])):
+            method = 'linear'
+        return method
+
+    def _get_interpolator(self, name, method) -> RegularGridInterpolator:
+        """Get the interpolator of a quantity, creating it on first use."""
+        method = self._get_method(name, method)
+        if ( name, method ) not in self._interpolators:
+            self._interpolators[( name, method )] = RegularGridInterpolator(
+                [ self.axes[axis] for axis in TABLE_AXES ], self.values[name], method=method)
+        return self._interpolators[( name, method )]
+
+    def _interpolate(self, name, points, method=None) -> np.ndarray:
+        """Interpolate a quantity at an array of points (eps_d, width, Vsd)."""
+        return self._get_interpolator(name, method)(points)
+
+    def _query(self, name, eps_d, width, Vsd, return_error):
+        """Interpolate a quantity at any eps_d, width and Vsd that broadcast
+        against each other. Points outside of the grid raise a ValueError.
+        The error estimate is the difference to the linear interpolation,
+        which bounds the error of the cubic interpolation where the quantity
+        is smooth on the scale of the grid."""
+        eps_d, width, Vsd = np.broadcast_arrays(*[ np.asarray(x, dtype=float)
+                                                   for x in ( eps_d, width, Vsd ) ])
+        points = np.stack([ eps_d.ravel(), width.ravel(), Vsd.ravel() ], axis=-1)
+        quantity = self._interpolate(name, points)
+        if return_error:
+            error = np.abs(quantity - self._interpolate(name, points, 'linear'))
+        if name == 'chemisorption_energy':
+            # The constant offset is not part of the table
+            quantity = quantity + self.parameters['constant_offset']
+
+        if eps_d.ndim == 0:
+            quantity = float(quantity[0])
+            error = float(error[0]) if return_error else None
+        else:
+            quantity = quantity.reshape(eps_d.shape)
+            error = error.reshape(eps_d.shape) if return_error else None
+        return ( quantity, error ) if return_error else quantity
+
+    def get_chemisorption_energy(self, eps_d, width, Vsd, return_error=False):
+        """Get the chemisorption energy, including the constant offset.
+        With return_error, an estimate of the interpolation error is also
+        returned; the bound over the whole table is in error_bounds."""
+        return self._query('chemisorption_energy', eps_d, width, Vsd, return_error)
+
+    def get_hybridisation_energy(self, eps_d, width, Vsd, return_error=False):
+        """Get the hybridisation energy."""
+        return self._query('hybridisation_energy', eps_d, width, Vsd, return_error)
+
+    def get_orthogonalisation_energy(self, eps_d, width, Vsd, return_error=False):
+        """Get the orthogonalisation energy."""
+        return self._query('orthogonalisation_energy', eps_d, width, Vsd, return_error)
+
+    def get_occupancy(self, eps_d, width, Vsd, return_error=False):
+        """Get the occupancy of the single particle state."""
+        return self._query('occupancy', eps_d, width, Vsd, return_error)
@@ -0,0 +1,338 @@
+"""Newns-Anderson model with Delta tabulated on an energy grid."""
+
+import numpy as np
+from catchemi.NewnsAndersonInstrumentation import instrumentation, timed_stage
+
+
+def hilbert_transform_fft(Delta) -> np.ndarray:
+    """Hilbert transform (1/pi) P int Delta(t) / ( eps - t ) dt of Delta
+    tabulated on a uniform grid, at the points of the grid. Delta is taken
+    to be linear between the points and zero outside of the grid, so that
+    the transform is the discrete convolution of Delta with the transform of
+    a triangle, K(m) = (m+1) ln|m+1| - 2m ln|m| + (m-1) ln|m-1| for points m
+    apart, independently of the spacing. The convolution is done with FFTs
+    long enough that it does not wrap around, in O(N log N)."""
+    Delta = np.asarray(Delta, dtype=float)
+    n = len(Delta)
+    # x ln|x| with its limit of 0 at x = 0
+    def xlogx(x):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(x == 0, 0.0, x * np.log(np.abs(x)))
+    m = np.arange(-(n - 1), n, dtype=float)
+    kernel = xlogx(m + 1) - 2 * xlogx(m) + xlogx(m - 1)
+
+    n_fft = 1 << ( 3 * n - 3 ).bit_length()
+    convolution = np.fft.irfft(np.fft.rfft(Delta, n_fft) * np.fft.rfft(kernel, n_fft), n_fft)
+    # The kernel starts at m = -(n - 1)
+    return convolution[n - 1:2 * n - 1] / np.pi
+
+
+def _integrate_cells(eps, Delta, energy_difference, quantity) -> float:
+    """Integrate over the cells of a grid either the density of states
+    Delta / ( D^2 + Delta^2 ) ('occupancy'), without the factor 1/pi, or
+    arctan2(Delta, D) ('energy'), with D = eps - eps_a - Lambda. Within a
+    cell Delta is taken as constant and D as linear, for which both
+    integrals are elementary. This keeps the integrals exact for resonances
+    much narrower than the cells, and for Delta = 0 it gives the weight
+    1 / D' of a localised state where D changes sign, so that the poles
+    do not have to be located first."""
+    width = np.diff(eps)
+    D_lower = energy_difference[:-1]
+    D_upper = energy_difference[1:]
+    Delta_cell = 0.5 * ( Delta[:-1] + Delta[1:] )
+    D_cell = 0.5 * ( D_lower + D_upper )
+    slope = D_upper - D_lower
+
+    if quantity == 'occupancy':
+        # Antiderivative with respect to D
+        antiderivative = lambda D: np.arctan2(D, Delta_cell)
+        flat = Delta_cell / ( D_cell**2 + Delta_cell**2 )
+    else:
+        def antiderivative(D):
+            with np.errstate(divide='ignore', invalid='ignore'):
+                logarithm = np.where(Delta_cell > 0, 0.5 * Delta_cell * np.log(D**2 + Delta_cell**2), 0.0)
+            return np.pi / 2 * D - D * np.arctan2(D, Delta_cell) + logarithm
+        flat = np.arctan2(Delta_cell, D_cell)
+
+    # Where D barely changes, the difference of the antiderivatives
+    # loses its precision and the integrand is constant over the cell
+    is_flat = np.abs(slope) <= 1e-7 * ( 1 + np.abs(D_cell) + Delta_cell )
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cells = np.where(is_flat, width * flat,
+                         width * ( antiderivative(D_upper) - antiderivative(D_lower) ) / slope)
+    return float(np.sum(cells))
+
+
+class NewnsAndersonTabulated:
+    """Newns-Anderson model for a Delta tabulated on a uniform energy grid,
+    for example the projected d-density of states of a DFT calculation,
+    instead of a semi-ellipse. Lambda is the Hilbert transform of Delta,
+    computed once with FFTs when the model is created. The occupancy, the
+    hybridisation energy, the filling and the poles are then computed on
+    the grid in O(N), so that changing eps_a, Vak or Delta0_mag with
+    update does not redo the transform.
+
+    eps: list
+        Uniform, increasing energy grid on which Delta is tabulated; it is
+        also the range of the integrals, as eps is for NewnsAndersonNumerical.
+    Delta: list
+        Delta per unit coupling on eps, e.g. the projected d-density of states.
+        Delta is taken to vanish outside of the grid.
+    eps_a: float
+        Renormalised energy of the adsorbate.
+    Vak: float
+        Coupling element; Delta is multiplied by Vak^2.
+    Delta0_mag: float
+        Augmentation of the sp states into the d-states, constant
+        between eps_sp_min and eps_sp_max.
+    normalise: bool
+        If True, Delta is scaled to an area of pi, which is that of the
+        semi-ellipse of NewnsAndersonNumerical, so that Vak has the same
+        meaning in both models.
+    """
+
+    NUMERICAL_NOISE_THRESHOLD = 1e-2
+    # Parameters on which every result depends, as for NewnsAndersonNumerical
+    RESULT_DEPENDENCIES = {
+        'hybridisation_energy': { 'eps_a', 'Vak', 'Delta0_mag', 'eps_sp_min', 'eps_sp_max', 'spin' },
+        'occupancy': { 'eps_a', 'Vak', 'Delta0_mag', 'eps_sp_min', 'eps_sp_max' },
+        'filling': { 'Vak', 'Delta0_mag', 'eps_sp_min', 'eps_sp_max' },
+    }
+
+    def __init__(self, eps, Delta, eps_a, Vak=1.0, Delta0_mag=0.0,
+                 eps_sp_max=15, eps_sp_min=-15, spin=2,
+                 normalise=True, verbose=False):
+        self.eps = np.asarray(eps, dtype=float)
+        self.Delta_shape = np.asarray(Delta, dtype=float)
+        assert self.eps.ndim == 1 and len(self.eps) >= 3, "eps must be a grid of at least three points."
+        assert self.Delta_shape.shape == self.eps.shape, "Delta must be tabulated on eps."
+        assert np.all(self.Delta_shape >= 0), "Delta must not be negative."
+        self.spacing = ( self.eps[-1] - self.eps[0] ) / ( len(self.eps) - 1 )
+        assert self.spacing > 0 and np.allclose(np.diff(self.eps), self.spacing, rtol=1e-6, atol=0), \
+            "eps must be a uniform, increasing grid."
+        self.eps_min = self.eps[0]
+        self.eps_max = self.eps[-1]
+        if normalise:
+            self.Delta_shape = self.Delta_shape * np.pi / self._integrate_trapezoid(self.Delta_shape)
+
+        self.eps_a = eps_a
+        self.Vak = Vak
+        self.Delta0_mag = Delta0_mag
+        self.eps_sp_max = eps_sp_max
+        self.eps_sp_min = eps_sp_min
+        self.spin = spin
+        self.verbose = verbose
+        self.recorder = instrumentation.get_recorder(self)
+
+        self.Lambda_shape = self._calculate_Lambda_shape()
+
+        self.hybridisation_energy = None
+        self.occupancy = None
+        self.filling = None
+
+    @timed_stage('grid')
+    def _calculate_Lambda_shape(self) -> np.ndarray:
+        """Hilbert transform of Delta per unit coupling on the grid."""
+        return hilbert_transform_fft(self.Delta_shape)
+
+    def update(self, **parameters):
+        """Change parameters of the model in place, discarding only the
+        results that depend on them, see NewnsAndersonNumerical.update.
+        Returns the model, so that calls can be chained."""
+        updatable = set().union(*self.RESULT_DEPENDENCIES.values()) | { 'verbose' }
+        changed = set()
+        for name, value in parameters.items():
+            assert name in updatable, f"{name} cannot be updated."
+            if getattr(self, name) != value:
+                setattr(self, name, value)
+                changed.add(name)
+        self._update_derived_parameters(changed)
+        for result, dependencies in self.RESULT_DEPENDENCIES.items():
+            if changed & dependencies:
+                setattr(self, result, None)
+        return self
+
+    def _update_derived_parameters(self, changed):
+        """Set the quantities that are derived from the changed parameters."""
+        pass
+
+    def _integrate_trapezoid(self, values) -> float:
+        """Integrate values on the grid with the trapezoidal rule."""
+        return float(self.spacing * ( np.sum(values) - 0.5 * ( values[0] + values[-1] ) ))
+
+    def _create_Delta0_vec(self, eps) -> np.ndarray:
+        """Create Delta0 on an array of energies."""
+        in_sp_band = ( eps > self.eps_sp_min ) & ( eps < self.eps_sp_max )
+        return np.where(in_sp_band, self.Delta0_mag, 0.0)
+
+    def get_Delta_on_grid(self) -> np.ndarray:
+        """Get Delta, including Delta0, on the grid."""
+        return self.Vak**2 * self.Delta_shape + self._create_Delta0_vec(self.eps)
+
+    def get_Lambda_on_grid(self) -> np.ndarray:
+        """Get the Hilbert transform of Delta on the grid. As in
+        NewnsAndersonNumerical, Delta0 has no Hilbert transform."""
+        return self.Vak**2 * self.Lambda_shape
+
+    def get_energy_diff_on_grid(self) -> np.ndarray:
+        """Get eps - eps_a - Lambda on the grid."""
+        return self.eps - self.eps_a - self.get_Lambda_on_grid()
+
+    def get_dos_on_grid(self) -> np.ndarray:
+        """Get the density of states of the adsorbate on the grid."""
+        Delta = self.get_Delta_on_grid()
+        energy_difference = self.get_energy_diff_on_grid()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            dos = Delta / ( energy_difference**2 + Delta**2 ) / np.pi
+        return np.nan_to_num(dos, nan=0.0, posinf=0.0)
+
+    @timed_stage('poles')
+    def find_poles_green_function(self) -> np.ndarray:
+        """Find the energies at which eps - eps_a - Lambda vanishes, by
+        linear interpolation between the points of the grid where it
+        changes sign. These are the poles of the green function where
+        Delta vanishes. Returns all of them, in increasing order."""
+        energy_difference = self.get_energy_diff_on_grid()
+        lower = energy_difference[:-1]
+        upper = energy_difference[1:]
+        crossing = np.nonzero(( lower <= 0 ) & ( upper > 0 ) | ( lower > 0 ) & ( upper <= 0 ))[0]
+        fraction = lower[crossing] / ( lower[crossing] - upper[crossing] )
+        self.poles = self.eps[crossing] + fraction * self.spacing
+        if self.verbose:
+            print(f'Poles of the green function:{self.poles}')
+        return self.poles
+
+    def _get_grid_below_fermi_level(self) -> tuple:
+        """The grid up to the Fermi level, with the Fermi level added as
+        the last point, and Delta and eps - eps_a - Lambda on it."""
+        Delta = self.get_Delta_on_grid()
+        energy_difference = self.get_energy_diff_on_grid()
+        below = self.eps < 0
+        if not np.any(below):
+            return self.eps[:0], Delta[:0], energy_difference[:0]
+        if self.eps_max <= 0:
+            return self.eps, Delta, energy_difference
+        # Delta and Lambda are linear between the points of the grid
+        eps = np.append(self.eps[below], 0.0)
+        Delta_fermi = self.Vak**2 * np.interp(0.0, self.eps, self.Delta_shape) \
+                    + self._create_Delta0_vec(np.array(0.0))
+        Lambda_fermi = self.Vak**2 * np.interp(0.0, self.eps, self.Lambda_shape)
+        return eps, np.append(Delta[below], Delta_fermi), \
+               np.append(energy_difference[below], -self.eps_a - Lambda_fermi)
+
+    def get_hybridisation_energy(self) -> float:
+        """Get the hybridisation energy."""
+        if self.hybridisation_energy is None:
+            self.calculate_hybridisation_energy()
+        return self.hybridisation_energy
+
+    def get_occupancy(self) -> float:
+        """Get the occupancy of the single particle state."""
+        if self.occupancy is None:
+            self.calculate_occupancy()
+        return self.occupancy
+
+    @timed_stage('filling')
+    def get_dband_filling(self) -> float:
+        """Get the filling of the d-band, as for NewnsAndersonNumerical the
+        integral of Delta and Delta0 up to the Fermi level over that on the
+        whole grid; the integrals of Delta0 are elementary."""
+        if self.filling is None:
+            eps, _, _ = self._get_grid_below_fermi_level()
+            Delta_shape = np.interp(eps, self.eps, self.Delta_shape)
+            numerator = self.Vak**2 * np.sum(np.diff(eps) * 0.5 * ( Delta_shape[:-1] + Delta_shape[1:] ))
+            denominator = self.Vak**2 * self._integrate_trapezoid(self.Delta_shape)
+            def overlap(lower, upper):
+                return max(min(upper, self.eps_sp_max) - max(lower, self.eps_sp_min), 0.0)
+            numerator += self.Delta0_mag * overlap(self.eps_min, min(0.0, self.eps_max))
+            denominator += self.Delta0_mag * overlap(self.eps_min, self.eps_max)
+            self.filling = float(numerator / denominator)
+        return self.filling
+
+    @timed_stage('occupancy')
+    def calculate_occupancy(self):
+        """Calculate the occupancy as the integral of the density of states
+        up to the Fermi level, including the localised states."""
+        eps, Delta, energy_difference = self._get_grid_below_fermi_level()
+        self.recorder.count('occupancy_evaluations', len(eps))
+        self.occupancy = _integrate_cells(eps, Delta, energy_difference, 'occupancy') / np.pi
+        if self.verbose:
+            print(f'Single particle occupancy: {self.occupancy}')
+
+    @timed_stage('energy')
+    def calculate_hybridisation_energy(self):
+        """Calculate the hybridisation energy from the integral of
+        arctan2(Delta, eps - eps_a - Lambda) - pi up to the Fermi level."""
+        eps, Delta, energy_difference = self._get_grid_below_fermi_level()
+        self.recorder.count('energy_evaluations', len(eps))
+        delta_E_ = _integrate_cells(eps, Delta, energy_difference, 'energy')
+        delta_E_ -= np.pi * ( eps[-1] - eps[0] ) if len(eps) else 0.0
+
+        self.hybridisation_energy = delta_E_ * self.spin / np.pi
+        self.hybridisation_energy -= self.spin * self.eps_a
+        # Same treatment of the numerical noise as NewnsAndersonNumerical
+        if 0 < self.hybridisation_energy < self.NUMERICAL_NOISE_THRESHOLD:
+            self.hybridisation_energy = 0
+        if self.verbose:
+            print(f'Energy of the system: {self.hybridisation_energy} eV')
+
+    def get_statistics(self) -> dict:
+        """Get the counts and the timings of the stages, if the
+        instrumentation was enabled when the model was created."""
+        return self.recorder.get_statistics()
+
+
+class NewnsAndersonTabulatedLinearRepulsion(NewnsAndersonTabulated):
+    """Counterpart of NewnsAndersonLinearRepulsion for a tabulated Delta:
+    the hybridisation energy plus the linear orthogonalisation energy
+    spin ( n_a + f ) alpha Vak^2, with Vak^2 = beta Vsd^2. The large-S
+    contribution needs the d-band centre and is not available."""
+
+    RESULT_DEPENDENCIES = { result: dependencies - { 'Vak' } | { 'Vsd', 'beta' } for result, dependencies
+                            in NewnsAndersonTabulated.RESULT_DEPENDENCIES.items() }
+    RESULT_DEPENDENCIES['orthogonalisation_energy'] = set().union(*RESULT_DEPENDENCIES.values()) | { 'alpha' }
+    RESULT_DEPENDENCIES['chemisorption_energy'] = RESULT_DEPENDENCIES['orthogonalisation_energy'] \
+                                                | { 'constant_offset' }
+
+    def __init__(self, eps, Delta, eps_a, Vsd, alpha=0.0, beta=0.0, constant_offset=0.0,
+                 Delta0_mag=0.0, eps_sp_max=15, eps_sp_min=-15, spin=2,
+                 normalise=True, verbose=False):
+        assert alpha >= 0.0, "alpha must be positive."
+        assert beta >= 0.0, "beta must be positive."
+        super().__init__(eps, Delta, eps_a, np.sqrt(beta) * Vsd, Delta0_mag,
+                         eps_sp_max, eps_sp_min, spin, normalise, verbose)
+        self.Vsd = Vsd
+        self.alpha = alpha
+        self.beta = beta
+        self.constant_offset = constant_offset
+        self.chemisorption_energy = None
+        self.orthogonalisation_energy = None
+
+    def _update_derived_parameters(self, changed):
+        """Set Vak from the updated Vsd and beta."""
+        assert self.alpha >= 0.0, "alpha must be positive."
+        assert self.beta >= 0.0, "beta must be positive."
+        if changed & { 'Vsd', 'beta' }:
+            self.Vak = np.sqrt(self.beta) * self.Vsd
+
+    @timed_stage('chemisorption')
+    def compute_chemisorption_energy(self):
+        """Compute the chemisorption energy as the sum of the
+        hybridisation and the orthogonalisation energies."""
+        occupancy = self.get_occupancy()
+        filling = self.get_dband_filling()
+        self.orthogonalisation_energy = self.spin * ( occupancy + filling ) * self.alpha * self.Vak**2
+        self.chemisorption_energy = self.get_hybridisation_energy() + self.orthogonalisation_energy
+        self.chemisorption_energy += self.constant_offset
+
+    def get_chemisorption_energy(self) -> float:
+        """Get the chemisorption energy."""
+        if self.chemisorption_energy is None:
+            self.compute_chemisorption_energy()
+        return float(self.chemisorption_energy)
+
+    def get_orthogonalisation_energy(self) -> float:
+        """Get the orthogonalisation energy."""
+        if self.orthogonalisation_energy is None:
+            self.compute_chemisorption_energy()
+        return float(self.orthogonalisation_energy)
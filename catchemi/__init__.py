@@ -1,8 +1,60 @@
 # Newns-Anderson equations implementations
-from catchemi.NewnsAndersonAnalytical import NewnsAndersonAnalytical
-from catchemi.NewnsAndersonNumerical import NewnsAndersonNumerical
-from catchemi.NewnsAndersonGrimley import NewnsAndersonGrimleyNumerical
-from catchemi.NewnsAndersonLinearRepulsion import NewnsAndersonLinearRepulsion
-from catchemi.NewnsAndersonGrimleyRepulsion import NewnsAndersonGrimleyRepulsion
-from catchemi.NewnsAndersonRepulsion import FitParametersNewnsAnderson
-from catchemi.NewnsAndersonDerivatives import NewnsAndersonDerivativeEpsd
\ No newline at end of file
+# The modules are imported when one of their names is first used, so that
+# importing catchemi does not load python-flint and scipy for the models
+# that are not used (PEP 562)
+import importlib
+import sys
+import types
+
+# Module in which each of the public names is defined
+_NAMES = {
+    'NewnsAndersonAnalytical': 'NewnsAndersonAnalytical',
+    'NewnsAndersonNumerical': 'NewnsAndersonNumerical',
+    'NewnsAndersonGrimleyNumerical': 'NewnsAndersonGrimley',
+    'NewnsAndersonLinearRepulsion': 'NewnsAndersonLinearRepulsion',
+    'NewnsAndersonGrimleyRepulsion': 'NewnsAndersonGrimleyRepulsion',
+    'FitParametersNewnsAnderson': 'NewnsAndersonRepulsion',
+    'FitAdsorbatesNewnsAnderson': 'NewnsAndersonFitting',
+    'NewnsAndersonDerivativeEpsd': 'NewnsAndersonDerivatives',
+    'ChemisorptionTable': 'NewnsAndersonTable',
+    'NewnsAndersonBatch': 'NewnsAndersonBatch',
+    'NewnsAndersonLinearRepulsionBatch': 'NewnsAndersonBatch',
+    'NewnsAndersonShapeNumerical': 'NewnsAndersonShapes',
+    'shape_parameters_from_moments': 'NewnsAndersonShapes',
+    'NewnsAndersonTabulated': 'NewnsAndersonTabulated',
+    'NewnsAndersonTabulatedLinearRepulsion': 'NewnsAndersonTabulated',
+    'ModelCache': 'NewnsAndersonCache',
+    'model_cache': 'NewnsAndersonCache',
+    'Instrumentation': 'NewnsAndersonInstrumentation',
+    'instrumentation': 'NewnsAndersonInstrumentation',
+}
+
+__all__ = list(_NAMES)
+
+
+def __getattr__(name):
+    """Import the module of a public name on its first use."""
+    if name not in _NAMES:
+        raise AttributeError(f"module 'catchemi' has no attribute '{name}'")
+    value = getattr(importlib.import_module(f'catchemi.{_NAMES[name]}'), name)
+    # Later lookups find the name without calling __getattr__
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
+
+
+class _Package(types.ModuleType):
+    """The import system binds every imported submodule as an attribute
+    of the package. Most classes share the name of their module, so bind
+    the class instead, as when the modules were imported eagerly."""
+
+    def __setattr__(self, name, value):
+        if isinstance(value, types.ModuleType) and _NAMES.get(name) == name:
+            value = getattr(value, name)
+        super().__setattr__(name, value)
+
+
+sys.modules[__name__].__class__ = _Package
@@ -0,0 +1,343 @@
+"""Command line interface of CatChemi for screening materials."""
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import itertools
+import json
+import math
+import os
+import click
+import numpy as np
+import yaml
+from catchemi import NewnsAndersonLinearRepulsion, NewnsAndersonGrimleyRepulsion
+from catchemi.NewnsAndersonRepulsion import _evaluate_chemisorption
+
+# Properties of a material read from the input
+MATERIAL_FIELDS = [ 'eps_d', 'width', 'Vsd', 'no_of_bonds' ]
+# Parameters of the adsorbate, one value per single particle state
+STATE_FIELDS = [ 'eps_a', 'alpha', 'beta', 'constant_offset' ]
+# Formats that can be streamed, by extension
+FORMATS = { '.csv': 'csv', '.jsonl': 'jsonl', '.ndjson': 'jsonl' }
+# Suffix of the file storing the settings of a screening run next to its output
+SETTINGS_SUFFIX = '.settings.json'
+
+
+def _get_format(filename, file_format=None) -> str:
+    """Get the format of a file, either as given or from its extension."""
+    if file_format is not None:
+        return file_format
+    extension = os.path.splitext(filename)[1].lower()
+    if extension not in FORMATS:
+        raise click.BadParameter(f'cannot guess the format of {filename}, '
+                                 f'use an extension in {list(FORMATS)} or give the format.')
+    return FORMATS[extension]
+
+
+def read_materials(filename, file_format=None):
+    """Stream the materials of a CSV or JSON Lines file one at a time,
+    so that the whole file is never held in memory. Every material is a
+    dict of the raw values in the file; lines that are not valid JSON are
+    passed on with an error, so that the count of the rows is kept."""
+    file_format = _get_format(filename, file_format)
+    with open(filename, newline='') as handle:
+        if file_format == 'csv':
+            for row in csv.DictReader(handle):
+                yield row
+        else:
+            for line in handle:
+                if not line.strip():
+                    continue
+                try:
+                    material = json.loads(line)
+                except json.JSONDecodeError as error:
+                    material = {'error': f'invalid JSON: {error}'}
+                if not isinstance(material, dict):
+                    material = {'error': 'every line must be a JSON object'}
+                yield material
+
+
+def get_output_fields(n_states) -> list:
+    """Columns of the output; the occupancy is reported for every single
+    particle state, numbered from 1 if there is more than one."""
+    if n_states == 1:
+        occupancies = [ 'occupancy' ]
+    else:
+        occupancies = [ f'occupancy_{i+1}' for i in range(n_states) ]
+    return [ 'index', 'name' ] + MATERIAL_FIELDS \
+         + [ 'chemisorption_energy', 'hybridisation_energy', 'orthogonalisation_energy' ] \
+         + occupancies + [ 'filling', 'error' ]
+
+
+def evaluate_material(settings, index, material) -> dict:
+    """Evaluate the model for one material. As in FitParametersNewnsAnderson,
+    the energies are summed over the single particle states and multiplied
+    with the number of bonds. If the material cannot be read or the model
+    fails, the energies are nan and the reason is stored as the error."""
+    n_states = len(settings['states'])
+    fields = get_output_fields(n_states)
+    result = dict.fromkeys(fields, math.nan)
+    result.update(index=index, name=material.get(settings['id_column'], ''), error='')
+
+    if settings['type_repulsion'] == 'grimley':
+        fitting_class = NewnsAndersonGrimleyRepulsion
+    else:
+        fitting_class = NewnsAndersonLinearRepulsion
+    add_largeS_contribution = settings['type_repulsion'] == 'linear_mod'
+
+    try:
+        if material.get('error'):
+            raise ValueError(material['error'])
+        for field in MATERIAL_FIELDS:
+            value = material.get(field)
+            if field == 'no_of_bonds' and value in ( None, '' ):
+                # A single bond unless stated otherwise
+                value = 1
+            if value in ( None, '' ):
+                raise ValueError(f'{field} is missing')
+            result[field] = float(value)
+
+        eps = np.linspace(*settings['eps'])
+        energies = np.zeros(3)
+        for i, state in enumerate(settings['states']):
+            parameters = dict(settings['model'], eps=eps, **state)
+            parameters.update(Vsd=result['Vsd'], eps_d=result['eps_d'], width=result['width'])
+            e_chem, e_hyb, e_ortho, occupancy, filling = \
+                _evaluate_chemisorption(fitting_class, add_largeS_contribution, parameters)
+            energies += [ e_chem, e_hyb, e_ortho ]
+            result['occupancy' if n_states == 1 else f'occupancy_{i+1}'] = occupancy
+            # The filling of the d-band does not depend on the adsorbate
+            result['filling'] = filling
+        energies *= result['no_of_bonds']
+        result['chemisorption_energy'], result['hybridisation_energy'], \
+            result['orthogonalisation_energy'] = energies.tolist()
+    except (AssertionError, ValueError, TypeError, ArithmeticError) as error:
+        result['error'] = f'{type(error).__name__}: {error}'
+        for field in fields[fields.index('chemisorption_energy'):-1]:
+            result[field] = math.nan
+
+    return result
+
+
+def evaluate_chunk(settings, chunk) -> list:
+    """Evaluate a chunk of (index, material) pairs; sent to the worker processes."""
+    return [ evaluate_material(settings, index, material) for index, material in chunk ]
+
+
+def count_completed(filename, file_format) -> int:
+    """Count the results already written to an output file, reading it line
+    by line. A last line cut short by an interrupted run is removed, so that
+    the run can be resumed by appending to the file."""
+    with open(filename, 'rb+') as handle:
+        handle.seek(0, os.SEEK_END)
+        size = handle.tell()
+        if size == 0:
+            return 0
+        # Drop everything after the last complete line
+        position = size
+        while position > 0:
+            step = min(position, 65536)
+            handle.seek(position - step)
+            block = handle.read(step)
+            newline = block.rfind(b'\n')
+            if newline >= 0:
+                position = position - step + newline + 1
+                break
+            position -= step
+        handle.truncate(position)
+
+    with open(filename, newline='') as handle:
+        if file_format == 'csv':
+            return max(sum(1 for _ in csv.reader(handle)) - 1, 0)
+        return sum(1 for line in handle if line.strip())
+
+
+def _write_results(handle, writer, results, file_format):
+    """Append the results of a chunk to the output and flush them to disk."""
+    for result in results:
+        if file_format == 'csv':
+            writer.writerow(result)
+        else:
+            # nan is not valid JSON
+            result = { key: None if isinstance(value, float) and math.isnan(value) else value
+                       for key, value in result.items() }
+            handle.write(json.dumps(result) + '\n')
+    handle.flush()
+
+
+def _get_chunks(materials, chunk_size):
+    """Group the (index, material) pairs into lists of chunk_size."""
+    while True:
+        chunk = list(itertools.islice(materials, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def screen_materials(input_file, output_file, settings, chunk_size=64, n_jobs=1,
+                     resume=False, input_format=None, output_format=None, verbose=False) -> dict:
+    """Evaluate the model for every material of input_file and append the
+    results to output_file chunk by chunk, in the order of the input. At
+    most two chunks per worker process are in flight, so that the memory
+    used does not grow with the size of the input. With resume, the
+    materials that already have a result in output_file are skipped;
+    the settings of the run are stored next to the output and have
+    to be the same to resume it.
+
+    Returns the number of materials evaluated and of those that failed."""
+    assert chunk_size >= 1, "chunk_size must be at least one."
+    assert n_jobs >= 1, "n_jobs must be at least one."
+    output_format = _get_format(output_file, output_format)
+    fields = get_output_fields(len(settings['states']))
+    settings_file = output_file + SETTINGS_SUFFIX
+    # Compared as they are read back from the file
+    stored_settings = json.loads(json.dumps(settings))
+
+    completed = 0
+    if resume and os.path.exists(output_file):
+        if os.path.exists(settings_file):
+            with open(settings_file) as handle:
+                if json.load(handle) != stored_settings:
+                    raise click.ClickException(f'{output_file} was written with different settings.')
+        completed = count_completed(output_file, output_format)
+        if verbose:
+            click.echo(f'Resuming after {completed} materials', err=True)
+    with open(settings_file, 'w') as handle:
+        json.dump(stored_settings, handle, indent=2)
+
+    materials = itertools.islice(enumerate(read_materials(input_file, input_format)), completed, None)
+    chunks = _get_chunks(materials, chunk_size)
+    statistics = {'evaluated': 0, 'failed': 0}
+
+    with open(output_file, 'a' if completed else 'w', newline='') as handle:
+        writer = None
+        if output_format == 'csv':
+            writer = csv.DictWriter(handle, fieldnames=fields)
+            if not completed:
+                writer.writeheader()
+
+        def write(results):
+            _write_results(handle, writer, results, output_format)
+            statistics['evaluated'] += len(results)
+            statistics['failed'] += sum(1 for result in results if result['error'])
+            if verbose:
+                click.echo(f'{completed + statistics["evaluated"]} materials done, '
+                           f'{statistics["failed"]} failed', err=True)
+
+        if n_jobs == 1:
+            for chunk in chunks:
+                write(evaluate_chunk(settings, chunk))
+        else:
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                pending = deque()
+                for chunk in chunks:
+                    pending.append(executor.submit(evaluate_chunk, settings, chunk))
+                    # Write out in order as soon as enough chunks are queued
+                    while len(pending) >= 2 * n_jobs:
+                        write(pending.popleft().result())
+                while pending:
+                    write(pending.popleft().result())
+
+    return statistics
+
+
+def _get_states(parameters, eps_a, alpha, beta, constant_offset) -> list:
+    """Combine the parameters of the single particle states from a YAML or
+    JSON file with those given as options, the latter taking precedence."""
+    values = {}
+    if parameters is not None:
+        with open(parameters) as handle:
+            values = yaml.safe_load(handle) or {}
+    for key, option in zip(STATE_FIELDS, [ eps_a, alpha, beta, constant_offset ]):
+        if option:
+            values[key] = list(option)
+        value = values.get(key, 0.0 if key == 'constant_offset' else None)
+        if value is None:
+            raise click.UsageError(f'{key} has to be given as an option or in the parameters file.')
+        values[key] = np.atleast_1d(value).astype(float).tolist()
+
+    n_states = len(values['eps_a'])
+    for key in STATE_FIELDS:
+        if len(values[key]) == 1:
+            values[key] = values[key] * n_states
+        if len(values[key]) != n_states:
+            raise click.UsageError(f'{key} needs one value for every eps_a.')
+    return [ { key: values[key][i] for key in STATE_FIELDS } for i in range(n_states) ]
+
+
+@click.group()
+def main():
+    """Newns-Anderson model of chemisorption with orthogonalisation."""
+
+
+@main.command()
+@click.argument('input_file', type=click.Path(exists=True, dir_okay=False))
+@click.argument('output_file', type=click.Path(dir_okay=False))
+@click.option('--model', 'type_repulsion', type=click.Choice(['linear', 'linear_mod', 'grimley']),
+              default='linear', show_default=True, help='Type of the repulsion.')
+@click.option('--parameters', type=click.Path(exists=True, dir_okay=False),
+              help='YAML or JSON file with eps_a, alpha, beta and constant_offset.')
+@click.option('--eps-a', type=float, multiple=True, help='Energy of a single particle state.')
+@click.option('--alpha', type=float, multiple=True, help='alpha of a single particle state.')
+@click.option('--beta', type=float, multiple=True, help='beta of a single particle state.')
+@click.option('--constant-offset', type=float, multiple=True, help='Constant offset of a single particle state.')
+@click.option('--delta0', 'Delta0_mag', type=float, default=0.1, show_default=True,
+              help='Augmentation of the sp states into the d-states.')
+@click.option('--eps-min', type=float, default=-30, show_default=True)
+@click.option('--eps-max', type=float, default=10, show_default=True)
+@click.option('--n-eps', type=int, default=1000, show_default=True)
+@click.option('--eps-sp-min', type=float, default=-15, show_default=True)
+@click.option('--eps-sp-max', type=float, default=15, show_default=True)
+@click.option('--precision', type=int, default=50, show_default=True)
+@click.option('--quadrature', type=click.Choice(['adaptive', 'gauss_legendre']),
+              default='adaptive', show_default=True)
+@click.option('--occupancy-engine', type=click.Choice(['arb', 'float']), default='arb', show_default=True)
+@click.option('--precision-policy', type=click.Choice(['fixed', 'escalate']), default='fixed', show_default=True)
+@click.option('--id-column', default='name', show_default=True,
+              help='Column of the input copied to the output to identify the material.')
+@click.option('--input-format', type=click.Choice(['csv', 'jsonl']), help='Guessed from the extension by default.')
+@click.option('--output-format', type=click.Choice(['csv', 'jsonl']), help='Guessed from the extension by default.')
+@click.option('--chunk-size', type=click.IntRange(min=1), default=64, show_default=True,
+              help='Materials evaluated together by a worker and written at once.')
+@click.option('-j', '--n-jobs', type=click.IntRange(min=1), default=1, show_default=True,
+              help='Number of worker processes.')
+@click.option('--resume', is_flag=True, help='Skip the materials already in the output.')
+@click.option('--overwrite', is_flag=True, help='Replace an existing output.')
+@click.option('-v', '--verbose', is_flag=True)
+def screen(input_file, output_file, type_repulsion, parameters, eps_a, alpha, beta, constant_offset,
+           Delta0_mag, eps_min, eps_max, n_eps, eps_sp_min, eps_sp_max, precision, quadrature,
+           occupancy_engine, precision_policy, id_column, input_format, output_format,
+           chunk_size, n_jobs, resume, overwrite, verbose):
+    """Compute the chemisorption energy of every material in INPUT_FILE.
+
+    INPUT_FILE is a CSV or JSON Lines file with eps_d, width, Vsd and,
+    optionally, no_of_bonds for every material. The results are appended
+    to OUTPUT_FILE as they are computed, in the order of the input.
+    """
+    if os.path.exists(output_file) and not ( resume or overwrite ):
+        raise click.UsageError(f'{output_file} exists; use --resume to continue or --overwrite to replace it.')
+
+    settings = {
+        'type_repulsion': type_repulsion,
+        'states': _get_states(parameters, eps_a, alpha, beta, constant_offset),
+        'id_column': id_column,
+        # The energy grid is created by the workers from its bounds
+        'eps': [ eps_min, eps_max, n_eps ],
+        'model': {
+            'Delta0_mag': Delta0_mag,
+            'eps_sp_min': eps_sp_min,
+            'eps_sp_max': eps_sp_max,
+            'precision': precision,
+            'quadrature': quadrature,
+            'occupancy_engine': occupancy_engine,
+            'precision_policy': precision_policy,
+        },
+    }
+    statistics = screen_materials(input_file, output_file, settings, chunk_size=chunk_size,
+                                  n_jobs=n_jobs, resume=resume, input_format=input_format,
+                                  output_format=output_format, verbose=verbose)
+    click.echo(f'Evaluated {statistics["evaluated"]} materials, {statistics["failed"]} failed.', err=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,7 +2,7 @@
 from matplotlib.colors import Colormap
 import numpy as np
 import matplotlib.pyplot as plt
-from catchemi import NewnsAndersonNumerical
+from catchemi import NewnsAndersonBatch
 from plot_params import get_plot_params
 get_plot_params()
 
@@ -21,23 +21,19 @@ if __name__ == '__main__':
     delta0 = 0
     Vak = 1
 
-    energy_matrix = np.zeros((len(widths), len(eps_ds)))
-    na_matrix = np.zeros((len(widths), len(eps_ds)))
-
-    for i, width in enumerate(widths):
-        for j, eps_d in enumerate(eps_ds):
-
-            newns = NewnsAndersonNumerical(
-                width = width,
-                Vak = Vak, 
-                eps_a = EPS_A,
-                eps_d = eps_d,
-                eps = EPS_RANGE,
-                Delta0_mag = delta0, 
-            )
-
-            energy_matrix[i, j] = newns.get_hybridisation_energy()
-            na_matrix[i, j] = newns.get_occupancy()
+    # Evaluate the whole map at once, widths along the rows
+    # and d-band centres along the columns
+    newns = NewnsAndersonBatch(
+        width = widths[:, None],
+        Vak = Vak, 
+        eps_a = EPS_A,
+        eps_d = eps_ds[None, :],
+        eps = EPS_RANGE,
+        Delta0_mag = delta0, 
+    )
+
+    energy_matrix = newns.get_hybridisation_energy()
+    na_matrix = newns.get_occupancy()
 
     # Plot the contour
     energy_matrix = energy_matrix.T
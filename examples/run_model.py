@@ -139,9 +139,14 @@ if __name__ == '__main__':
 
         # Finding the fitting parameters
         data = odr.RealData(parameters['d_band_centre'], dft_energies)
-        fitting_model = odr.Model(fitting_function.fit_parameters)
+        # The Jacobian is supplied analytically instead of
+        # through finite differences of the chemisorption energy;
+        # fjacd is required by scipy but not used by ordinary least squares
+        fitting_model = odr.Model(fitting_function.fit_parameters,
+                                  fjacb=fitting_function.jacobian,
+                                  fjacd=lambda beta, x: np.zeros_like(x))
         fitting_odr = odr.ODR(data, fitting_model, initial_guess)
-        fitting_odr.set_job(fit_type=2)
+        fitting_odr.set_job(fit_type=2, deriv=3)
         output = fitting_odr.run()
 
         # Get the final hybridisation energy